@@ -0,0 +1,356 @@
+import argparse
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from faiss_store import sync_index, load_bm25
+from config import config
+from ingest import iter_notes
+from note_chunker import NoteChunker, chunk_notes
+from local_validator import validate_records
+from mmap_store import MmapVectorStore, export_store
+from offline_backends import HashEmbeddings
+from retrieval import multi_query_search
+from rule_extractor import split_by_rules
+
+try:
+    import resource
+except ImportError:  # POSIX only; memory figures are reported as unavailable (None) on Windows
+    resource = None
+
+# Offline benchmark + accuracy regression check. Everything runs on local stand-ins
+# (offline_backends.py), so numbers are comparable across commits and need no Azure access:
+#   python benchmark.py                      bundled CSV and a 4x synthetic corpus
+#   python benchmark.py --compare bench_results/latest.json
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CSV = os.path.join(REPO, "d2c1f46e2b3267d315fb03f76724aa7036ea01b3f1803e94126e26dc26881629.csv")
+REFERENCE = os.path.join(REPO, "kappa_lambda_results_cleaned.json")
+QUERIES = ["lambda", "klc", "flc", "kflc", "lflc", "free light chain"]
+SCRIPTS = ["vectorize_patient_emr.py", "extract_flca.py", "main.py"]
+
+
+def make_synthetic_corpus(csv_path: str, scale: int, out_path: str) -> str:
+    """Replicate the corpus `scale` times, each copy as a different patient with distinct titles."""
+    frame = pd.read_csv(csv_path, usecols=["title", "text"])
+    copies = [frame]
+    for k in range(1, scale):
+        copy = frame.copy()
+        copy["title"] = copy["title"] + f"_x{k}"
+        copy["text"] = copy["text"].str.replace(
+            r"(?<!Master)PatientId:\s*(\S+)",
+            lambda m: "PatientId: " + hashlib.sha256(f"{m.group(1)}-{k}".encode()).hexdigest(),
+            n=1, regex=True,
+        )
+        copies.append(copy)
+    pd.concat(copies, ignore_index=True).to_csv(out_path, index=False)
+    return out_path
+
+
+def _rss_mb() -> Optional[float]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        return _peak_rss_mb()
+
+
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    # ru_maxrss is KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+
+def _round_mb(value: Optional[float]) -> Optional[float]:
+    return round(value, 1) if value is not None else None
+
+
+def _format_mb(value: Optional[float]) -> str:
+    return f"{value:>8.1f} MB" if value is not None else f"{'n/a':>8}   "
+
+
+class Stage:
+    """Context manager recording wall time and memory of one benchmark stage into `results`."""
+
+    def __init__(self, name: str, results: List[dict]):
+        self.name = name
+        self.results = results
+        self.extra: Dict[str, Any] = {}
+
+    def __enter__(self):
+        self.rss_before = _rss_mb()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        rss = _rss_mb()
+        delta = rss - self.rss_before if rss is not None and self.rss_before is not None else None
+        self.results.append({
+            "stage": self.name,
+            "seconds": round(seconds, 4),
+            "rss_mb": _round_mb(rss),
+            "rss_delta_mb": _round_mb(delta),
+            "peak_rss_mb": _round_mb(_peak_rss_mb()),
+            **self.extra,
+        })
+        print(f"[Bench] {self.name}: {seconds:.3f}s {self.extra}")
+        return False
+
+
+def run_stages(csv_path: str, workdir: str, query_repeats: int = 20) -> List[dict]:
+    """Time the pipeline's building blocks in-process with hash embeddings."""
+    stages = []
+    embeddings = HashEmbeddings()
+    chunker = NoteChunker(config["chunking"]["chunk_size"], config["chunking"]["overlap"])
+    index_path = os.path.join(workdir, "bench_index")
+    store_path = os.path.join(workdir, "bench_store")
+
+    with Stage("ingest", stages) as stage:
+        chunks = list(chunk_notes(iter_notes(csv_path), chunker, workers=config["chunking"]["workers"]))
+        stage.extra = {"chunks": len(chunks), "notes": len({c.metadata["source"] for c in chunks})}
+
+    with Stage("index_build", stages) as stage:
+        store = sync_index(chunks, embeddings, index_path)
+        stage.extra = {"vectors": store.index.ntotal}
+
+    with Stage("index_resync", stages):
+        store = sync_index(chunks, embeddings, index_path)
+
+    with Stage("export_mmap", stages):
+        export_store(store, store_path, index_path=index_path)
+
+    with Stage("open_mmap", stages):
+        mapped = MmapVectorStore.load(store_path, embeddings)
+        bm25 = load_bm25(mapped, store_path)
+
+    latencies = []
+    with Stage("query", stages) as stage:
+        for _ in range(query_repeats):
+            start = time.perf_counter()
+            hits = multi_query_search(mapped, bm25, QUERIES, vector_k=100)
+            latencies.append(1000 * (time.perf_counter() - start))
+        stage.extra = {
+            "repeats": query_repeats,
+            "hits": len(hits),
+            "p50_ms": round(float(np.percentile(latencies, 50)), 2),
+            "p95_ms": round(float(np.percentile(latencies, 95)), 2),
+        }
+
+    documents = [
+        {"title": doc.metadata.get("source", "unknown_source"), "medical_notes": doc.page_content.strip()}
+        for doc, _ in hits if any(q in doc.page_content.lower() for q in QUERIES)
+    ]
+    note_dates = {doc.metadata.get("source", "unknown_source"): doc.metadata["note_date"]
+                  for doc, _ in hits if doc.metadata.get("note_date")}
+    with Stage("rules", stages) as stage:
+        records, unresolved = split_by_rules(documents, note_dates=note_dates)
+        stage.extra = {"chunks": len(documents), "records": len(records), "unresolved": len(unresolved)}
+
+    with Stage("local_validate", stages) as stage:
+        sources = {}
+        for doc in documents:
+            sources[doc["title"]] = sources.get(doc["title"], "") + doc["medical_notes"] + "\n"
+        checked = validate_records(records, sources, note_dates)
+        stage.extra = {status: len(items) for status, items in checked.items()}
+
+    return stages
+
+
+def run_script(script: str, workdir: str, env: Dict[str, str], timeout: int = 3600) -> dict:
+    """Run one pipeline script end to end in `workdir`; returns wall time and the child's peak RSS
+    (None where os.wait4 is unavailable, i.e. on Windows)."""
+    log_path = os.path.join(workdir, script.replace(".py", ".log"))
+    start = time.perf_counter()
+    with open(log_path, "w", encoding="utf-8") as log:
+        process = subprocess.Popen([sys.executable, os.path.join(REPO, script)], cwd=workdir, env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        killer = threading.Timer(timeout, process.kill)
+        killer.start()
+        peak = None
+        if hasattr(os, "wait4"):
+            # wait4 gives this child's own rusage (RUSAGE_CHILDREN would be the max over all children)
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.waitstatus_to_exitcode(status)
+            peak = usage.ru_maxrss / (2 ** 20 if sys.platform == "darwin" else 2 ** 10)
+        else:
+            process.wait()
+        killer.cancel()
+    seconds = time.perf_counter() - start
+    result = {
+        "script": script,
+        "seconds": round(seconds, 3),
+        "returncode": process.returncode,
+        "peak_rss_mb": _round_mb(peak),
+        "log": log_path,
+    }
+    print(f"[Bench] {script}: {seconds:.2f}s, exit {process.returncode}")
+    return result
+
+
+def _normalize_value(value: Any) -> str:
+    text = str(value or "").lower().replace(" ", "").replace("mg/dl", "").replace("mg/l", "")
+    return text.rstrip(".")
+
+
+def record_key(record: Dict[str, Any], with_date: bool = True) -> tuple:
+    key = tuple(_normalize_value(record.get(f)) for f in ("kappa_flc", "lambda_flc", "kappa_lambda_ratio"))
+    return key + (str(record.get("date_of_lab") or "").strip(),) if with_date else key
+
+
+def score_records(records: List[Dict[str, Any]], reference: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Precision / recall / F1 of unique lab results against the reference, with and without the date."""
+    scores = {}
+    for name, with_date in (("values_and_date", True), ("values_only", False)):
+        predicted = {record_key(r, with_date) for r in records}
+        expected = {record_key(r, with_date) for r in reference}
+        tp = len(predicted & expected)
+        precision = tp / len(predicted) if predicted else 0.0
+        recall = tp / len(expected) if expected else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        scores[name] = {"predicted": len(predicted), "reference": len(expected), "true_positives": tp,
+                        "precision": round(precision, 4), "recall": round(recall, 4), "f1": round(f1, 4)}
+    return scores
+
+
+def load_script_outputs(workdir: str) -> Dict[str, List[dict]]:
+    outputs = {}
+    for script, prefix in (("extract_flca.py", "flca"), ("main.py", os.path.join("main_output", "Output2"))):
+        path = os.path.join(workdir, prefix)
+        if os.path.exists(path + ".jsonl"):
+            with open(path + ".jsonl", "r", encoding="utf-8") as f:
+                outputs[script] = [json.loads(line) for line in f if line.strip()]
+        elif os.path.exists(path + ".xlsx"):
+            outputs[script] = pd.read_excel(path + ".xlsx").to_dict("records")
+    return outputs
+
+
+def compare_results(current: dict, previous: dict, f1_tolerance: float = 0.02,
+                    time_tolerance: float = 0.5) -> List[str]:
+    """Regressions of `current` vs `previous`: F1 drops beyond f1_tolerance and stages slower by
+    more than time_tolerance (fraction)."""
+    regressions = []
+    before = {c["corpus"]: c for c in previous.get("corpora", [])}
+    for corpus in current.get("corpora", []):
+        old = before.get(corpus["corpus"])
+        if old is None:
+            continue
+        for script, scores in corpus.get("scores", {}).items():
+            old_f1 = old.get("scores", {}).get(script, {}).get("values_and_date", {}).get("f1")
+            new_f1 = scores["values_and_date"]["f1"]
+            if old_f1 is not None and new_f1 < old_f1 - f1_tolerance:
+                regressions.append(f"{corpus['corpus']}/{script}: F1 {old_f1:.3f} -> {new_f1:.3f}")
+        old_stages = {s["stage"]: s for s in old.get("stages", [])}
+        for stage in corpus.get("stages", []):
+            old_stage = old_stages.get(stage["stage"])
+            # Ignore sub-10ms stages, their timings are noise
+            if old_stage and old_stage["seconds"] > 0.01 and stage["seconds"] > old_stage["seconds"] * (1 + time_tolerance):
+                regressions.append(f"{corpus['corpus']}/{stage['stage']}: "
+                                   f"{old_stage['seconds']:.3f}s -> {stage['seconds']:.3f}s")
+    return regressions
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_summary(results: dict) -> str:
+    lines = []
+    for corpus in results["corpora"]:
+        lines.append(f"== {corpus['corpus']} ==")
+        for stage in corpus["stages"]:
+            lines.append(f"  {stage['stage']:<16} {stage['seconds']:>9.3f}s  rss {_format_mb(stage['rss_mb'])}")
+        for script in corpus.get("scripts", []):
+            lines.append(f"  {script['script']:<25} {script['seconds']:>9.2f}s  peak {_format_mb(script['peak_rss_mb'])}"
+                         f"  exit {script['returncode']}")
+        for script, scores in corpus.get("scores", {}).items():
+            s = scores["values_and_date"]
+            lines.append(f"  {script:<25} P {s['precision']:.3f}  R {s['recall']:.3f}  F1 {s['f1']:.3f}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark and FLC accuracy regression suite")
+    parser.add_argument("--csv", default=DEFAULT_CSV)
+    parser.add_argument("--scales", default="1,4", help="corpus sizes as multiples of the CSV")
+    parser.add_argument("--workdir", default="bench_runs")
+    parser.add_argument("--out", default="bench_results")
+    parser.add_argument("--reference", default=REFERENCE)
+    parser.add_argument("--skip-scripts", action="store_true", help="only run the in-process stages")
+    parser.add_argument("--llm-latency", type=float, default=0.0, help="simulated seconds per LLM call")
+    parser.add_argument("--query-repeats", type=int, default=20)
+    parser.add_argument("--compare", default=None, help="earlier results JSON to check for regressions")
+    args = parser.parse_args()
+
+    with open(args.reference, "r", encoding="utf-8") as f:
+        reference = json.load(f)
+    previous = None
+    if args.compare:
+        # Read before this run overwrites latest.json
+        with open(args.compare, "r", encoding="utf-8") as f:
+            previous = json.load(f)
+
+    results = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "corpora": [],
+    }
+    for scale in [int(s) for s in args.scales.split(",") if s]:
+        name = f"x{scale}"
+        workdir = os.path.abspath(os.path.join(args.workdir, name))
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(os.path.join(workdir, "prompts"))
+        # extract_flca.py reads its template from prompts/ relative to the working directory
+        shutil.copyfile(os.path.join(REPO, "flca_extraction.txt"), os.path.join(workdir, "prompts", "flca_extraction.txt"))
+        csv_path = args.csv if scale == 1 else make_synthetic_corpus(args.csv, scale, os.path.join(workdir, "corpus.csv"))
+        print(f"[Bench] Corpus {name}: {csv_path}")
+
+        corpus = {"corpus": name, "scale": scale, "stages": run_stages(csv_path, workdir, args.query_repeats)}
+        if not args.skip_scripts:
+            env = {
+                **os.environ,
+                "OFFLINE_BACKENDS": "1",
+                "OFFLINE_LLM_LATENCY": str(args.llm_latency),
+                "EMR_CSV_PATH": os.path.abspath(csv_path),
+                "MAIN_OUTPUT_DIR": os.path.join(workdir, "main_output"),
+                "LLM_CACHE_MODE": "bypass",
+                # Time the full run, not a resume from an earlier benchmark's checkpoints
+                "CHECKPOINT_MODE": "off",
+                "PYTHONPATH": REPO + os.pathsep + os.environ.get("PYTHONPATH", ""),
+            }
+            corpus["scripts"] = [run_script(script, workdir, env) for script in SCRIPTS]
+            corpus["scores"] = {script: score_records(records, reference)
+                                for script, records in load_script_outputs(workdir).items()}
+        results["corpora"].append(corpus)
+
+    print(format_summary(results))
+    os.makedirs(args.out, exist_ok=True)
+    out_path = os.path.join(args.out, f"{results['commit'] or 'nocommit'}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    for path in (out_path, os.path.join(args.out, "latest.json")):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    print(f"[Bench] Results written to {out_path}")
+
+    if previous is not None:
+        regressions = compare_results(results, previous)
+        for line in regressions:
+            print(f"[Bench] REGRESSION {line}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,173 @@
+import heapq
+import math
+import os
+import sqlite3
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from util import normalize_text
+
+BM25_FILE = "bm25.sqlite"
+
+# Query terms shorter than this are not expanded to the longer tokens starting with them
+MIN_SUBSTRING_TERM = 3
+
+# Readers map the file instead of copying it into the process (up to this many bytes)
+MMAP_BYTES = 1 << 30
+
+_SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS docs (chunk_id TEXT PRIMARY KEY, len INTEGER NOT NULL) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, chunk_id TEXT NOT NULL, tf INTEGER NOT NULL,"
+    " PRIMARY KEY (term, chunk_id)) WITHOUT ROWID",
+]
+
+
+def tokenize(text: str) -> List[str]:
+    return normalize_text(text).split()
+
+
+class BM25Index:
+    """Inverted index over chunk ids, kept next to the FAISS index in the same folder.
+
+    Postings live in SQLite. A new or writable index works on an in-memory database that save()
+    writes out; load() opens the saved file read-only and memory-mapped, so processes searching
+    the same index share one page-cached copy instead of each parsing it into their own memory.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75, conn: Optional[sqlite3.Connection] = None):
+        if conn is None:
+            conn = sqlite3.connect(":memory:", check_same_thread=False)
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            conn.executemany("INSERT INTO meta VALUES (?, ?)", [("k1", k1), ("b", b)])
+        self._conn = conn
+        self._lock = threading.Lock()
+        meta = dict(conn.execute("SELECT key, value FROM meta"))
+        self.k1, self.b = meta["k1"], meta["b"]
+        self._n_docs, self._total_len = conn.execute("SELECT COUNT(*), COALESCE(SUM(len), 0) FROM docs").fetchone()
+
+    def __len__(self) -> int:
+        return self._n_docs
+
+    def __contains__(self, chunk_id: str) -> bool:
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM docs WHERE chunk_id = ?", (chunk_id,)).fetchone() is not None
+
+    def chunk_ids(self) -> Set[str]:
+        with self._lock:
+            return {chunk_id for (chunk_id,) in self._conn.execute("SELECT chunk_id FROM docs")}
+
+    def add(self, chunk_id: str, text: str) -> None:
+        if chunk_id in self:
+            return
+        tokens = tokenize(text)
+        with self._lock:
+            self._conn.executemany("INSERT INTO postings VALUES (?, ?, ?)",
+                                   [(term, chunk_id, tf) for term, tf in Counter(tokens).items()])
+            self._conn.execute("INSERT INTO docs VALUES (?, ?)", (chunk_id, len(tokens)))
+        self._n_docs += 1
+        self._total_len += len(tokens)
+
+    def remove(self, chunk_id: str, text: str) -> None:
+        with self._lock:
+            row = self._conn.execute("SELECT len FROM docs WHERE chunk_id = ?", (chunk_id,)).fetchone()
+            if row is None:
+                return
+            self._conn.executemany("DELETE FROM postings WHERE term = ? AND chunk_id = ?",
+                                   [(term, chunk_id) for term in set(tokenize(text))])
+            self._conn.execute("DELETE FROM docs WHERE chunk_id = ?", (chunk_id,))
+        self._n_docs -= 1
+        self._total_len -= row[0]
+
+    def _postings(self, term: str, prefix: bool) -> Dict[str, Dict[str, int]]:
+        # term -> {chunk_id: tf}. A prefix lookup covers vocabulary terms starting with `term`
+        # (tokens are ASCII, so term + U+10FFFF bounds the range)
+        if prefix:
+            sql = "SELECT term, chunk_id, tf FROM postings WHERE term >= ? AND term < ?"
+            params = (term, term + "\U0010ffff")
+        else:
+            sql, params = "SELECT term, chunk_id, tf FROM postings WHERE term = ?", (term,)
+        found = defaultdict(dict)
+        with self._lock:
+            for vocab_term, chunk_id, tf in self._conn.execute(sql, params):
+                found[vocab_term][chunk_id] = tf
+        return found
+
+    def _doc_lens(self, chunk_ids: Set[str]) -> Dict[str, int]:
+        ids = list(chunk_ids)
+        lens = {}
+        with self._lock:
+            for start in range(0, len(ids), 500):
+                batch = ids[start:start + 500]
+                lens.update(self._conn.execute(
+                    f"SELECT chunk_id, len FROM docs WHERE chunk_id IN ({', '.join('?' * len(batch))})", batch))
+        return lens
+
+    def search(self, query: str, k: Optional[int] = None, substring: bool = False) -> List[Tuple[str, float]]:
+        """BM25-score every chunk containing all query terms; k=None returns all of them.
+
+        With substring=True a query term also matches longer tokens starting with it ("ratio"
+        matches "ratios"); terms shorter than MIN_SUBSTRING_TERM (a bare "m" from "m-spike") would
+        match most of the vocabulary, so they only match exactly. A multi-word query ("free light
+        chain") matches a chunk only when every word (or a word it starts) is in the chunk.
+        """
+        if not self._n_docs:
+            return []
+        avgdl = self._total_len / self._n_docs
+        groups = [self._postings(t, substring and len(t) >= MIN_SUBSTRING_TERM)
+                  for t in dict.fromkeys(tokenize(query))]
+        if not groups:
+            return []
+        matched = None
+        for group in groups:
+            ids = {chunk_id for docs in group.values() for chunk_id in docs}
+            matched = ids if matched is None else matched & ids
+            if not matched:
+                return []
+        doc_len = self._doc_lens(matched)
+        postings = {term: docs for group in groups for term, docs in group.items()}
+        scores = defaultdict(float)
+        for docs in postings.values():
+            idf = math.log(1 + (self._n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for chunk_id, tf in docs.items():
+                if chunk_id not in matched:
+                    continue
+                norm = self.k1 * (1 - self.b + self.b * doc_len[chunk_id] / avgdl)
+                scores[chunk_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        if k is None:
+            return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+        return heapq.nlargest(k, scores.items(), key=lambda x: x[1])
+
+    def save(self, folder: str) -> None:
+        """Write the index to <folder>/bm25.sqlite, swapped in with os.replace so open readers keep
+        the previous file."""
+        tmp_path = os.path.join(folder, BM25_FILE + ".tmp")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        target = sqlite3.connect(tmp_path)
+        with self._lock:
+            self._conn.commit()
+            self._conn.backup(target)
+        target.close()
+        os.replace(tmp_path, os.path.join(folder, BM25_FILE))
+
+    @classmethod
+    def load(cls, folder: str, writable: bool = False) -> "BM25Index":
+        """Open a saved index read-only (memory-mapped); writable=True copies it into memory for
+        add/remove and a later save()."""
+        path = os.path.join(folder, BM25_FILE)
+        if writable:
+            source = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            conn = sqlite3.connect(":memory:", check_same_thread=False)
+            source.backup(conn)
+            source.close()
+        else:
+            conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size = {MMAP_BYTES}")
+        return cls(conn=conn)
+
+    @classmethod
+    def exists(cls, folder: str) -> bool:
+        return os.path.exists(os.path.join(folder, BM25_FILE))
@@ -0,0 +1,231 @@
+import functools
+import hashlib
+import inspect
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from langchain_core.messages import AIMessage
+
+from llm_runner import run_prompts, LLMBatchError
+
+# resume: reuse finished nodes/batches; restart: drop all checkpoints first; off: no checkpointing
+CHECKPOINT_MODES = ("resume", "restart", "off")
+
+
+def content_hash(*parts: Any) -> str:
+    payload = json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def index_fingerprint(store) -> str:
+    """Hash of the chunk ids in an index (FAISS or mmap store); changes whenever the corpus does."""
+    digest = hashlib.sha256()
+    for chunk_id in store.index_to_docstore_id.values():
+        digest.update(chunk_id.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def source_hash(*paths: str) -> str:
+    """Hash of the text of files a node depends on (prompt templates, rule / validator modules)."""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def llm_key(llm) -> str:
+    """deployment/model of the chat model behind `llm` (unwrapping the response cache), so answers
+    from different backends (e.g. the offline stand-in vs gpt-4o) never share a checkpoint."""
+    key = getattr(llm, "model_key", None)
+    if key:
+        return key
+    return f"{getattr(llm, 'deployment_name', None) or ''}/{getattr(llm, 'model_name', None) or ''}"
+
+
+def refreshing(llm) -> bool:
+    """True when the response cache is in refresh mode: the model must be asked again, so
+    checkpointed answers are not restored either (new ones are still saved)."""
+    return getattr(llm, "mode", None) == "refresh"
+
+
+class CheckpointStore:
+    """Durable checkpoints for long runs: graph state after each node and each finished LLM batch.
+
+    Node checkpoints are keyed by (node, hash of the node's input state and salt); batch
+    checkpoints by (stage, model, hash of the prompt). Both are written as soon as the work
+    finishes, so a killed run loses at most the batches that were in flight.
+    """
+
+    def __init__(self, path: str = "checkpoints.sqlite", enabled: bool = True):
+        self.path = path
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._conn = None
+        if not enabled:
+            return
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS node_states ("
+            " key TEXT PRIMARY KEY, node TEXT NOT NULL, state TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS batches ("
+            " key TEXT PRIMARY KEY, stage TEXT NOT NULL, content TEXT NOT NULL, usage TEXT, created REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def clear(self) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._conn.execute("DELETE FROM node_states")
+            self._conn.execute("DELETE FROM batches")
+            self._conn.commit()
+
+    def get_node(self, key: str) -> Optional[dict]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT state FROM node_states WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_node(self, key: str, node: str, state: dict) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO node_states (key, node, state, created) VALUES (?, ?, ?, ?)",
+                (key, node, json.dumps(state, default=str), time.time()),
+            )
+            self._conn.commit()
+
+    def get_batches(self, keys: Sequence[str]) -> Dict[str, AIMessage]:
+        if not self.enabled or not keys:
+            return {}
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                part = list(keys[start:start + 500])
+                rows = self._conn.execute(
+                    f"SELECT key, content, usage FROM batches WHERE key IN ({','.join('?' * len(part))})", part
+                ).fetchall()
+                for key, content, usage in rows:
+                    found[key] = AIMessage(content=content, response_metadata={"checkpoint": True},
+                                           usage_metadata=json.loads(usage) if usage else None)
+        return found
+
+    def put_batch(self, key: str, stage: str, response) -> None:
+        if not self.enabled:
+            return
+        usage = getattr(response, "usage_metadata", None)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO batches (key, stage, content, usage, created) VALUES (?, ?, ?, ?, ?)",
+                (key, stage, response.content, json.dumps(usage) if usage else None, time.time()),
+            )
+            self._conn.commit()
+
+
+_checkpoints = CheckpointStore(enabled=False)
+
+
+def get_checkpoints() -> CheckpointStore:
+    return _checkpoints
+
+
+def open_checkpoints(path: str = "checkpoints.sqlite", mode: str = "resume") -> CheckpointStore:
+    """Install the global checkpoint store used by checkpoint_node and run_prompts_checkpointed."""
+    global _checkpoints
+    if mode not in CHECKPOINT_MODES:
+        raise ValueError(f"Unknown checkpoint mode '{mode}', expected one of {CHECKPOINT_MODES}")
+    _checkpoints = CheckpointStore(path, enabled=mode != "off")
+    if mode == "restart":
+        _checkpoints.clear()
+    if mode != "off":
+        print(f"[Checkpoint] {mode} from {path}")
+    return _checkpoints
+
+
+def checkpoint_node(name: str, salt: Callable[[], Any] = lambda: None, llm=None):
+    """Decorator that skips a LangGraph node whose input state (plus `salt()`) was already processed.
+
+    `salt` covers inputs that are not in the state, e.g. the index fingerprint for retrieval or the
+    prompt templates. For nodes that call `llm`, its deployment/model is part of the key and nothing
+    is restored while its cache is refreshing. Outputs that report failed batches are not
+    checkpointed, so the node runs again on resume (its finished batches are restored by
+    run_prompts_checkpointed).
+    """
+
+    def key_for(state: dict) -> str:
+        return content_hash(name, salt(), llm_key(llm) if llm is not None else None, state)
+
+    def restore(key: str) -> Optional[dict]:
+        if llm is not None and refreshing(llm):
+            return None
+        return get_checkpoints().get_node(key)
+
+    def save(key: str, state: dict, result: dict) -> None:
+        if len(result.get("failed_batches") or []) <= len(state.get("failed_batches") or []):
+            get_checkpoints().put_node(key, name, result)
+
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(state):
+                key = key_for(state)
+                saved = restore(key)
+                if saved is not None:
+                    print(f"[Checkpoint] {name}: restored from checkpoint")
+                    return saved
+                result = await fn(state)
+                save(key, state, result)
+                return result
+        else:
+            @functools.wraps(fn)
+            def wrapper(state):
+                key = key_for(state)
+                saved = restore(key)
+                if saved is not None:
+                    print(f"[Checkpoint] {name}: restored from checkpoint")
+                    return saved
+                result = fn(state)
+                save(key, state, result)
+                return result
+        return wrapper
+
+    return decorate
+
+
+async def run_prompts_checkpointed(llm, prompts: Sequence[str], stage: str, model: str = "gpt-4o",
+                                   **kwargs) -> List[Any]:
+    """run_prompts that only sends prompts without a finished-batch checkpoint and checkpoints
+    each new response the moment it arrives. Results (restored and new) come back in input order.
+
+    Batches are keyed by the wrapped model's deployment/model (`model` is only used to count tokens).
+    """
+    store = get_checkpoints()
+    backend = llm_key(llm)
+    keys = [content_hash(stage, backend, prompt) for prompt in prompts]
+    done = {} if refreshing(llm) else store.get_batches(keys)
+    todo = [i for i, key in enumerate(keys) if key not in done]
+    if done:
+        print(f"[Checkpoint] {stage}: {len(prompts) - len(todo)} of {len(prompts)} batches restored")
+    results = [done.get(key) for key in keys]
+
+    def save(i: int, response) -> None:
+        store.put_batch(keys[todo[i]], stage, response)
+
+    try:
+        fresh = await run_prompts(llm, [prompts[i] for i in todo], model=model, stage=stage, on_result=save, **kwargs)
+    except LLMBatchError as e:
+        for i, response in zip(todo, e.results):
+            results[i] = response
+        raise LLMBatchError([todo[i] for i in e.failed], e.errors, results) from e
+    for i, response in zip(todo, fresh):
+        results[i] = response
+    return results
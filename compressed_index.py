@@ -0,0 +1,195 @@
+import argparse
+import json
+import math
+import os
+import shutil
+import time
+from typing import Dict, List, Optional, Sequence
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+
+from bm25_index import BM25_FILE
+from near_dedup import NEAR_DUPLICATES_FILE
+
+BACKENDS = ("flat", "fp16", "ivfpq")
+
+# The queries the pipelines actually run (extract_flca.py and main.py)
+RECALL_QUERIES = [
+    "lambda",
+    "klc",
+    "flc",
+    "free light chain",
+    "Extract the patient's kappa free light chain (mg/L), lambda free light chain (mg/L), "
+    "and kappa/lambda ratio, along with the lab date and evidence.",
+]
+
+
+def _metric(index: faiss.Index) -> int:
+    return faiss.METRIC_INNER_PRODUCT if index.metric_type == faiss.METRIC_INNER_PRODUCT else faiss.METRIC_L2
+
+
+def build_index(vectors: np.ndarray, backend: str = "flat", metric: int = faiss.METRIC_L2,
+                truncate_dim: Optional[int] = None, nlist: Optional[int] = None, pq_m: int = 64,
+                nbits: Optional[int] = None, nprobe: int = 16, train_size: int = 50_000,
+                seed: int = 0) -> faiss.Index:
+    """Build a FAISS index over `vectors` with one of BACKENDS.
+
+    flat:  exact float32 (what the pipelines use today)
+    fp16:  exact search over float16-stored vectors, half the memory
+    ivfpq: inverted lists + product quantization, trained on a random sample of `train_size`
+
+    `truncate_dim` keeps only the leading dimensions and re-normalizes (text-embedding-3 vectors
+    are Matryoshka-trained, so a prefix is itself a usable embedding). The returned index takes
+    full-size query vectors either way.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown index backend '{backend}', expected one of {BACKENDS}")
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, full_dim = vectors.shape
+    dim = truncate_dim or full_dim
+
+    if backend == "flat":
+        index = faiss.IndexFlat(dim, metric)
+    elif backend == "fp16":
+        index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, metric)
+    else:
+        nlist = nlist or max(1, min(int(4 * math.sqrt(n)), n // 39))
+        # 2**nbits centroids per sub-quantizer need enough training points
+        nbits = nbits or max(4, min(8, int(math.log2(max(16, n // 39)))))
+        while dim % pq_m:
+            pq_m -= 1
+        quantizer = faiss.IndexFlat(dim, metric)
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, nbits, metric)
+        index.nprobe = min(nprobe, nlist)
+
+    if truncate_dim and truncate_dim < full_dim:
+        index = faiss.IndexPreTransform(faiss.NormalizationTransform(dim, 2.0), index)
+        index.prepend_transform(faiss.RemapDimensionsTransform(full_dim, dim, False))
+
+    if not index.is_trained:
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(n, min(n, train_size), replace=False)]
+        index.train(sample)
+    index.add(vectors)
+    return index
+
+
+def index_bytes(index: faiss.Index) -> int:
+    return int(faiss.serialize_index(index).nbytes)
+
+
+def recall_at_k(exact: faiss.Index, approx: faiss.Index, queries: np.ndarray, k: int) -> float:
+    """Mean fraction of the exact top-k that the approximate index also returns in its top-k."""
+    _, truth = exact.search(queries, k)
+    _, found = approx.search(queries, k)
+    hits = [len(set(t[t != -1]) & set(f[f != -1])) / max(1, (t != -1).sum()) for t, f in zip(truth, found)]
+    return float(np.mean(hits))
+
+
+def recall_report(store: FAISS, candidates: Dict[str, faiss.Index], queries: Sequence[str] = RECALL_QUERIES,
+                  ks: Sequence[int] = (10, 50, 100), sample_queries: int = 200, seed: int = 0) -> List[dict]:
+    """Recall@k, size and search time of each candidate index against the store's exact index.
+
+    Queries are the pipeline's own query strings plus `sample_queries` stored chunk vectors
+    (chunks as queries, so the estimate does not rest on a handful of strings).
+    """
+    vectors = np.asarray(store.embedding_function.embed_documents(list(queries)), dtype=np.float32)
+    if store._normalize_L2:
+        faiss.normalize_L2(vectors)
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(store.index.ntotal, min(sample_queries, store.index.ntotal), replace=False)
+    sampled = store.index.reconstruct_batch(np.sort(picks).astype(np.int64))
+    query_sets = {"pipeline": vectors, "sampled": np.vstack([vectors, sampled])}
+
+    rows = []
+    for name, index in {"flat": store.index, **candidates}.items():
+        start = time.perf_counter()
+        index.search(query_sets["sampled"], max(ks))
+        elapsed = time.perf_counter() - start
+        row = {
+            "backend": name,
+            "bytes": index_bytes(index),
+            "ms_per_query": 1000 * elapsed / len(query_sets["sampled"]),
+        }
+        for k in ks:
+            for label, qs in query_sets.items():
+                row[f"recall@{k}_{label}"] = recall_at_k(store.index, index, qs, min(k, store.index.ntotal))
+        rows.append(row)
+    return rows
+
+
+def format_recall_report(rows: List[dict]) -> str:
+    columns = list(rows[0].keys())
+    lines = ["  ".join(f"{c:>22}" for c in columns)]
+    for row in rows:
+        cells = []
+        for c in columns:
+            value = row[c]
+            if c == "bytes":
+                cells.append(f"{value / 2 ** 20:>19.1f} MB")
+            elif isinstance(value, float):
+                cells.append(f"{value:>22.3f}")
+            else:
+                cells.append(f"{value:>22}")
+        lines.append("  ".join(cells))
+    return "\n".join(lines)
+
+
+def save_compressed(store: FAISS, path: str, index_path: str = "faiss_index") -> None:
+    store.save_local(path)
+    for name in (BM25_FILE, NEAR_DUPLICATES_FILE):
+        if os.path.exists(os.path.join(index_path, name)):
+            shutil.copyfile(os.path.join(index_path, name), os.path.join(path, name))
+
+
+if __name__ == "__main__":
+    from langchain_openai import AzureOpenAIEmbeddings
+    from config import config
+    from embedding_cache import get_cached_embeddings
+
+    parser = argparse.ArgumentParser(description="Compare compressed index backends against the exact index")
+    parser.add_argument("--index", default="faiss_index")
+    parser.add_argument("--backends", default="fp16,ivfpq", help="comma-separated, from " + ", ".join(BACKENDS))
+    parser.add_argument("--truncate-dims", default="", help="comma-separated Matryoshka dims, e.g. 1024,256")
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--pq-m", type=int, default=64)
+    parser.add_argument("--nprobe", type=int, default=16)
+    parser.add_argument("--report", default="index_recall_report.json")
+    parser.add_argument("--save", default=None, help="backend name from the report to save to <index>_compressed")
+    args = parser.parse_args()
+
+    embedding_model = get_cached_embeddings(AzureOpenAIEmbeddings(
+        deployment=config["embedding_models"]["text_embedding_3_large"],
+        model="text-embedding-3-large",
+        openai_api_key=config["azure_openai"]["api_key"],
+        azure_endpoint=config["azure_openai"]["endpoint"],
+        openai_api_version=config["azure_openai_4O"]["api_version"],
+    ), "text-embedding-3-large")
+    store = FAISS.load_local(args.index, embedding_model, allow_dangerous_deserialization=True)
+
+    dims = [None] + [int(d) for d in args.truncate_dims.split(",") if d]
+    vectors = store.index.reconstruct_n(0, store.index.ntotal)
+    candidates = {}
+    for backend in args.backends.split(","):
+        for dim in dims:
+            if backend == "flat" and dim is None:
+                continue
+            name = backend if dim is None else f"{backend}-d{dim}"
+            print(f"[Compress] Building {name}...")
+            candidates[name] = build_index(vectors, backend, metric=_metric(store.index), truncate_dim=dim,
+                                           nlist=args.nlist, pq_m=args.pq_m, nprobe=args.nprobe)
+
+    rows = recall_report(store, candidates)
+    print(format_recall_report(rows))
+    with open(args.report, "w", encoding="utf-8") as f:
+        json.dump(rows, f, indent=2)
+    print(f"[Compress] Report written to {args.report}")
+
+    if args.save:
+        # The chosen index with the exact store's docstore and id mapping, so retrieval.py works on it unchanged
+        compressed = FAISS(embedding_function=embedding_model, index=candidates[args.save], docstore=store.docstore,
+                           index_to_docstore_id=store.index_to_docstore_id, normalize_L2=store._normalize_L2)
+        save_compressed(compressed, args.index + "_compressed", args.index)
+        print(f"[Compress] Saved {args.save} to {args.index}_compressed")
@@ -19,5 +19,67 @@ config = {
     "azure_openai": {
         "api_key": os.environ.get("AZURE_OPENAI_API_KEY"),
         "endpoint": os.environ.get("AZURE_OPENAI_ENDPOINT")
+    },
+    # Concurrency and quota of the chat deployment (set RPM/TPM to the Azure deployment's limits)
+    "llm_limits": {
+        "max_concurrency": int(os.environ.get("LLM_MAX_CONCURRENCY", 8)),
+        "requests_per_minute": int(os.environ.get("LLM_REQUESTS_PER_MINUTE", 0)) or None,
+        "tokens_per_minute": int(os.environ.get("LLM_TOKENS_PER_MINUTE", 0)) or None
+    },
+    # Input-token budget per extraction/validation prompt (template + packed chunks)
+    "prompt_packing": {
+        "max_input_tokens": int(os.environ.get("PROMPT_MAX_INPUT_TOKENS", 16_000))
+    },
+    # Structure-aware note chunking (note_chunker.py); CHUNK_WORKERS > 1 chunks on a process pool
+    "chunking": {
+        "chunk_size": int(os.environ.get("CHUNK_SIZE", 1000)),
+        "overlap": int(os.environ.get("CHUNK_OVERLAP", 100)),
+        "workers": int(os.environ.get("CHUNK_WORKERS", os.cpu_count() or 1))
+    },
+    # MinHash near-duplicate collapsing before embedding and before prompt packing (NEAR_DEDUP=0 disables)
+    "near_dedup": {
+        "enabled": os.environ.get("NEAR_DEDUP", "1") != "0",
+        "threshold": float(os.environ.get("NEAR_DEDUP_THRESHOLD", 0.85))
+    },
+    # LLM_CACHE_MODE: use (default) / refresh (re-ask and overwrite) / bypass (no caching)
+    "llm_cache": {
+        "path": os.environ.get("LLM_CACHE_PATH", "llm_cache.sqlite"),
+        "max_entries": int(os.environ.get("LLM_CACHE_MAX_ENTRIES", 50_000)),
+        "mode": os.environ.get("LLM_CACHE_MODE", "use")
+    },
+    # Compressed index to search instead of the exact one (see compressed_index.py for the recall report)
+    "vector_index": {
+        "path": os.environ.get("VECTOR_INDEX_PATH") or None
+    },
+    # Per-run JSONL traces (node spans, LLM calls, embedding batches); prices are USD per 1K tokens
+    "tracing": {
+        "directory": os.environ.get("TRACE_DIR", "traces"),
+        "prices": {
+            "llm": {
+                "input": float(os.environ.get("LLM_PRICE_INPUT_PER_1K", 0.0025)),
+                "output": float(os.environ.get("LLM_PRICE_OUTPUT_PER_1K", 0.01))
+            },
+            "embedding": {
+                "input": float(os.environ.get("EMBEDDING_PRICE_PER_1K", 0.00013)),
+                "output": 0.0
+            }
+        }
+    },
+    # Result files: RESULT_FORMATS from jsonl/parquet (appended batch by batch); EXPORT_EXCEL=0 skips the .xlsx copy
+    "results": {
+        "formats": [f for f in os.environ.get("RESULT_FORMATS", "jsonl,parquet").split(",") if f],
+        "excel": os.environ.get("EXPORT_EXCEL", "1") != "0"
+    },
+    # CHECKPOINT_MODE: resume (default) / restart (drop checkpoints first) / off
+    "checkpoints": {
+        "path": os.environ.get("CHECKPOINT_PATH", "checkpoints.sqlite"),
+        "mode": os.environ.get("CHECKPOINT_MODE", "resume")
+    },
+    # Optional scope for retrieval over the sharded index (comma-separated lists, dates as YYYY-MM-DD)
+    "retrieval_scope": {
+        "patient_ids": [p for p in os.environ.get("RETRIEVAL_PATIENT_IDS", "").split(",") if p] or None,
+        "date_from": os.environ.get("RETRIEVAL_DATE_FROM") or None,
+        "date_to": os.environ.get("RETRIEVAL_DATE_TO") or None,
+        "note_types": [t.strip() for t in os.environ.get("RETRIEVAL_NOTE_TYPES", "").split(",") if t.strip()] or None
     }
 }
\ No newline at end of file
@@ -0,0 +1,128 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from typing import List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Persistent (model, sha256(text)) -> float32 vector store with LRU eviction."""
+
+    def __init__(self, path: str = "embedding_cache.sqlite", max_entries: int = 200_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " text_hash TEXT NOT NULL,"
+            " dim INTEGER NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, text_hash))"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used)")
+        self._conn.commit()
+
+    def get_many(self, model: str, hashes: List[str]) -> dict:
+        found = {}
+        now = time.time()
+        with self._lock:
+            # SQLite caps the number of bound parameters, so look up in slices
+            for i in range(0, len(hashes), 500):
+                part = hashes[i:i + 500]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                    [model, *part],
+                ).fetchall()
+                for h, blob in rows:
+                    found[h] = np.frombuffer(blob, dtype=np.float32)
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                        [(now, model, h) for h, _ in rows],
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, model: str, hashes: List[str], vectors) -> None:
+        now = time.time()
+        rows = []
+        for h, vec in zip(hashes, vectors):
+            arr = np.asarray(vec, dtype=np.float32)
+            rows.append((model, h, arr.shape[0], arr.tobytes(), now))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text_hash, dim, vector, last_used) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self) -> None:
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN "
+                "(SELECT rowid FROM embeddings ORDER BY last_used ASC LIMIT ?)",
+                (overflow,),
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings backend and only sends cache misses to it."""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache, model_name: str):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model_name = model_name
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [text_hash(t) for t in texts]
+        found = self.cache.get_many(self.model_name, list(set(hashes)))
+
+        # Embed each distinct missing text once, even if it repeats in the input
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in found and h not in missing:
+                missing[h] = t
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            miss_hashes = list(missing.keys())
+            new_vectors = self.embeddings.embed_documents([missing[h] for h in miss_hashes])
+            self.cache.put_many(self.model_name, miss_hashes, new_vectors)
+            for h, vec in zip(miss_hashes, new_vectors):
+                found[h] = np.asarray(vec, dtype=np.float32)
+
+        return [found[h].tolist() for h in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def get_cached_embeddings(embeddings: Embeddings, model_name: str, path: str = "embedding_cache.sqlite",
+                          max_entries: int = 200_000) -> CachedEmbeddings:
+    return CachedEmbeddings(embeddings, EmbeddingCache(path, max_entries=max_entries), model_name)
@@ -0,0 +1,127 @@
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional
+
+import numpy as np
+from tqdm import tqdm
+
+from embedding_cache import CachedEmbeddings, text_hash
+from token_counter import count_tokens
+from tracing import get_tracer
+
+
+class EmbeddingError(RuntimeError):
+    def __init__(self, failed_batches: List[int], errors: List[Exception]):
+        self.failed_batches = failed_batches
+        self.errors = errors
+        super().__init__(
+            f"{len(failed_batches)} embedding batch(es) failed after retries: "
+            f"{failed_batches[:10]} (first error: {errors[0]!r})"
+        )
+
+
+def pack_batches(texts: List[str], max_batch_tokens: int = 100_000, max_batch_items: int = 2048) -> List[List[int]]:
+    """Group text positions into request-sized batches by token budget (order preserving)."""
+    batches = []
+    current, current_tokens = [], 0
+    for i, text in enumerate(texts):
+        tokens = count_tokens(text)
+        if current and (current_tokens + tokens > max_batch_tokens or len(current) >= max_batch_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def _embed_with_retry(backend, texts: List[str], max_retries: int, base_delay: float,
+                      batch: int = 0, submitted: Optional[float] = None) -> List[List[float]]:
+    start = time.perf_counter()
+    # Time spent waiting for a free worker thread
+    queue_wait = start - submitted if submitted is not None else 0.0
+    tokens = sum(count_tokens(t) for t in texts)
+    for attempt in range(max_retries + 1):
+        try:
+            vectors = backend.embed_documents(texts)
+            get_tracer().record("embedding", "documents", batch=batch, items=len(texts), prompt_tokens=tokens,
+                                seconds=time.perf_counter() - start, queue_wait=queue_wait, retries=attempt,
+                                status="ok")
+            return vectors
+        except Exception as e:
+            if attempt == max_retries:
+                get_tracer().record("embedding", "documents", batch=batch, items=len(texts), prompt_tokens=tokens,
+                                    seconds=time.perf_counter() - start, queue_wait=queue_wait, retries=attempt,
+                                    status="failed", error=repr(e))
+                raise
+            delay = base_delay * (2 ** attempt) + random.uniform(0, base_delay)
+            print(f"[Embed] Batch of {len(texts)} failed ({e}); retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def embed_texts(texts: List[str], embedding_model, max_batch_tokens: int = 100_000, max_batch_items: int = 2048,
+                max_workers: int = 4, max_retries: int = 5, base_delay: float = 1.0) -> np.ndarray:
+    """Embed `texts` across documents in token-packed batches; returns one (n, dim) float32 array.
+
+    Raises EmbeddingError if any batch still fails after its retries, so no chunk is dropped silently.
+    """
+    if not texts:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    # Resolve cache hits first so that only misses are packed into requests
+    cached = {}
+    backend = embedding_model
+    if isinstance(embedding_model, CachedEmbeddings):
+        backend = embedding_model.embeddings
+        hashes = [text_hash(t) for t in texts]
+        cached = embedding_model.cache.get_many(embedding_model.model_name, list(set(hashes)))
+        pending = {}
+        for h, t in zip(hashes, texts):
+            if h not in cached and h not in pending:
+                pending[h] = t
+        todo_hashes = list(pending.keys())
+        todo_texts = [pending[h] for h in todo_hashes]
+        embedding_model.hits += len(texts) - len(todo_texts)
+        embedding_model.misses += len(todo_texts)
+        get_tracer().record("embedding", "cache_lookup", items=len(texts), cache_hits=len(texts) - len(todo_texts),
+                            cached=True, status="ok")
+    else:
+        todo_texts = list(texts)
+
+    batches = pack_batches(todo_texts, max_batch_tokens, max_batch_items)
+    print(f"[Embed] {len(texts)} texts, {len(todo_texts)} to embed in {len(batches)} batches")
+
+    results = [None] * len(todo_texts)
+    failed, errors = [], []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_embed_with_retry, backend, [todo_texts[i] for i in batch], max_retries, base_delay,
+                            n, time.perf_counter()): n
+            for n, batch in enumerate(batches)
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            n = futures[future]
+            try:
+                vectors = future.result()
+            except Exception as e:
+                print(f"[Embed] Batch {n} failed permanently: {e}")
+                failed.append(n)
+                errors.append(e)
+                continue
+            for i, vec in zip(batches[n], vectors):
+                results[i] = vec
+            if isinstance(embedding_model, CachedEmbeddings):
+                # Cache per batch so work already paid for survives a later failure
+                embedding_model.cache.put_many(embedding_model.model_name, [todo_hashes[i] for i in batches[n]], vectors)
+
+    if failed:
+        raise EmbeddingError(sorted(failed), errors)
+
+    if isinstance(embedding_model, CachedEmbeddings):
+        for h, vec in zip(todo_hashes, results):
+            cached[h] = vec
+        return np.ascontiguousarray(np.vstack([np.asarray(cached[h], dtype=np.float32) for h in hashes]))
+
+    return np.ascontiguousarray(np.asarray(results, dtype=np.float32))
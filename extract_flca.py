@@ -1,3 +1,5 @@
+import asyncio
+import functools
 from langchain_community.vectorstores import FAISS
 from langgraph.graph import StateGraph
 from typing import TypedDict, List, Dict, Any
@@ -5,33 +7,77 @@ import json
 from collections import defaultdict
 from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
 from config import config
-from util import batchify, parse_llm_json
+from util import parse_llm_json
+from faiss_store import load_bm25
+from mmap_store import MmapVectorStore, store_exists
+from sharded_index import open_scoped_index
+from retrieval import multi_query_search
+from llm_runner import LLMBatchError
+from llm_cache import get_cached_llm
+from prompt_packer import pack_prompt_batches, format_pack_stats
+from token_counter import count_tokens
+import rule_extractor
+import local_validator
+from rule_extractor import split_by_rules
+from local_validator import validate_records, VALID, INVALID, AMBIGUOUS
+from tracing import start_trace, traced_node
+from checkpoint_store import open_checkpoints, checkpoint_node, run_prompts_checkpointed, index_fingerprint, source_hash
+from near_dedup import load_provenance, duplicate_sources, dedup_items, merge_links
+from lab_postprocess import postprocess_labs, ResultWriter
+from offline_backends import offline_enabled, HashEmbeddings, offline_llm
 import pandas as pd
-from tqdm import tqdm
 class GraphState(TypedDict, total=False):
     retrieved_documents: List[Dict[str, Any]]
     extracted_labs: List[Dict[str, Any]]
     validated_data: List[Dict[str, Any]]
+    failed_batches: List[Dict[str, Any]]
+    near_duplicates: Dict[str, List[str]]
+    note_patients: Dict[str, str]
+    note_dates: Dict[str, str]
 
 
-embedding_model = AzureOpenAIEmbeddings(
-    deployment=config["embedding_models"]["text_embedding_3_large"],
-    model="text-embedding-3-large",
-    openai_api_key=config["azure_openai"]["api_key"],
-    azure_endpoint=config["azure_openai"]["endpoint"],
-    openai_api_version=config["azure_openai_4O"]["api_version"],
-)
+if offline_enabled():
+    embedding_model = HashEmbeddings()
+else:
+    embedding_model = AzureOpenAIEmbeddings(
+        deployment=config["embedding_models"]["text_embedding_3_large"],
+        model="text-embedding-3-large",
+        openai_api_key=config["azure_openai"]["api_key"],
+        azure_endpoint=config["azure_openai"]["endpoint"],
+        openai_api_version=config["azure_openai_4O"]["api_version"],
+    )
 
-faiss_index = FAISS.load_local("faiss_index", embedding_model, allow_dangerous_deserialization=True)
+# VECTOR_INDEX_PATH selects a compressed index saved by compressed_index.py (e.g. faiss_index_compressed).
+# Otherwise the exported store is mapped, not loaded: vectors are paged in on search, chunk text is read per hit
+if config["vector_index"]["path"]:
+    index_path = config["vector_index"]["path"]
+    faiss_index = FAISS.load_local(index_path, embedding_model, allow_dangerous_deserialization=True)
+elif store_exists("vector_store"):
+    index_path = "vector_store"
+    faiss_index = MmapVectorStore.load(index_path, embedding_model)
+else:
+    index_path = "faiss_index"
+    faiss_index = FAISS.load_local(index_path, embedding_model, allow_dangerous_deserialization=True)
+index_provenance = load_provenance(index_path)
+# Scoped runs (RETRIEVAL_PATIENT_IDS / _DATE_FROM / _DATE_TO / _NOTE_TYPES) search only matching shards;
+# a scope without shards to apply it to is an error, not an unfiltered search
+retrieval_scope = {key: value for key, value in config["retrieval_scope"].items() if value}
+sharded_index = open_scoped_index(retrieval_scope, embedding_model)
 
-llm = AzureChatOpenAI(
-    deployment_name=config["azure_openai_4O"]["deployment"],
-    api_key=config["azure_openai"]["api_key"],
-    api_version=config["azure_openai_4O"]["api_version"],
-    azure_endpoint=config["azure_openai"]["endpoint"],
-    temperature=0,
-    model=config["azure_openai_4O"]["model"]
-)
+if offline_enabled():
+    llm = offline_llm()
+else:
+    llm = AzureChatOpenAI(
+        deployment_name=config["azure_openai_4O"]["deployment"],
+        api_key=config["azure_openai"]["api_key"],
+        api_version=config["azure_openai_4O"]["api_version"],
+        azure_endpoint=config["azure_openai"]["endpoint"],
+        temperature=0,
+        model=config["azure_openai_4O"]["model"]
+    )
+LLM_MODEL = config["azure_openai_4O"]["model"] or "gpt-4o"
+# Unchanged prompts are answered from disk (LLM_CACHE_MODE=refresh/bypass to re-ask)
+llm = get_cached_llm(llm, **config["llm_cache"])
 
 
 def get_flca_extraction_prompt(context: List[Dict[str, str]]) -> str:
@@ -40,77 +86,155 @@ def get_flca_extraction_prompt(context: List[Dict[str, str]]) -> str:
     return template.format(context=json.dumps(context, indent=2))
 
 
-def retrieve_docs_agent(state: GraphState) -> GraphState:
-    print(f"[RetrieveDocs] Incoming state keys: {list(state.keys())}")
-    queries = ["lambda", "klc", "flc", "free light chain"]
-    all_results = []
+@functools.lru_cache(maxsize=None)
+def get_bm25_index():
+    # Parsed on first retrieval rather than at import, and not at all when RetrieveDocs is restored
+    return load_bm25(faiss_index, index_path)
 
-    for query in queries:
-        try:
-            docs = faiss_index.similarity_search(query, k=1000)
-            # Filter only relevant docs where query exists in content
-            filtered_docs = [doc for doc in docs if query.lower() in doc.page_content.lower()]
-            all_results.extend(filtered_docs)
-        except Exception as e:
-            print(f"[RetrieveDocs] Error retrieving for query '{query}': {e}")
 
-    unique_documents = set()
+@functools.lru_cache(maxsize=None)
+def retrieval_inputs() -> str:
+    # Retrieval reads the index, not the state: a changed corpus or scope must not reuse old results
+    return json.dumps({"index": index_fingerprint(faiss_index), "scope": retrieval_scope,
+                       "near_dedup": config["near_dedup"]}, sort_keys=True)
+
+
+@functools.lru_cache(maxsize=None)
+def extraction_inputs() -> str:
+    # The prompt template, the rule fast path and the packing budget shape the extracted records
+    return json.dumps({"sources": source_hash("prompts/flca_extraction.txt", rule_extractor.__file__),
+                       "packing": config["prompt_packing"]}, sort_keys=True)
+
+
+@functools.lru_cache(maxsize=None)
+def validation_inputs() -> str:
+    return json.dumps({"prompt": get_validation_prompt([]), "sources": source_hash(local_validator.__file__),
+                       "packing": config["prompt_packing"]}, sort_keys=True)
+
+
+@traced_node("RetrieveDocs")
+@checkpoint_node("RetrieveDocs", salt=retrieval_inputs)
+def retrieve_docs_agent(state: GraphState) -> GraphState:
+    print(f"[RetrieveDocs] Incoming state keys: {list(state.keys())}")
+    # Keyword matches start at a word, so the KFLC / LFLC abbreviations are queried on their own
+    queries = ["lambda", "klc", "flc", "kflc", "lflc", "free light chain"]
     final_documents = []
+    failed_batches = list(state.get("failed_batches", []))
+    # note title -> titles of other notes holding a near-duplicate copy of its retrieved text
+    index_links: Dict[str, List[str]] = {}
+    patient_ids = []
+    note_patients: Dict[str, str] = {}
+    note_dates: Dict[str, str] = {}
+
+    try:
+        # One embedding request + one FAISS search for all queries; hits are merged by chunk id
+        if sharded_index is not None:
+            hits = sharded_index.search(queries, vector_k=100, **retrieval_scope)
+        else:
+            hits = multi_query_search(faiss_index, get_bm25_index(), queries, vector_k=100)
+    except Exception as e:
+        print(f"[RetrieveDocs] Error retrieving for queries {queries}: {e}")
+        hits = []
+        failed_batches.append({"stage": "RetrieveDocs", "batch": 0, "error": repr(e)})
 
-    for doc in all_results:
-        source = doc.metadata.get("source", "unknown_source")
-        key = (source, doc.page_content.strip())
-        if key not in unique_documents:
-            unique_documents.add(key)
+    for doc, _ in hits:
+        # Filter only relevant docs where a query exists in content
+        content = doc.page_content.lower()
+        if any(query in content for query in queries):
             final_documents.append({
-                "title": source,
+                "title": doc.metadata.get("source", "unknown_source"),
                 "medical_notes": doc.page_content.strip()
             })
+            patient_ids.append(doc.metadata.get("patient_id"))
+            note_patients[final_documents[-1]["title"]] = doc.metadata.get("patient_id")
+            if doc.metadata.get("note_date"):
+                note_dates[final_documents[-1]["title"]] = doc.metadata["note_date"]
+            index_links.setdefault(final_documents[-1]["title"], []).extend(duplicate_sources(index_provenance, doc))
+
+    # Overlapping / copied-forward chunks are sent to the model once
+    prompt_links: Dict[str, List[str]] = {}
+    if config["near_dedup"]["enabled"]:
+        retrieved = len(final_documents)
+        final_documents, prompt_links = dedup_items(final_documents, "medical_notes", scopes=patient_ids,
+                                                    threshold=config["near_dedup"]["threshold"])
+        print(f"[RetrieveDocs] Collapsed {retrieved - len(final_documents)} near-duplicate chunks")
 
     print(f"[RetrieveDocs] Retrieved {len(final_documents)} unique documents.")
     new_state: GraphState = {
         **state,
-        "retrieved_documents": final_documents
+        "retrieved_documents": final_documents,
+        "near_duplicates": merge_links(index_links, prompt_links),
+        "note_patients": note_patients,
+        "note_dates": note_dates,
+        "failed_batches": failed_batches
     }
 
     return new_state
 
 
-def extract_lab_values_agent(state: GraphState) -> GraphState:
+async def run_llm_batches(prompts: List[str], stage: str, failed_batches: List[Dict[str, Any]]) -> List[Any]:
+    """Send prompts concurrently under the deployment quota; failed batches are appended to `failed_batches`.
+
+    Batches finished by an earlier (interrupted) run are restored from their checkpoints instead.
+    """
+    try:
+        return await run_prompts_checkpointed(llm, prompts, stage, model=LLM_MODEL, **config["llm_limits"])
+    except LLMBatchError as e:
+        print(f"[{stage}] {len(e.failed)} of {len(prompts)} batches failed after retries: {e.failed}")
+        failed_batches.extend(
+            {"stage": stage, "batch": i, "error": repr(err)} for i, err in zip(e.failed, e.errors)
+        )
+        return e.results
+
+
+@traced_node("ExtractLabs")
+@checkpoint_node("ExtractLabs", salt=extraction_inputs, llm=llm)
+async def extract_lab_values_agent(state: GraphState) -> GraphState:
     print("[ExtractLabs] Function entered")
     retrieved_documents = state.get("retrieved_documents", [])
-    extracted = []
+    failed_batches = list(state.get("failed_batches", []))
+
+    # Rule-based fast path first; only chunks it cannot fully resolve go to the LLM
+    rule_records, llm_documents = split_by_rules(retrieved_documents, note_dates=state.get("note_dates"))
+    print(f"[ExtractLabs] Rules resolved {len(retrieved_documents) - len(llm_documents)} of "
+          f"{len(retrieved_documents)} chunks; {len(llm_documents)} chunks go to the LLM")
+    extracted = list(rule_records)
 
-    # Ensure batchify is available in util.py
-    for batch in tqdm(batchify(retrieved_documents, 10)):
+    # Fill each prompt up to the token budget, keeping chunks of the same note together
+    batches, stats = pack_prompt_batches(
+        llm_documents, config["prompt_packing"]["max_input_tokens"],
+        overhead_tokens=count_tokens(get_flca_extraction_prompt([]), LLM_MODEL),
+        group_key=lambda doc: doc["title"], model=LLM_MODEL,
+    )
+    print(format_pack_stats("ExtractLabs", stats))
+    prompts = [get_flca_extraction_prompt(batch) for batch in batches]
+    responses = await run_llm_batches(prompts, "ExtractLabs", failed_batches)
+
+    for i, result in enumerate(responses):
+        if result is None:
+            continue
         try:
-            prompt = get_flca_extraction_prompt(batch)
-            result = llm.invoke(prompt)
             parsed = json.loads(parse_llm_json(result.content))
             if isinstance(parsed, list):
                 extracted.extend(parsed)
             else:
                 print(f"[ExtractLabs] Unexpected response format: {parsed}")
         except Exception as e:
-            print(f"[ExtractLabs] Extraction failed for batch: {e}")
+            print(f"[ExtractLabs] Could not parse response for batch {i}: {e}")
 
     updated_state: GraphState = {
         **state,
-        "extracted_labs": extracted
+        "extracted_labs": extracted,
+        "failed_batches": failed_batches
     }
 
-    print(f"[ExtractLabs] Returning {len(extracted)} extracted records.")
+    print(f"[ExtractLabs] Returning {len(extracted)} extracted records "
+          f"(rules: {len(rule_records)}, llm: {len(extracted) - len(rule_records)}).")
     return updated_state
 
 
-
-def validate_extraction_agent(state: GraphState) -> GraphState:
-    extracted_data = state.get("extracted_labs", [])
-    batches = list(batchify(extracted_data, 10))
-    validated = []
-
-    for batch in batches:
-        validation_prompt = f"""
+def get_validation_prompt(batch: List[Dict[str, Any]]) -> str:
+    return f"""
         You are a clinical validation assistant.
         
         Given a list of extracted records, validate each one by checking if all fields —
@@ -135,15 +259,44 @@ def validate_extraction_agent(state: GraphState) -> GraphState:
         Here is the data:
         {json.dumps(batch, indent=2)}
         """
+
+
+@traced_node("Validate")
+@checkpoint_node("Validate", salt=validation_inputs, llm=llm)
+async def validate_extraction_agent(state: GraphState) -> GraphState:
+    extracted_data = state.get("extracted_labs", [])
+    failed_batches = list(state.get("failed_batches", []))
+
+    # Literal checks (values/dates vs evidence, evidence vs source chunk) run locally;
+    # only records that are ambiguous on those checks go to the model
+    sources = defaultdict(str)
+    for doc in state.get("retrieved_documents", []):
+        sources[doc["title"]] += doc["medical_notes"] + "\n"
+    checked = validate_records(extracted_data, dict(sources), state.get("note_dates"))
+    validated = list(checked[VALID])
+    print(f"[Validate] Local checks: {len(checked[VALID])} valid, {len(checked[INVALID])} rejected, "
+          f"{len(checked[AMBIGUOUS])} sent to the LLM")
+
+    batches, stats = pack_prompt_batches(
+        checked[AMBIGUOUS], config["prompt_packing"]["max_input_tokens"],
+        overhead_tokens=count_tokens(get_validation_prompt([]), LLM_MODEL),
+        group_key=lambda record: record.get("title"), model=LLM_MODEL,
+    )
+    print(format_pack_stats("Validate", stats))
+    prompts = [get_validation_prompt(batch) for batch in batches]
+    responses = await run_llm_batches(prompts, "Validate", failed_batches)
+
+    for i, response in enumerate(responses):
+        if response is None:
+            continue
         try:
-            response = llm.invoke(validation_prompt)
             parsed = json.loads(parse_llm_json(response.content))
             if isinstance(parsed, list):
                 validated.extend(parsed)
         except Exception as e:
-            print(f"[Validate] Validation parsing error: {e}")
+            print(f"[Validate] Validation parsing error for batch {i}: {e}")
 
-    return {**state, "validated_data": validated}
+    return {**state, "validated_data": validated, "failed_batches": failed_batches}
 
 
 # Graph setup
@@ -163,9 +316,23 @@ print("[LangGraph] Graph compiled")
 app = graph
 
 if __name__ == "__main__":
-    result = app.invoke({})
+    tracer = start_trace(config["tracing"]["directory"], "extract_flca", prices=config["tracing"]["prices"])
+    open_checkpoints(**config["checkpoints"])
+    result = asyncio.run(app.ainvoke({}))
+    print(tracer.format_summary())
+    tracer.close()
+    if result.get("failed_batches"):
+        print(f"[LangGraph] {len(result['failed_batches'])} batches failed: {result['failed_batches']}")
     print(json.dumps(result['validated_data'], indent=2))
     df = pd.DataFrame(result['validated_data'])
+    if "title" in df:
+        df["patient_id"] = df["title"].map(result.get("note_patients", {}))
+        # Provenance: other notes the record's source text was also copied into
+        df["duplicate_sources"] = df["title"].map(lambda title: "\n".join(result["near_duplicates"].get(title, [])))
 
-    # Display the DataFrame
-    df.to_excel('flca.xlsx')
+    # Normalized values, one row per (patient, date, values); Excel is an optional final copy
+    writer = ResultWriter("flca", config["results"]["formats"])
+    writer.write(postprocess_labs(df))
+    writer.close()
+    if config["results"]["excel"]:
+        writer.export_excel('flca.xlsx')
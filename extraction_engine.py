@@ -0,0 +1,355 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from checkpoint_store import run_prompts_checkpointed
+from llm_runner import LLMBatchError
+from local_validator import validate_records, INVALID
+from near_dedup import dedup_items
+from prompt_packer import pack_prompt_batches, format_pack_stats
+from retrieval import multi_query_search
+from rule_extractor import extract_flc_rules
+from token_counter import count_tokens
+from util import parse_llm_json
+
+# Single-pass extraction for several field families: one retrieval over the union of every
+# schema's queries, one prompt per packed batch of chunks that fills all schemas applying to
+# each chunk, and the answer split back into one record list per schema.
+
+
+class FieldSchema:
+    """A field family the engine extracts.
+
+    `instructions` is the schema's fragment of the combined prompt, `record` maps each output
+    field to a short description, and `keywords` are the hints that decide which chunks the
+    schema applies to (and, unless `queries` is given, what is retrieved for it). `rules`
+    optionally resolves a chunk locally: (title, text, note_date) -> (records, resolved), where
+    note_date is the chunk's note_date metadata (or None); a resolved chunk is not sent to the
+    model for this schema. `validate` optionally checks the model's records against their chunks:
+    (records, {title: chunk text}, {title: note_date}) -> records per status, as validate_records
+    returns them; records it finds invalid are dropped.
+    """
+
+    def __init__(self, name: str, instructions: str, record: Dict[str, str], keywords: Sequence[str],
+                 queries: Optional[Sequence[str]] = None,
+                 rules: Optional[Callable[[str, str, Optional[str]], Tuple[List[Dict[str, Any]], bool]]] = None,
+                 validate: Optional[Callable[[List[Dict[str, Any]], Dict[str, str], Dict[str, Optional[str]]],
+                                             Dict[str, List[Dict[str, Any]]]]] = None):
+        self.name = name
+        self.instructions = instructions.strip()
+        self.record = record
+        self.keywords = list(keywords)
+        self.queries = list(queries or keywords)
+        self.rules = rules
+        self.validate = validate
+        self._pattern = re.compile(r"\b(?:" + "|".join(re.escape(k) for k in self.keywords) + r")\b", re.IGNORECASE)
+
+    def applies_to(self, text: str) -> bool:
+        return bool(self._pattern.search(text))
+
+    def clean(self, record: Dict[str, Any]) -> Dict[str, Any]:
+        """The record restricted to this schema's fields (plus title)."""
+        return {"title": record.get("title"), **{key: record.get(key) for key in self.record}}
+
+    def prompt_fragment(self) -> str:
+        example = json.dumps({"title": "<EXACTLY MATCH THE TITLE FIELD FROM THE INPUT>", **self.record}, indent=2)
+        return f"#### {self.name}\n{self.instructions}\nRecord format:\n{example}"
+
+
+SCHEMAS: Dict[str, FieldSchema] = {}
+
+
+def register_schema(schema: FieldSchema) -> FieldSchema:
+    SCHEMAS[schema.name] = schema
+    return schema
+
+
+register_schema(FieldSchema(
+    "flc",
+    """Kappa and lambda free light chains and their ratio. Alternate forms: KLC / Kappa light / Kappa FLC,
+LLC / Lambda light / Lambda FLC, K/L / kappa/lambda. One record per lab date; keep units as written.""",
+    {
+        "kappa_flc": "kappa free light chain value with unit, e.g. 1.35 mg/dL",
+        "lambda_flc": "lambda free light chain value with unit",
+        "kappa_lambda_ratio": "kappa/lambda ratio, may include < or >",
+        "date_of_lab": "YYYY-MM-DD; unknown parts as XX, e.g. 2021-06-XX",
+        "evidence_sentences_for_lab_values": ["sentences stating the values"],
+        "evidence_sentences_for_lab_date": ["sentences stating the date"],
+    },
+    keywords=["kappa", "lambda", "klc", "flc", "kflc", "lflc", "free light chain"],
+    rules=extract_flc_rules,
+    validate=validate_records,
+))
+
+register_schema(FieldSchema(
+    "m_spike",
+    """Serum M-spike (M-protein) results from SPEP / immunofixation. One record per lab date; skip mentions
+without a numeric value.""",
+    {
+        "m_spike": "M-spike value with unit, e.g. 0.3 g/dL",
+        "date_of_lab": "YYYY-MM-DD; unknown parts as XX",
+        "evidence_sentences": ["sentences stating the value and date"],
+    },
+    keywords=["m-spike", "m spike", "mspike", "m-protein", "m protein", "monoclonal protein", "spep"],
+    # The keywords tokenize to a bare "m", which would substring-match most of the vocabulary
+    queries=["spike", "mspike", "monoclonal", "paraprotein", "spep", "immunofixation"],
+))
+
+register_schema(FieldSchema(
+    "aml_sentences",
+    """Exact sentences (no summaries) from notes of AML patients, grouped by category: diagnosis, precedent
+disease (prior cancers or conditions with dates), performance status (ECOG/KPS), mutational status,
+treatment plans, hospitalization reasons, lab results, genetic mutations, admission/discharge or follow-up
+plans, general diagnostic summary. One record per note.""",
+    {
+        "aml_diagnosis_sentences": [],
+        "precedent_disease_sentences": [],
+        "performance_status_sentences": [],
+        "mutational_status_sentences": [],
+        "treatment_sentences": [],
+        "hospitalization_reason_sentences": [],
+        "lab_result_sentences": [],
+        "genetic_mutations_sentences": [],
+        "admission_discharge_plan_sentences": [],
+        "diagnosis_summary_sentences": [],
+    },
+    keywords=["aml", "acute myeloid", "ecog", "kps", "npm1", "tp53", "flt3", "idh1", "idh2", "nras", "dnmt3a",
+              "azacitidine", "venetoclax", "aza/ven"],
+    queries=["aml", "acute myeloid", "ecog", "kps", "npm1", "tp53", "flt3", "idh1", "idh2", "nras", "dnmt3a",
+             "azacitidine", "venetoclax"],
+))
+
+
+class ExtractionEngine:
+    """Runs every schema in `schemas` over one shared retrieval and one LLM pass.
+
+    Each retrieved chunk is tagged with the schemas whose keywords it contains; schema rules run
+    first, and only chunks with schemas left go to the model. A batch's prompt carries the
+    fragments of the schemas present in that batch only.
+    """
+
+    def __init__(self, llm, schemas: Sequence[FieldSchema], model: str = "gpt-4o",
+                 max_input_tokens: int = 16_000, llm_limits: Optional[Dict[str, Any]] = None,
+                 near_dedup_threshold: Optional[float] = 0.85):
+        self.llm = llm
+        self.schemas = {schema.name: schema for schema in schemas}
+        self.model = model
+        self.max_input_tokens = max_input_tokens
+        self.llm_limits = llm_limits or {}
+        self.near_dedup_threshold = near_dedup_threshold
+        self.failed_batches: List[Dict[str, Any]] = []
+        self.note_patients: Dict[str, Optional[str]] = {}
+        self.note_dates: Dict[str, Optional[str]] = {}
+
+    def queries(self) -> List[str]:
+        return list(dict.fromkeys(q for schema in self.schemas.values() for q in schema.queries))
+
+    def retrieve(self, store, bm25, vector_k: int = 100, sharded_index=None,
+                 scope: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """One hybrid search for the union of all schemas' queries; chunks no schema applies to are dropped."""
+        queries = self.queries()
+        if sharded_index is not None:
+            hits = sharded_index.search(queries, vector_k=vector_k, **(scope or {}))
+        else:
+            hits = multi_query_search(store, bm25, queries, vector_k=vector_k)
+        items, patient_ids = [], []
+        for doc, _ in hits:
+            applicable = [name for name, schema in self.schemas.items() if schema.applies_to(doc.page_content)]
+            if not applicable:
+                continue
+            title = doc.metadata.get("source", "unknown_source")
+            items.append({"title": title, "medical_notes": doc.page_content.strip(), "schemas": applicable})
+            patient_ids.append(doc.metadata.get("patient_id"))
+            self.note_patients[title] = doc.metadata.get("patient_id")
+            self.note_dates[title] = doc.metadata.get("note_date")
+        if self.near_dedup_threshold:
+            retrieved = len(items)
+            items, _ = dedup_items(items, "medical_notes", scopes=patient_ids, threshold=self.near_dedup_threshold)
+            print(f"[Engine] Collapsed {retrieved - len(items)} near-duplicate chunks")
+        print(f"[Engine] {len(items)} chunks for {len(queries)} queries across {len(self.schemas)} schemas")
+        return items
+
+    def apply_rules(self, items: List[Dict[str, Any]]) -> Tuple[Dict[str, List[dict]], List[Dict[str, Any]]]:
+        """Resolve what schema rules can locally; returns (records per schema, items still needing the model)."""
+        results: Dict[str, List[dict]] = {name: [] for name in self.schemas}
+        remaining = []
+        for item in items:
+            left = []
+            for name in item["schemas"]:
+                rules = self.schemas[name].rules
+                if rules is None:
+                    left.append(name)
+                    continue
+                records, resolved = rules(item["title"], item["medical_notes"], self.note_dates.get(item["title"]))
+                # Like split_by_rules: records of a chunk the rules cannot fully resolve come from the model
+                if resolved:
+                    results[name].extend(records)
+                else:
+                    left.append(name)
+            if left:
+                remaining.append({**item, "schemas": left})
+        return results, remaining
+
+    def build_prompt(self, batch: List[Dict[str, Any]]) -> str:
+        names = [name for name in self.schemas if any(name in item["schemas"] for item in batch)] or list(self.schemas)
+        fragments = "\n\n".join(self.schemas[name].prompt_fragment() for name in names)
+        response = json.dumps({name: ["<records>"] for name in names}, indent=2)
+        return (
+            "You are a clinical data extraction assistant.\n\n"
+            "Each item in the context is a chunk of a medical note with its \"title\", its \"medical_notes\" "
+            "text and the \"schemas\" that apply to it. For every item, fill only the schemas listed for it, "
+            "using only values explicitly stated in that item's text. Do not infer or guess; return an empty "
+            "list for a schema with nothing to extract.\n\n"
+            f"### Schemas\n\n{fragments}\n\n"
+            "### Response Format (Strict JSON)\n\n"
+            f"Return only one object with a list of records per schema:\n{response}\n\n"
+            f"### Context\n\n{json.dumps(batch, indent=2)}\n"
+        )
+
+    def split_response(self, content: str, batch: List[Dict[str, Any]]) -> Dict[str, List[dict]]:
+        """Records per schema from one response; raises ValueError for an answer that cannot be split.
+
+        Records whose title names no chunk of the batch are dropped: they cannot be traced to a note.
+        """
+        parsed = json.loads(parse_llm_json(content))
+        if isinstance(parsed, list):
+            # Single-schema answer as a bare list; with several schemas its records cannot be assigned
+            names = {name for item in batch for name in item["schemas"]}
+            if len(names) != 1:
+                raise ValueError(f"bare list of {len(parsed)} records for schemas {sorted(names)}")
+            parsed = {names.pop(): parsed}
+        if not isinstance(parsed, dict):
+            raise ValueError(f"expected an object of schema lists, got {type(parsed).__name__}")
+        titles = {item["title"] for item in batch}
+        results = {}
+        for name, records in parsed.items():
+            if name in self.schemas and isinstance(records, list):
+                results[name] = [self.schemas[name].clean(r) for r in records
+                                 if isinstance(r, dict) and r.get("title") in titles]
+        return results
+
+    async def extract(self, items: List[Dict[str, Any]], stage: str = "MultiExtract") -> Dict[str, List[dict]]:
+        results, remaining = self.apply_rules(items)
+        resolved = sum(len(records) for records in results.values())
+        print(f"[Engine] Rules produced {resolved} records; {len(remaining)} of {len(items)} chunks go to the LLM")
+
+        batches, stats = pack_prompt_batches(
+            remaining, self.max_input_tokens,
+            overhead_tokens=count_tokens(self.build_prompt([]), self.model),
+            group_key=lambda item: item["title"], model=self.model,
+        )
+        print(format_pack_stats(stage, stats))
+        prompts = [self.build_prompt(batch) for batch in batches]
+        try:
+            responses = await run_prompts_checkpointed(self.llm, prompts, stage, model=self.model, **self.llm_limits)
+        except LLMBatchError as e:
+            print(f"[{stage}] {len(e.failed)} of {len(prompts)} batches failed after retries: {e.failed}")
+            self.failed_batches.extend(
+                {"stage": stage, "batch": i, "error": repr(err)} for i, err in zip(e.failed, e.errors)
+            )
+            responses = e.results
+
+        answered: Dict[str, List[dict]] = {name: [] for name in self.schemas}
+        for i, (batch, response) in enumerate(zip(batches, responses)):
+            if response is None:
+                continue
+            try:
+                for name, records in self.split_response(response.content, batch).items():
+                    answered[name].extend(records)
+            except Exception as e:
+                print(f"[{stage}] Could not parse response for batch {i}: {e}")
+
+        sources: Dict[str, str] = {}
+        for item in remaining:
+            sources[item["title"]] = sources.get(item["title"], "") + item["medical_notes"] + "\n"
+        for name, records in answered.items():
+            validate = self.schemas[name].validate
+            if validate is not None and records:
+                checked = validate(records, sources, self.note_dates)
+                print(f"[{stage}] Dropped {len(checked[INVALID])} of {len(records)} {name} records "
+                      f"that failed local validation")
+                invalid = {id(record) for record in checked[INVALID]}
+                records = [record for record in records if id(record) not in invalid]
+            results[name].extend(records)
+
+        for records in results.values():
+            for record in records:
+                record.setdefault("patient_id", self.note_patients.get(record.get("title")))
+        print("[Engine] Records per schema: " + ", ".join(f"{name}={len(r)}" for name, r in results.items()))
+        return results
+
+
+if __name__ == "__main__":
+    import pandas as pd
+    from langchain_community.vectorstores import FAISS
+    from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
+    from config import config
+    from checkpoint_store import open_checkpoints
+    from faiss_store import load_bm25
+    from lab_postprocess import postprocess_labs, ResultWriter
+    from llm_cache import get_cached_llm
+    from mmap_store import MmapVectorStore, store_exists
+    from offline_backends import offline_enabled, HashEmbeddings, offline_llm
+    from sharded_index import open_scoped_index
+    from tracing import start_trace
+
+    parser = argparse.ArgumentParser(description="Extract several field schemas in one retrieval and LLM pass")
+    parser.add_argument("--schemas", default=",".join(SCHEMAS), help="comma-separated, from " + ", ".join(SCHEMAS))
+    parser.add_argument("--output", default="extraction_output")
+    parser.add_argument("--vector-k", type=int, default=100)
+    args = parser.parse_args()
+
+    if offline_enabled():
+        embedding_model = HashEmbeddings()
+        llm = offline_llm()
+    else:
+        embedding_model = AzureOpenAIEmbeddings(
+            deployment=config["embedding_models"]["text_embedding_3_large"],
+            model="text-embedding-3-large",
+            openai_api_key=config["azure_openai"]["api_key"],
+            azure_endpoint=config["azure_openai"]["endpoint"],
+            openai_api_version=config["azure_openai_4O"]["api_version"],
+        )
+        llm = AzureChatOpenAI(
+            deployment_name=config["azure_openai_4O"]["deployment"],
+            api_key=config["azure_openai"]["api_key"],
+            api_version=config["azure_openai_4O"]["api_version"],
+            azure_endpoint=config["azure_openai"]["endpoint"],
+            temperature=0,
+            model=config["azure_openai_4O"]["model"]
+        )
+    llm = get_cached_llm(llm, **config["llm_cache"])
+
+    index_path = config["vector_index"]["path"] or ("vector_store" if store_exists("vector_store") else "faiss_index")
+    if index_path == "vector_store":
+        store = MmapVectorStore.load(index_path, embedding_model)
+    else:
+        store = FAISS.load_local(index_path, embedding_model, allow_dangerous_deserialization=True)
+    bm25 = load_bm25(store, index_path)
+    scope = {key: value for key, value in config["retrieval_scope"].items() if value}
+    sharded = open_scoped_index(scope, embedding_model)
+
+    tracer = start_trace(config["tracing"]["directory"], "extraction_engine", prices=config["tracing"]["prices"])
+    open_checkpoints(**config["checkpoints"])
+    engine = ExtractionEngine(
+        llm, [SCHEMAS[name] for name in args.schemas.split(",") if name],
+        model=config["azure_openai_4O"]["model"] or "gpt-4o",
+        max_input_tokens=config["prompt_packing"]["max_input_tokens"],
+        llm_limits=config["llm_limits"],
+        near_dedup_threshold=config["near_dedup"]["threshold"] if config["near_dedup"]["enabled"] else None,
+    )
+    items = engine.retrieve(store, bm25, vector_k=args.vector_k, sharded_index=sharded, scope=scope)
+    results = asyncio.run(engine.extract(items))
+    print(tracer.format_summary())
+    tracer.close()
+
+    for name, records in results.items():
+        writer = ResultWriter(os.path.join(args.output, name), config["results"]["formats"])
+        # Lab values get the normalized columns and (patient, date, values) dedup
+        writer.write(postprocess_labs(records) if name == "flc" else pd.DataFrame(records))
+        writer.close()
+    if engine.failed_batches:
+        print(f"[Engine] {len(engine.failed_batches)} batches failed: {engine.failed_batches}")
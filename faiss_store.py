@@ -0,0 +1,115 @@
+import hashlib
+import os
+from typing import Iterable, List
+
+import faiss
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from bm25_index import BM25Index
+from embedding_pipeline import embed_texts
+from util import iter_batches
+
+
+def chunk_id(doc: Document) -> str:
+    # Content-addressed: the same chunk text from the same note always gets the same id
+    source = str(doc.metadata.get("source", ""))
+    return hashlib.sha256(f"{source}\x00{doc.page_content}".encode("utf-8")).hexdigest()
+
+
+def index_exists(index_path: str) -> bool:
+    return os.path.exists(os.path.join(index_path, "index.faiss"))
+
+
+def empty_index(embedding_model, dim: int) -> FAISS:
+    return FAISS(
+        embedding_function=embedding_model,
+        index=faiss.IndexFlatL2(dim),
+        docstore=InMemoryDocstore(),
+        index_to_docstore_id={},
+    )
+
+
+def bulk_add(store: FAISS, docs: List[Document], ids: List[str], vectors: np.ndarray) -> None:
+    """Add pre-computed vectors to `store` in one index call and one docstore update."""
+    if store._normalize_L2:
+        faiss.normalize_L2(vectors)
+    start = store.index.ntotal
+    store.index.add(vectors)
+    store.docstore.add({
+        doc_id: Document(id=doc_id, page_content=doc.page_content, metadata=doc.metadata)
+        for doc_id, doc in zip(ids, docs)
+    })
+    store.index_to_docstore_id.update({start + j: doc_id for j, doc_id in enumerate(ids)})
+
+
+def sync_index(chunks: Iterable[Document], embedding_model, index_path: str = "faiss_index",
+               window_size: int = 2000, **embed_kwargs) -> FAISS:
+    """Bring the saved index in line with `chunks`, embedding only chunks it does not hold yet.
+
+    `chunks` may be a generator; it is consumed `window_size` chunks at a time and each window
+    is embedded and added before the next one is read.
+    """
+    if index_exists(index_path):
+        index = FAISS.load_local(index_path, embedding_model, allow_dangerous_deserialization=True)
+        existing = set(index.index_to_docstore_id.values())
+        bm25 = load_bm25(index, index_path, writable=True)
+    else:
+        index = None
+        existing = set()
+        bm25 = BM25Index()
+
+    seen = set()
+    added = 0
+    for window in iter_batches(chunks, window_size):
+        fresh_ids, fresh_docs = [], []
+        for doc in window:
+            doc_id = chunk_id(doc)
+            if doc_id in seen:
+                continue
+            seen.add(doc_id)
+            if doc_id not in existing:
+                fresh_ids.append(doc_id)
+                fresh_docs.append(doc)
+        if not fresh_docs:
+            continue
+        vectors = embed_texts([d.page_content for d in fresh_docs], embedding_model, **embed_kwargs)
+        if index is None:
+            index = empty_index(embedding_model, vectors.shape[1])
+        bulk_add(index, fresh_docs, fresh_ids, vectors)
+        for doc_id, doc in zip(fresh_ids, fresh_docs):
+            bm25.add(doc_id, doc.page_content)
+        added += len(fresh_ids)
+
+    if index is None:
+        raise ValueError("No chunks to index")
+
+    # Chunks that were not in this input any more (edited or removed notes)
+    stale = [i for i in existing if i not in seen]
+    if stale:
+        for doc_id in stale:
+            bm25.remove(doc_id, index.docstore.search(doc_id).page_content)
+        index.delete(stale)
+
+    print(f"[Index] {added} added, {len(stale)} removed, {len(seen)} total chunks")
+    index.save_local(index_path)
+    bm25.save(index_path)
+    return index
+
+
+def load_bm25(index: FAISS, index_path: str = "faiss_index", writable: bool = False) -> BM25Index:
+    """Open the keyword index saved next to `index`, rebuilding (and saving) it from the docstore if
+    missing (e.g. an index saved with the older bm25.json). writable=True is for sync_index."""
+    if BM25Index.exists(index_path):
+        return BM25Index.load(index_path, writable=writable)
+    print("[Index] No keyword index found, building it from the docstore")
+    bm25 = BM25Index()
+    for doc_id in index.index_to_docstore_id.values():
+        bm25.add(doc_id, index.docstore.search(doc_id).page_content)
+    try:
+        bm25.save(index_path)
+    except OSError as e:
+        print(f"[Index] Could not save the rebuilt keyword index to {index_path}: {e}")
+    return bm25
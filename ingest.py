@@ -0,0 +1,31 @@
+import re
+from typing import Dict, Iterator, Optional, Tuple
+
+import pandas as pd
+
+
+# "ClinicalNoteId: ... PatientId: ... NoteDateTime: 2021-10-15 00:00:00.000 NoteType: Telephone Encounter NoteText: ..."
+_HEADER_FIELDS = {
+    "clinical_note_id": re.compile(r"ClinicalNoteId:\s*(\S+)"),
+    "patient_id": re.compile(r"(?<!Master)PatientId:\s*(\S+)"),
+    "note_date": re.compile(r"NoteDateTime:\s*(\d{4}-\d{2}-\d{2})"),
+    "note_type": re.compile(r"NoteType:\s*(.*?)\s*NoteText:", re.DOTALL),
+}
+
+
+def parse_note_header(text: str) -> Dict[str, Optional[str]]:
+    """Structured fields from the header every note starts with; missing fields are None."""
+    head = text[:1000]
+    fields = {}
+    for name, pattern in _HEADER_FIELDS.items():
+        match = pattern.search(head)
+        fields[name] = match.group(1).strip() if match else None
+    return fields
+
+
+def iter_notes(csv_path: str, rows_per_chunk: int = 1000) -> Iterator[Tuple[str, str]]:
+    """Yield (title, text) pairs from the EMR CSV, reading `rows_per_chunk` rows at a time."""
+    for frame in pd.read_csv(csv_path, usecols=["title", "text"], chunksize=rows_per_chunk):
+        frame = frame.dropna(subset=["text"])
+        for title, text in zip(frame["title"], frame["text"]):
+            yield title, text
@@ -0,0 +1,234 @@
+import json
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet output is skipped without pyarrow
+    pa = pq = None
+
+# Lab fields of the pipelines' records -> unit their values are normalized to (None: unitless)
+LAB_FIELDS = {"kappa_flc": "mg/L", "lambda_flc": "mg/L", "kappa_lambda_ratio": None}
+
+# Multiply a value in the key unit by the factor to get mg/L
+UNIT_FACTORS = {"mg/l": 1.0, "mg/dl": 10.0}
+
+_VALUE_PATTERN = (
+    r"(?P<comparator>[<>]=?|[≤≥])?\s*"
+    r"(?P<value>\d+(?:\.\d+)?|\.\d+)\s*"
+    r"(?P<unit>mg\s*/\s*d?l)?"
+)
+# No leading \b: the unit is often attached to the number ("06mg /dL")
+_UNIT = re.compile(r"(?<![A-Za-z])mg\s*/\s*d?l\b", re.IGNORECASE)
+
+# Where a record's value evidence lives (extract_flca / the engine, main.py)
+EVIDENCE_COLUMNS = ("evidence_sentences_for_lab_values", "evidence_sentences")
+
+# Excel's sheet limit; larger results are left to the JSONL/Parquet files
+EXCEL_MAX_ROWS = 1_048_575
+
+# Reported (raw) columns that are always written as text: the model returns them as strings or numbers
+TEXT_COLUMNS = [*LAB_FIELDS, "date_of_lab", "lab_date"]
+
+
+def split_lab_values(values: pd.Series) -> pd.DataFrame:
+    """Split strings like "<0.15 mg/dL" into comparator, numeric value and lower-cased unit columns."""
+    text = values.astype("string").str.replace(",", "", regex=False)
+    parts = text.str.extract(_VALUE_PATTERN, flags=re.IGNORECASE)
+    comparator = parts["comparator"].replace({"≤": "<=", "≥": ">="}).fillna("")
+    unit = parts["unit"].str.lower().str.replace(r"\s+", "", regex=True)
+    return pd.DataFrame({
+        "comparator": comparator,
+        "value": pd.to_numeric(parts["value"], errors="coerce"),
+        "unit": unit,
+    }, index=values.index)
+
+
+def evidence_units(evidence: pd.Series) -> pd.Series:
+    """The one unit named in each record's evidence sentences; NA when there is none or more than one."""
+    def unit_of(sentences) -> Optional[str]:
+        if isinstance(sentences, str):
+            sentences = [sentences]
+        if not isinstance(sentences, (list, tuple)):
+            return None
+        units = {re.sub(r"\s+", "", u.lower()) for s in sentences for u in _UNIT.findall(str(s))}
+        return units.pop() if len(units) == 1 else None
+
+    return evidence.map(unit_of).astype("string")
+
+
+def normalize_labs(df: pd.DataFrame, fields: Dict[str, Optional[str]] = LAB_FIELDS,
+                   date_col: str = "date_of_lab") -> pd.DataFrame:
+    """Add <field>_comparator / _raw_value / _raw_unit / _value / _unit columns and lab_date.
+
+    The reported strings are left as they are; _raw_value and _raw_unit are the number and unit
+    parsed from them, _value and _unit the value converted to each field's unit. A value without a
+    unit takes the unit its evidence sentences name; if they name none (or several), the converted
+    value and unit stay NA rather than guessing, since these notes report bare FLC values in mg/dL
+    and mg/L alike, while _raw_value keeps the number. lab_date is
+    ISO YYYY-MM-DD where the date parses, else the stripped text (partial dates like 2021-03-XX
+    stay as reported).
+    """
+    df = df.copy()
+    evidence = next((col for col in EVIDENCE_COLUMNS if col in df), None)
+    fallback = (evidence_units(df[evidence]) if evidence
+                else pd.Series(pd.NA, index=df.index, dtype="string"))
+    for field, target in fields.items():
+        if field not in df:
+            df[field] = None
+        parts = split_lab_values(df[field])
+        value = parts["value"]
+        unit = None
+        if target is not None:
+            known = parts["unit"].fillna(fallback)
+            factor = known.map(UNIT_FACTORS).astype(float) / UNIT_FACTORS[target.lower()]
+            value = (value * factor).round(6)
+            unit = pd.Series(target, index=df.index, dtype="string").where(value.notna())
+        df[f"{field}_comparator"] = parts["comparator"]
+        df[f"{field}_raw_value"] = parts["value"]
+        df[f"{field}_raw_unit"] = parts["unit"]
+        df[f"{field}_value"] = value
+        df[f"{field}_unit"] = unit
+    if date_col in df:
+        raw = df[date_col].astype("string").str.strip()
+        parsed = pd.to_datetime(raw, format="%Y-%m-%d", exact=False, errors="coerce")
+        df["lab_date"] = parsed.dt.strftime("%Y-%m-%d").where(parsed.notna(), raw)
+    else:
+        df["lab_date"] = None
+    return df
+
+
+def dedup_labs(df: pd.DataFrame, patient_col: Optional[str] = "patient_id",
+               fields: Iterable[str] = LAB_FIELDS, seen: Optional[set] = None) -> pd.DataFrame:
+    """Keep the first record per (patient, lab_date, normalized values) in one hashing pass.
+
+    Expects normalize_labs columns. A value whose unit is unknown (NA _value) is keyed on its raw
+    value and raw unit instead, so distinct bare values are not merged. `seen` carries the keys of
+    earlier batches, so a stream of batches is deduplicated as a whole; it is updated in place.
+    """
+    key = df[[c for c in [patient_col, "lab_date"] if c and c in df]].astype("string").fillna("")
+    for field in fields:
+        raw = ("raw:" + df[f"{field}_raw_value"].astype("string").fillna("") + " "
+               + df[f"{field}_raw_unit"].astype("string").fillna(""))
+        key[f"{field}_comparator"] = df[f"{field}_comparator"].astype("string").fillna("")
+        key[f"{field}_value"] = df[f"{field}_value"].astype("string").fillna(raw)
+    keys = pd.util.hash_pandas_object(key, index=False).to_numpy()
+    keys = pd.Series(keys)
+    keep = ~keys.duplicated()
+    if seen is not None:
+        keep &= ~keys.isin(seen)
+        seen.update(keys[keep].tolist())
+    keep = keep.to_numpy()
+    return df[keep]
+
+
+def postprocess_labs(records, fields: Dict[str, Optional[str]] = LAB_FIELDS, date_col: str = "date_of_lab",
+                     patient_col: Optional[str] = "patient_id", require: Sequence[str] = (),
+                     seen: Optional[set] = None) -> pd.DataFrame:
+    """normalize_labs + dedup_labs over a list of records (or a DataFrame).
+
+    Records without a parsed value for every field in `require` are dropped first; a value whose
+    unit is unknown counts (its _raw_value is set).
+    """
+    df = records if isinstance(records, pd.DataFrame) else pd.DataFrame(list(records))
+    if df.empty:
+        return df
+    df = normalize_labs(df, fields, date_col)
+    for field in require:
+        df = df[df[f"{field}_raw_value"].notna()]
+    return dedup_labs(df, patient_col, fields, seen)
+
+
+def _columnar(df: pd.DataFrame) -> pd.DataFrame:
+    """Lists (evidence sentences) joined by newlines and other objects as strings, so every batch has one schema.
+
+    Raw lab values, dates and evidence are strings even when a batch happens to hold only numbers.
+    """
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object or col in TEXT_COLUMNS or col.startswith("evidence_sentences"):
+            df[col] = df[col].map(
+                lambda v: "\n".join(map(str, v)) if isinstance(v, list)
+                else (json.dumps(v) if isinstance(v, dict) else (v if v is None or pd.isna(v) else str(v)))
+            ).astype("string")
+    return df
+
+
+class ResultWriter:
+    """Appends result batches to <prefix>.jsonl and/or <prefix>.parquet as they are produced.
+
+    The first batch fixes the Parquet schema (later batches are reindexed and cast to it); each
+    batch becomes one row group. Excel is only written on request by export_excel.
+    """
+
+    def __init__(self, prefix: str, formats: Sequence[str] = ("jsonl", "parquet")):
+        self.prefix = prefix
+        self.formats = list(formats)
+        if "parquet" in self.formats and pq is None:
+            print("[Results] pyarrow is not installed; writing JSONL instead of Parquet")
+            self.formats = [f for f in self.formats if f != "parquet"] or ["jsonl"]
+        os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+        self.rows = 0
+        # Files actually created: the Parquet file only appears with the first non-empty batch
+        self.paths: List[str] = []
+        self._jsonl = None
+        if "jsonl" in self.formats:
+            self._jsonl = open(prefix + ".jsonl", "w", encoding="utf-8")
+            self.paths.append(prefix + ".jsonl")
+        self._parquet = None
+        self._schema = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        if df.empty:
+            return
+        df = _columnar(df)
+        # Convert first: a batch that does not fit the Parquet schema is written to neither file
+        table = None
+        if "parquet" in self.formats:
+            if self._schema is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+            else:
+                table = pa.Table.from_pandas(df.reindex(columns=self._schema.names), schema=self._schema,
+                                             preserve_index=False)
+        if self._jsonl:
+            text = df.to_json(orient="records", lines=True, force_ascii=False)
+            self._jsonl.write(text if text.endswith("\n") else text + "\n")
+            self._jsonl.flush()
+        if table is not None:
+            if self._parquet is None:
+                self._schema = table.schema
+                self._parquet = pq.ParquetWriter(self.prefix + ".parquet", self._schema)
+                self.paths.append(self.prefix + ".parquet")
+            self._parquet.write_table(table)
+        self.rows += len(df)
+
+    def close(self) -> None:
+        if self._jsonl:
+            self._jsonl.close()
+            self._jsonl = None
+        if self._parquet:
+            self._parquet.close()
+            self._parquet = None
+        print(f"[Results] {self.rows} rows written to " + (", ".join(self.paths) or "no files"))
+
+    def read(self) -> pd.DataFrame:
+        if "parquet" in self.formats and os.path.exists(self.prefix + ".parquet"):
+            return pd.read_parquet(self.prefix + ".parquet")
+        if os.path.exists(self.prefix + ".jsonl") and os.path.getsize(self.prefix + ".jsonl"):
+            return pd.read_json(self.prefix + ".jsonl", lines=True, dtype=False)
+        return pd.DataFrame()
+
+    def export_excel(self, path: str, columns: Optional[List[str]] = None) -> bool:
+        """Final Excel copy of everything written (call after close); skipped past Excel's row limit."""
+        if self.rows > EXCEL_MAX_ROWS:
+            print(f"[Results] {self.rows} rows exceed Excel's limit; skipping {path}")
+            return False
+        df = self.read()
+        if columns:
+            df = df.reindex(columns=columns)
+        df.to_excel(path, index=False)
+        return True
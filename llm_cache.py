@@ -0,0 +1,122 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from langchain_core.messages import AIMessage
+
+# use: read and write the cache; refresh: ignore stored answers but store new ones; bypass: no caching
+CACHE_MODES = ("use", "refresh", "bypass")
+
+
+class LLMResponseCache:
+    """Disk-backed LRU cache of chat responses keyed by (deployment/model, temperature, prompt hash)."""
+
+    def __init__(self, path: str = "llm_cache.sqlite", max_entries: int = 50_000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            " key TEXT PRIMARY KEY,"
+            " content TEXT NOT NULL,"
+            " usage TEXT,"
+            " last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_used ON responses(last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(model: str, temperature, prompt: str) -> str:
+        prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return hashlib.sha256(f"{model}\x00{temperature}\x00{prompt_hash}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT content, usage FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._conn.commit()
+        return {"content": row[0], "usage": json.loads(row[1]) if row[1] else None}
+
+    def put(self, key: str, content: str, usage: Optional[dict] = None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, content, usage, last_used) VALUES (?, ?, ?, ?)",
+                (key, content, json.dumps(usage) if usage else None, time.time()),
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN "
+                    "(SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                    (count - self.max_entries,),
+                )
+            self._conn.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM responses")
+            self._conn.commit()
+
+
+class CachedChatModel:
+    """Drop-in wrapper around a LangChain chat model that answers repeated prompts from the cache."""
+
+    def __init__(self, llm, cache: LLMResponseCache, mode: str = "use"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown LLM cache mode '{mode}', expected one of {CACHE_MODES}")
+        self.llm = llm
+        self.cache = cache
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+        deployment = getattr(llm, "deployment_name", None) or ""
+        model = getattr(llm, "model_name", None) or ""
+        self.model_key = f"{deployment}/{model}"
+        self.temperature = getattr(llm, "temperature", None)
+
+    def key(self, prompt: str) -> str:
+        return LLMResponseCache.make_key(self.model_key, self.temperature, prompt)
+
+    def lookup(self, prompt: str) -> Optional[AIMessage]:
+        if self.mode != "use":
+            return None
+        entry = self.cache.get(self.key(prompt))
+        if entry is None:
+            return None
+        self.hits += 1
+        return AIMessage(content=entry["content"], response_metadata={"cached": True},
+                         usage_metadata=entry["usage"])
+
+    def _store(self, prompt: str, response) -> None:
+        self.misses += 1
+        if self.mode != "bypass":
+            self.cache.put(self.key(prompt), response.content, getattr(response, "usage_metadata", None))
+
+    def invoke(self, prompt: str, **kwargs):
+        cached = self.lookup(prompt)
+        if cached is not None:
+            return cached
+        response = self.llm.invoke(prompt, **kwargs)
+        self._store(prompt, response)
+        return response
+
+    async def ainvoke(self, prompt: str, **kwargs):
+        cached = self.lookup(prompt)
+        if cached is not None:
+            return cached
+        response = await self.llm.ainvoke(prompt, **kwargs)
+        self._store(prompt, response)
+        return response
+
+
+def get_cached_llm(llm, path: str = "llm_cache.sqlite", max_entries: int = 50_000, mode: str = "use"):
+    if mode == "bypass":
+        return llm
+    return CachedChatModel(llm, LLMResponseCache(path, max_entries=max_entries), mode=mode)
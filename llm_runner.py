@@ -0,0 +1,177 @@
+import asyncio
+import random
+import time
+from typing import Any, Callable, List, Optional, Sequence
+
+import openai
+
+from llm_cache import CachedChatModel
+from token_counter import count_tokens
+from tracing import get_tracer
+
+# Errors worth retrying: throttling, timeouts and transient server/network failures
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+
+class LLMBatchError(RuntimeError):
+    """Raised when some prompts still fail after retries; `results` holds the ones that succeeded."""
+
+    def __init__(self, failed: List[int], errors: List[Exception], results: list):
+        self.failed = failed
+        self.errors = errors
+        self.results = results
+        super().__init__(f"{len(failed)} LLM call(s) failed after retries: {failed[:10]} (first error: {errors[0]!r})")
+
+
+class RateLimiter:
+    """Token bucket over requests/minute and tokens/minute, refilled continuously.
+
+    Azure enforces quota over short windows, so each bucket holds at most 10 seconds' worth of
+    budget instead of allowing a full minute's burst up front. A prompt larger than the token
+    bucket waits for a full bucket and is then charged in full, leaving the bucket in debt that
+    later calls wait out, so the long-run rate never exceeds tokens_per_minute.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        self.rpm = requests_per_minute
+        self.tpm = tokens_per_minute
+        self._max_requests = max(1.0, (requests_per_minute or 0) / 6)
+        self._max_tokens = (tokens_per_minute or 0) / 6
+        self._requests = self._max_requests
+        self._tokens = self._max_tokens
+        self._last = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self._last
+        self._last = now
+        if self.rpm:
+            self._requests = min(self._max_requests, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self._max_tokens, self._tokens + elapsed * self.tpm / 60)
+
+    async def acquire(self, tokens: int) -> None:
+        # A single prompt larger than the bucket would otherwise wait forever: it only needs a full
+        # bucket, but is charged its whole estimate below
+        needed = min(tokens, self._max_tokens) if self.tpm else tokens
+        async with self._lock:
+            while True:
+                self._refill()
+                need_requests = 1 - self._requests if self.rpm else 0
+                need_tokens = needed - self._tokens if self.tpm else 0
+                if need_requests <= 0 and need_tokens <= 0:
+                    if self.rpm:
+                        self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return
+                wait = max(
+                    need_requests * 60 / self.rpm if self.rpm else 0,
+                    need_tokens * 60 / self.tpm if self.tpm else 0,
+                )
+                await asyncio.sleep(wait)
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _usage(response, prompt_tokens: int) -> dict:
+    usage = getattr(response, "usage_metadata", None) or {}
+    return {
+        "prompt_tokens": usage.get("input_tokens", prompt_tokens),
+        "completion_tokens": usage.get("output_tokens", 0),
+    }
+
+
+async def _invoke(llm, prompt: str, index: int, limiter: RateLimiter, semaphore: asyncio.Semaphore,
+                  est_tokens: int, max_retries: int, base_delay: float, stage: str = "LLM",
+                  prompt_tokens: int = 0, on_result: Optional[Callable[[int, Any], None]] = None):
+    tracer = get_tracer()
+    start = time.perf_counter()
+    # Cached answers skip the concurrency slot and the quota entirely
+    if isinstance(llm, CachedChatModel):
+        cached = llm.lookup(prompt)
+        if cached is not None:
+            tracer.record("llm", stage, batch=index, seconds=time.perf_counter() - start, queue_wait=0.0,
+                          retries=0, cached=True, status="ok", **_usage(cached, prompt_tokens))
+            if on_result:
+                on_result(index, cached)
+            return cached
+    queue_wait = backoff = 0.0
+    attempt = 0
+    try:
+        for attempt in range(max_retries + 1):
+            queued = time.perf_counter()
+            async with semaphore:
+                await limiter.acquire(est_tokens)
+                queue_wait += time.perf_counter() - queued
+                try:
+                    response = await llm.ainvoke(prompt)
+                    tracer.record("llm", stage, batch=index, seconds=time.perf_counter() - start,
+                                  queue_wait=queue_wait, backoff=backoff, retries=attempt,
+                                  cached=bool((getattr(response, "response_metadata", None) or {}).get("cached")),
+                                  status="ok", **_usage(response, prompt_tokens))
+                    if on_result:
+                        on_result(index, response)
+                    return response
+                except RETRYABLE_ERRORS as e:
+                    if attempt == max_retries:
+                        raise
+                    delay = _retry_after(e) or base_delay * (2 ** attempt) + random.uniform(0, base_delay)
+                    print(f"[LLM] Call {index} failed ({type(e).__name__}); retry {attempt + 1}/{max_retries} in {delay:.1f}s")
+            # Back off outside the semaphore so other calls can use the slot meanwhile
+            await asyncio.sleep(delay)
+            backoff += delay
+    except Exception as e:
+        tracer.record("llm", stage, batch=index, seconds=time.perf_counter() - start, queue_wait=queue_wait,
+                      backoff=backoff, retries=attempt, cached=False, status="failed", error=repr(e),
+                      prompt_tokens=prompt_tokens, completion_tokens=0)
+        raise
+
+
+async def run_prompts(llm, prompts: Sequence[str], max_concurrency: int = 8,
+                      requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None,
+                      completion_tokens: int = 1000, max_retries: int = 6, base_delay: float = 2.0,
+                      model: str = "gpt-4o", stage: str = "LLM",
+                      on_result: Optional[Callable[[int, Any], None]] = None) -> list:
+    """Run prompts concurrently under the deployment's quota; responses come back in input order.
+
+    Every call is recorded on the active tracer under `stage`; `on_result(index, response)` is
+    called as soon as each prompt succeeds. Raises LLMBatchError after all calls finish if any
+    prompt failed for good.
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    prompt_tokens = [count_tokens(prompt, model) for prompt in prompts]
+    tasks = [
+        _invoke(llm, prompt, i, limiter, semaphore, tokens + completion_tokens, max_retries, base_delay,
+                stage=stage, prompt_tokens=tokens, on_result=on_result)
+        for i, (prompt, tokens) in enumerate(zip(prompts, prompt_tokens))
+    ]
+    outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+
+    results, failed, errors = [], [], []
+    for i, outcome in enumerate(outcomes):
+        if isinstance(outcome, BaseException):
+            print(f"[LLM] Call {i} failed permanently: {outcome!r}")
+            failed.append(i)
+            errors.append(outcome)
+            results.append(None)
+        else:
+            results.append(outcome)
+    if failed:
+        raise LLMBatchError(failed, errors, results)
+    return results
@@ -0,0 +1,161 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from rule_extractor import DATE_FROM_EVIDENCE, note_date
+from util import normalize_text
+
+VALUE_FIELDS = ["kappa_flc", "lambda_flc", "kappa_lambda_ratio"]
+
+VALID, INVALID, AMBIGUOUS = "valid", "invalid", "ambiguous"
+
+_NUMBER = re.compile(r"([<>]?)\s?(\d+(?:\.\d+)?)")
+_MONTHS = {m: i for i, m in enumerate(
+    ["jan", "feb", "mar", "apr", "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"], start=1)}
+# Whole month names or their abbreviations, so "Marrow 2023" is not read as March
+_MONTH_NAME = (r"(Jan(?:uary)?|Feb(?:ruary)?|Mar(?:ch)?|Apr(?:il)?|May|June?|July?|Aug(?:ust)?"
+               r"|Sep(?:t(?:ember)?)?|Oct(?:ober)?|Nov(?:ember)?|Dec(?:ember)?)")
+
+_DATE_PATTERNS = [
+    # 2024-06-25
+    (re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b"), lambda m: (m[1], m[2], m[3])),
+    # 6/25/2024, 6/25/24
+    (re.compile(r"\b(\d{1,2})/(\d{1,2})/(\d{4}|\d{2})\b"), lambda m: (m[3], m[1], m[2])),
+    # 6/2021
+    (re.compile(r"\b(\d{1,2})/(\d{4})\b"), lambda m: (m[2], m[1], None)),
+    # June 25, 2024 / June 2024
+    (re.compile(rf"\b{_MONTH_NAME}\.?\s+(?:(\d{{1,2}}),?\s+)?(\d{{4}})\b", re.IGNORECASE),
+     lambda m: (m[3], _MONTHS[m[1][:3].lower()], m[2])),
+]
+
+
+def evidence_list(value: Any) -> List[str]:
+    """Evidence sentences as a list: the model sometimes returns one string instead of a list."""
+    if value is None:
+        return []
+    if isinstance(value, str):
+        return [value] if value.strip() else []
+    return [str(sentence) for sentence in value if sentence]
+
+
+def _numbers(text: str) -> List[Tuple[str, float]]:
+    return [(cmp, float(num)) for cmp, num in _NUMBER.findall(text.replace(",", ""))]
+
+
+def _parse_dates(text: str) -> List[Tuple[int, Optional[int], Optional[int]]]:
+    dates = []
+    for pattern, parts in _DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            year, month, day = parts(match)
+            if month is None:
+                continue
+            year = int(year)
+            if year < 100:
+                year += 2000
+            dates.append((year, int(month), int(day) if day else None))
+    return dates
+
+
+def _parse_lab_date(value: str) -> Optional[Tuple[int, Optional[int], Optional[int]]]:
+    # date_of_lab is YYYY-MM-DD with XX for unknown parts
+    match = re.fullmatch(r"(\d{4})-(\d{2}|XX)-(\d{2}|XX)", (value or "").strip(), flags=re.IGNORECASE)
+    if not match:
+        return None
+    year, month, day = match.groups()
+    return (int(year), None if month.upper() == "XX" else int(month), None if day.upper() == "XX" else int(day))
+
+
+def _dates_agree(lab, evidence) -> bool:
+    return all(a is None or b is None or a == b for a, b in zip(lab, evidence)) and lab[0] == evidence[0]
+
+
+def check_value(value: Any, evidence: str) -> str:
+    """The field's number (and comparator, if any) must literally appear in its evidence."""
+    if value is None or not str(value).strip() or str(value).strip().lower() in ("n/a", "na", "none", "null"):
+        return INVALID
+    wanted = _numbers(str(value))
+    if not wanted:
+        return AMBIGUOUS
+    cmp, number = wanted[0]
+    found = _numbers(evidence)
+    if (cmp, number) in found:
+        return VALID
+    if any(n == number for _, n in found):
+        # Same number, different comparator ("<0.15" vs "0.15"): let the model decide
+        return AMBIGUOUS
+    return INVALID
+
+
+def check_evidence_in_source(evidence: List[str], source_text: Optional[str]) -> str:
+    if source_text is None:
+        return AMBIGUOUS
+    source = normalize_text(source_text)
+    status = VALID
+    for sentence in evidence_list(evidence):
+        norm = normalize_text(sentence)
+        if not norm or norm in source:
+            continue
+        tokens = norm.split()
+        overlap = sum(1 for t in tokens if t in source) / len(tokens)
+        # Mostly-present sentences are usually light paraphrases; absent ones are made up
+        if overlap < 0.8:
+            return INVALID
+        status = AMBIGUOUS
+    return status
+
+
+def check_date(record: Dict[str, Any], date_evidence: str, noted: Optional[str]) -> str:
+    """date_of_lab must match a date in its evidence and must not be later than the note itself.
+
+    A record dated from the note's metadata or title (date_source, see rule_extractor.note_date) has
+    no date evidence; its date must be the note's date instead.
+    """
+    lab = _parse_lab_date(record.get("date_of_lab"))
+    if lab is None:
+        return INVALID if not record.get("date_of_lab") else AMBIGUOUS
+
+    if noted is not None:
+        # A lab result cannot post-date the note it is reported in
+        if (lab[0], lab[1] or 0, lab[2] or 0) > _parse_lab_date(noted):
+            return INVALID
+
+    if not date_evidence.strip() and record.get("date_source") not in (None, DATE_FROM_EVIDENCE):
+        if noted is None:
+            return AMBIGUOUS
+        return VALID if _dates_agree(lab, _parse_lab_date(noted)) else INVALID
+
+    evidence_dates = _parse_dates(date_evidence)
+    if not evidence_dates:
+        return AMBIGUOUS
+    return VALID if any(_dates_agree(lab, d) for d in evidence_dates) else INVALID
+
+
+def validate_record(record: Dict[str, Any], source_text: Optional[str] = None,
+                    metadata_date: Optional[str] = None) -> Tuple[str, List[str]]:
+    """Check one extracted record locally. Returns (valid|invalid|ambiguous, reasons)."""
+    value_sentences = evidence_list(record.get("evidence_sentences_for_lab_values"))
+    date_sentences = evidence_list(record.get("evidence_sentences_for_lab_date"))
+    value_evidence = " ".join(value_sentences)
+    date_evidence = " ".join(date_sentences)
+    checks = {field: check_value(record.get(field), value_evidence) for field in VALUE_FIELDS}
+    noted, _, _ = note_date(record.get("title", ""), source_text or "", metadata_date)
+    checks["date_of_lab"] = check_date(record, date_evidence, noted)
+    checks["evidence_in_source"] = check_evidence_in_source(value_sentences + date_sentences, source_text)
+    failed = [name for name, status in checks.items() if status == INVALID]
+    unsure = [name for name, status in checks.items() if status == AMBIGUOUS]
+    if failed:
+        return INVALID, failed
+    if unsure:
+        return AMBIGUOUS, unsure
+    return VALID, []
+
+
+def validate_records(records: List[Dict[str, Any]], sources: Dict[str, str],
+                     note_dates: Optional[Dict[str, str]] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """Split records into valid / invalid / ambiguous using the retrieved chunk text (and note_date
+    metadata) per title."""
+    result = {VALID: [], INVALID: [], AMBIGUOUS: []}
+    for record in records:
+        title = record.get("title")
+        status, _ = validate_record(record, sources.get(title), (note_dates or {}).get(title))
+        result[status].append(record)
+    return result
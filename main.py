@@ -1,26 +1,41 @@
 import os
+import asyncio
 import re
 import json
 import pandas as pd
 import configparser
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from langchain_core.documents import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
 from langchain_openai import AzureOpenAIEmbeddings, AzureChatOpenAI
+from embedding_cache import get_cached_embeddings
+from faiss_store import sync_index, load_bm25
+from sharded_index import publish_index
+from retrieval import hybrid_search
+from ingest import iter_notes
+from note_chunker import NoteChunker, chunk_notes
+from llm_runner import LLMBatchError
+from llm_cache import get_cached_llm
+from prompt_packer import pack_prompt_batches, format_pack_stats
+from token_counter import count_tokens
+from rule_extractor import split_by_rules
+from checkpoint_store import open_checkpoints, run_prompts_checkpointed
+from near_dedup import ChunkDeduplicator, load_provenance, duplicate_sources, dedup_items, merge_links
+from lab_postprocess import postprocess_labs, ResultWriter
+from offline_backends import offline_enabled, HashEmbeddings, offline_llm
+from tracing import start_trace
+from config import config as settings
 
-# Load config.ini
+# Load config.ini (Azure credentials); pipeline settings and their environment overrides come from
+# config.py, shared with extract_flca.py and extraction_engine.py
 config = configparser.ConfigParser()
 config.read("config.ini")
 
-# Azure credentials
-AZURE_OPENAI_API_KEY = config["azure_openai"]["api_key"]
-AZURE_OPENAI_ENDPOINT = config["azure_openai"]["endpoint"]
-AZURE_OPENAI_API_VERSION = config["azure_openai"]["api_version"]
-EMBEDDING_DEPLOYMENT = config["embedding_models"]["text_embedding_3_large"]
+# Azure credentials (not needed with OFFLINE_BACKENDS=1)
+AZURE_OPENAI_API_KEY = config.get("azure_openai", "api_key", fallback=None)
+AZURE_OPENAI_ENDPOINT = config.get("azure_openai", "endpoint", fallback=None)
+AZURE_OPENAI_API_VERSION = config.get("azure_openai", "api_version", fallback=None)
+EMBEDDING_DEPLOYMENT = config.get("embedding_models", "text_embedding_3_large", fallback=None)
 EMBEDDING_MODEL = "text-embedding-3-large"
-GPT_DEPLOYMENT = config["gpt_models"]["model_gpt4o"]
+GPT_DEPLOYMENT = config.get("gpt_models", "model_gpt4o", fallback=None)
 
 # Util functions
 def parse_llm_json(raw_text: str) -> str:
@@ -42,84 +57,115 @@ def normalize_text(text):
     text = re.sub(r'\s+', ' ', text).strip()
     return text
 
-# Load dataset
-csv_path = "d2c1f46e2b3267d315fb03f76724aa7036ea01b3f1803e94126e26dc26881629.csv"
-df = pd.read_csv(csv_path)
+# Per-call timings, token usage and cost of this run (embedding and LLM calls), like extract_flca.py
+tracer = start_trace(settings["tracing"]["directory"], "main", prices=settings["tracing"]["prices"])
 
-# Grouped chunks per document
-splitter = RecursiveCharacterTextSplitter(chunk_size=3000, chunk_overlap=500)
-grouped_batches = []
-for _, row in tqdm(df.iterrows(), total=len(df)):
-    if pd.isna(row["text"]):
-        continue
-    source = row["title"]
-    chunks = splitter.split_text(row["text"])
-    doc_chunks = [Document(page_content=chunk, metadata={"source": source}) for chunk in chunks]
-    if doc_chunks:
-        grouped_batches.append(doc_chunks)
-
-# Embedding model
-embedding_model = AzureOpenAIEmbeddings(
-    deployment=EMBEDDING_DEPLOYMENT,
-    model=EMBEDDING_MODEL,
-    openai_api_key=AZURE_OPENAI_API_KEY,
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    openai_api_version=AZURE_OPENAI_API_VERSION,
-    chunk_size=1000
-)
-
-# Build FAISS index
-def build_faiss(batch):
-    return FAISS.from_documents(batch, embedding_model)
+# Stream dataset -> chunks
+csv_path = os.environ.get("EMR_CSV_PATH", "d2c1f46e2b3267d315fb03f76724aa7036ea01b3f1803e94126e26dc26881629.csv")
+# Same chunking as vectorize_patient_emr.py: both scripts sync the one faiss_index
+chunker = NoteChunker(settings["chunking"]["chunk_size"], settings["chunking"]["overlap"])
+chunks = chunk_notes(tqdm(iter_notes(csv_path, rows_per_chunk=1000)), chunker,
+                     workers=settings["chunking"]["workers"])
+# Near-duplicate chunks (copied-forward text) are embedded once per patient
+near_dedup = settings["near_dedup"]["enabled"]
+near_dedup_threshold = settings["near_dedup"]["threshold"]
+deduplicator = ChunkDeduplicator(near_dedup_threshold) if near_dedup else None
+if deduplicator:
+    chunks = deduplicator.filter(chunks)
 
-sub_indexes = []
-with ThreadPoolExecutor(max_workers=4) as executor:
-    futures = {executor.submit(build_faiss, batch): batch for batch in grouped_batches}
-    for future in tqdm(as_completed(futures), total=len(futures)):
-        try:
-            sub_indexes.append(future.result())
-        except Exception as e:
-            print(f"Batch failed: {e}")
+# Embedding model (OFFLINE_BACKENDS=1: local hash embeddings and rule-based LLM, for benchmarks)
+if offline_enabled():
+    embedding_model = get_cached_embeddings(HashEmbeddings(), HashEmbeddings.model_name)
+else:
+    azure_embeddings = AzureOpenAIEmbeddings(
+        deployment=EMBEDDING_DEPLOYMENT,
+        model=EMBEDDING_MODEL,
+        openai_api_key=AZURE_OPENAI_API_KEY,
+        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+        openai_api_version=AZURE_OPENAI_API_VERSION,
+        chunk_size=1000
+    )
+    embedding_model = get_cached_embeddings(azure_embeddings, EMBEDDING_MODEL)
 
-main_index = sub_indexes[0]
-for sub_index in sub_indexes[1:]:
-    main_index.merge_from(sub_index)
-main_index.save_local("faiss_index")
+# Sync FAISS index (only new/changed chunks are embedded)
+vectorstore = sync_index(chunks, embedding_model, "faiss_index", window_size=2000)
+if deduplicator:
+    print(deduplicator.stats())
+    deduplicator.save("faiss_index")
+# extract_flca.py reads vector_store/ and the shards; keep them in line with the index just synced
+publish_index(vectorstore, "faiss_index", "vector_store", "sharded_index")
+index_provenance = load_provenance("faiss_index")
 
 # Vector DB Search
-vectorstore = FAISS.load_local("faiss_index", embeddings=embedding_model, allow_dangerous_deserialization=True)
 query = "Extract the patient's kappa free light chain (mg/L), lambda free light chain (mg/L), and kappa/lambda ratio, along with the lab date and evidence."
-results = vectorstore.similarity_search(query, k=1000)
+bm25 = load_bm25(vectorstore, "faiss_index")
+results = hybrid_search(vectorstore, bm25, query, keywords="kappa lambda ratio", vector_k=100)
 
 # Filter matching content
 filtered_chunks = []
+patient_ids = []
+note_patients = {}
+note_dates = {}
+index_links = {}
 for doc in results:
     norm_text = normalize_text(doc.page_content)
     source_title = doc.metadata.get("source", "Unknown")
     if source_title != "Unknown" and ('kappa' in norm_text or 'lambda' in norm_text or 'ratio' in norm_text):
         filtered_chunks.append({"title": source_title, "content": doc.page_content})
+        patient_ids.append(doc.metadata.get("patient_id"))
+        note_patients[source_title] = doc.metadata.get("patient_id")
+        if doc.metadata.get("note_date"):
+            note_dates[source_title] = doc.metadata["note_date"]
+        index_links.setdefault(source_title, []).extend(duplicate_sources(index_provenance, doc))
 
-# Regroup filtered chunks per doc
+# Overlapping / copied-forward chunks go into the prompts once; the notes they came from are kept
+prompt_links = {}
+if near_dedup:
+    retrieved = len(filtered_chunks)
+    filtered_chunks, prompt_links = dedup_items(filtered_chunks, "content", scopes=patient_ids,
+                                                threshold=near_dedup_threshold)
+    print(f"🧹 Collapsed {retrieved - len(filtered_chunks)} near-duplicate chunks")
+near_duplicates = merge_links(index_links, prompt_links)
+
+# Rule-based fast path: routine lab-table lines are extracted locally, the rest goes to the LLM
+rule_records, llm_chunks = split_by_rules(filtered_chunks, text_key="content", note_dates=note_dates)
+rule_results = []
+for record in rule_records:
+    item = {
+        "kappa_flc": record["kappa_flc"],
+        "lambda_flc": record["lambda_flc"],
+        "kappa_lambda_ratio": record["kappa_lambda_ratio"],
+        "date_of_lab": record["date_of_lab"],
+        "evidence_sentences": record["evidence_sentences_for_lab_values"] + record["evidence_sentences_for_lab_date"],
+    }
+    item["source_document"] = record["title"]
+    item["context"] = json.dumps(item, indent=2)
+    rule_results.append(item)
+print(f"⚡ Rules resolved {len(filtered_chunks) - len(llm_chunks)} of {len(filtered_chunks)} chunks "
+      f"({len(rule_results)} records); {len(llm_chunks)} chunks go to the LLM")
+
+# Regroup remaining chunks per doc
 grouped_filtered = {}
-for chunk in filtered_chunks:
+for chunk in llm_chunks:
     grouped_filtered.setdefault(chunk["title"], []).append(chunk["content"])
 
 # Setup LLM
-llm = AzureChatOpenAI(
-    deployment_name=GPT_DEPLOYMENT,
-    model_name="gpt-4o",
-    openai_api_key=AZURE_OPENAI_API_KEY,
-    azure_endpoint=AZURE_OPENAI_ENDPOINT,
-    openai_api_version=AZURE_OPENAI_API_VERSION,
-    temperature=0
-)
+if offline_enabled():
+    llm = offline_llm()
+else:
+    llm = AzureChatOpenAI(
+        deployment_name=GPT_DEPLOYMENT,
+        model_name="gpt-4o",
+        openai_api_key=AZURE_OPENAI_API_KEY,
+        azure_endpoint=AZURE_OPENAI_ENDPOINT,
+        openai_api_version=AZURE_OPENAI_API_VERSION,
+        temperature=0
+    )
+llm = get_cached_llm(llm, **settings["llm_cache"])
 
-# Run LLM
-final_results = []
-for i, (doc_title, chunks) in enumerate(grouped_filtered.items()):
-    json_context = [{"note_id": j + 1, "title": doc_title, "content": chunk} for j, chunk in enumerate(chunks)]
-
-    full_prompt = f"""
+# Prompt template (chunks of one or more documents per prompt, each labelled with its title)
+def build_prompt(json_context):
+    return f"""
 You are a medical information extraction assistant. Your task is to extract lab results from clinical notes.
 
 Your goal is to extract the following values, **only from the given document context**, and **strictly ignore or skip the document** if:
@@ -127,6 +173,10 @@ Your goal is to extract the following values, **only from the given document con
 - The values appear to be duplicated from a different unrelated document.
 - The document contains no lab results.
 
+The context may hold chunks of several documents; each chunk carries its document's "title". Treat every
+document on its own: the constraints below apply per document, and every record names the one document
+its values come from.
+
 Extract these fields only if they are clearly present in the current context:
 - ✅ **Kappa free light chains** (must have numeric value and unit, e.g., 1.35 mg/dL, <0.15 mg/dL)
 - ✅ **Lambda free light chains** (must have numeric value and unit)
@@ -149,6 +199,7 @@ Extract these fields only if they are clearly present in the current context:
 Respond in strict JSON format like this:
 [
   {{
+    "title": "<EXACTLY MATCH THE TITLE OF THE CHUNK THE VALUES COME FROM>",
     "kappa_flc": "...",
     "lambda_flc": "...",
     "kappa_lambda_ratio": "...",
@@ -161,40 +212,87 @@ Respond in strict JSON format like this:
 {json.dumps(json_context, indent=2)}
 """
 
+
+# Build prompts: chunks are packed up to the input-token budget, keeping each document's chunks
+# together where they fit; short documents share a prompt and long ones are split over several
+max_input_tokens = settings["prompt_packing"]["max_input_tokens"]
+all_context = [
+    {"note_id": j + 1, "title": doc_title, "content": chunk}
+    for doc_title, chunks in grouped_filtered.items()
+    for j, chunk in enumerate(chunks)
+]
+context_batches, pack_stats = pack_prompt_batches(
+    all_context, max_input_tokens, overhead_tokens=count_tokens(build_prompt([]), "gpt-4o"),
+    group_key=lambda item: item["title"], model="gpt-4o",
+)
+print(format_pack_stats("Packer", pack_stats))
+prompts = [build_prompt(batch) for batch in context_batches]
+prompt_titles = [list(dict.fromkeys(item["title"] for item in batch)) for batch in context_batches]
+
+# Run LLM: concurrent, rate-limited, responses returned in input order. Each finished batch is
+# checkpointed, so a rerun after a crash only sends the batches that never completed.
+open_checkpoints(**settings["checkpoints"])
+print(f"🧠 Running {len(prompts)} batches...")
+try:
+    responses = asyncio.run(run_prompts_checkpointed(
+        llm, prompts, "LLM", model="gpt-4o", **settings["llm_limits"]
+    ))
+except LLMBatchError as e:
+    print(f"❌ {len(e.failed)} batches failed after retries: {[prompt_titles[i] for i in e.failed]}")
+    responses = e.results
+
+# Save: records are normalized (comparator / value / unit, mg/dL -> mg/L), deduplicated by
+# (patient, date, values) and appended to JSONL/Parquet batch by batch; Excel is a final copy
+output_dir = os.environ.get("MAIN_OUTPUT_DIR", r"C:\Users\HariharaM12\PycharmProjects\Task2")
+writer = ResultWriter(os.path.join(output_dir, "Output2"), settings["results"]["formats"])
+seen_results = set()
+result_columns = ["source_document", "patient_id", "duplicate_sources", "kappa_flc", "lambda_flc",
+                  "kappa_lambda_ratio", "date_of_lab", "evidence_sentences", "context"]
+
+
+def write_results(records):
+    for row in records:
+        row["patient_id"] = note_patients.get(row["source_document"])
+        row["duplicate_sources"] = "\n".join(near_duplicates.get(row["source_document"], []))
+    writer.write(postprocess_labs(pd.DataFrame(records, columns=result_columns), seen=seen_results))
+
+
+write_results(rule_results)
+llm_records = 0
+unattributed = 0
+for i, (doc_titles, response) in enumerate(zip(prompt_titles, responses)):
+    if response is None:
+        continue
     try:
-        print(f"🧠 Running batch {i+1}/{len(grouped_filtered)}...")
-        response = llm.invoke(full_prompt)
         cleaned = parse_llm_json(response.content)
         batch_result = json.loads(cleaned)
 
+        attributed = []
         for item in batch_result:
-            item["source_document"] = doc_title
+            title = item.pop("title", None)
+            if title not in doc_titles:
+                # A record naming no document of its batch is only kept when the batch had one
+                if len(doc_titles) > 1:
+                    unattributed += 1
+                    continue
+                title = doc_titles[0]
+            item["source_document"] = title
             item["context"] = json.dumps(item, indent=2)
-        final_results.extend(batch_result)
+            attributed.append(item)
+        write_results(attributed)
+        llm_records += len(attributed)
     except Exception as e:
-        print(f"❌ Failed batch {i+1}: {e}")
-
-# Format & Save
-for row in final_results:
-    if isinstance(row.get("evidence_sentences"), list):
-        row["evidence_sentences"] = "\n".join(row["evidence_sentences"])
-
-df = pd.DataFrame(final_results)
-df = df[["source_document", "kappa_flc", "lambda_flc", "kappa_lambda_ratio", "date_of_lab", "evidence_sentences", "context"]]
-df.drop_duplicates(
-    subset=["kappa_flc", "lambda_flc", "kappa_lambda_ratio"],
-    inplace=True
-)
-
-# Save Excel & JSON
-output_dir = r"C:\Users\HariharaM12\PycharmProjects\Task2"
-os.makedirs(output_dir, exist_ok=True)
-
-excel_path = os.path.join(output_dir, "Output2.xlsx")
-json_path = os.path.join(output_dir, "Output2.json")
+        print(f"❌ Could not parse batch {i+1}: {e}")
 
-df.to_excel(excel_path, index=False)
-df.to_json(json_path, orient="records", indent=2)
+if unattributed:
+    print(f"⚠️ Dropped {unattributed} LLM records that named no document of their batch")
+print(f"📊 Records by path: rules={len(rule_results)}, llm={llm_records}")
+writer.close()
+print(tracer.format_summary())
+tracer.close()
 
-print(f"\n✅ Excel saved: {excel_path}")
-print(f"✅ JSON saved: {json_path}")
+if settings["results"]["excel"]:
+    excel_path = os.path.join(output_dir, "Output2.xlsx")
+    if writer.export_excel(excel_path):
+        print(f"\n✅ Excel saved: {excel_path}")
+print("✅ Results saved: " + ", ".join(writer.paths))
@@ -0,0 +1,253 @@
+import json
+import os
+import shutil
+import sqlite3
+import threading
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from bm25_index import BM25_FILE
+from near_dedup import NEAR_DUPLICATES_FILE
+
+# On-disk layout of a store folder:
+#   meta.json     dim, count, metric
+#   vectors.f32   raw float32 matrix (count x dim), opened with np.memmap
+#   norms.f32     squared L2 norm per row (only needed for the l2 metric)
+#   chunks.sqlite pos -> chunk_id, source, patient_id, note_date, note_type, metadata, text
+#   bm25.sqlite   keyword index (same chunk ids), opened read-only and memory-mapped
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.f32"
+NORMS_FILE = "norms.f32"
+CHUNKS_FILE = "chunks.sqlite"
+
+
+def export_store(store: FAISS, path: str = "vector_store", index_path: Optional[str] = "faiss_index",
+                 block_rows: int = 100_000, positions: Optional[Sequence[int]] = None) -> None:
+    """Write a LangChain FAISS store (flat index) into the memory-mappable folder format.
+
+    `positions` exports only those rows of the FAISS index (used for shards). Files are written
+    next to the old ones and swapped in with os.replace, so processes that already have the
+    store open keep reading the previous version.
+    """
+    os.makedirs(path, exist_ok=True)
+    if positions is None:
+        positions = range(store.index.ntotal)
+    positions = np.asarray(positions, dtype=np.int64)
+    n, dim = len(positions), store.index.d
+    metric = "ip" if store.index.metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+
+    with open(os.path.join(path, VECTORS_FILE + ".tmp"), "wb") as vf, \
+            open(os.path.join(path, NORMS_FILE + ".tmp"), "wb") as nf:
+        for start in range(0, n, block_rows):
+            block = store.index.reconstruct_batch(positions[start:start + block_rows]).astype(np.float32)
+            vf.write(block.tobytes())
+            nf.write((block * block).sum(axis=1).astype(np.float32).tobytes())
+
+    db_tmp = os.path.join(path, CHUNKS_FILE + ".tmp")
+    if os.path.exists(db_tmp):
+        os.remove(db_tmp)
+    conn = sqlite3.connect(db_tmp)
+    conn.execute(
+        "CREATE TABLE chunks (pos INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL UNIQUE, source TEXT,"
+        " patient_id TEXT, note_date TEXT, note_type TEXT, metadata TEXT, text TEXT NOT NULL)"
+    )
+    rows = []
+    for pos, index_pos in enumerate(positions):
+        chunk_id = store.index_to_docstore_id[int(index_pos)]
+        doc = store.docstore.search(chunk_id)
+        meta = doc.metadata
+        rows.append((pos, chunk_id, str(meta.get("source", "")), meta.get("patient_id"), meta.get("note_date"),
+                     meta.get("note_type"), json.dumps(meta), doc.page_content))
+        if len(rows) >= 10_000:
+            conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            rows = []
+    conn.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.execute("CREATE INDEX idx_chunks_date ON chunks(note_date)")
+    conn.commit()
+    conn.close()
+
+    with open(os.path.join(path, META_FILE + ".tmp"), "w", encoding="utf-8") as f:
+        json.dump({"dim": dim, "count": n, "metric": metric}, f)
+
+    for name in (VECTORS_FILE, NORMS_FILE, CHUNKS_FILE, META_FILE):
+        os.replace(os.path.join(path, name + ".tmp"), os.path.join(path, name))
+    for name in (BM25_FILE, NEAR_DUPLICATES_FILE):
+        if index_path and os.path.exists(os.path.join(index_path, name)):
+            shutil.copyfile(os.path.join(index_path, name), os.path.join(path, name))
+    print(f"[Store] Exported {n} vectors ({dim}-dim, {metric}) to {path}")
+
+
+def store_exists(path: str = "vector_store") -> bool:
+    return os.path.exists(os.path.join(path, META_FILE))
+
+
+class _ChunkDB:
+    def __init__(self, db_path: str):
+        self._conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False)
+        self._lock = threading.Lock()
+
+    def query(self, sql: str, params=()) -> list:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+
+class LazyDocstore:
+    """Docstore that reads a chunk's text from SQLite only when it is asked for."""
+
+    def __init__(self, db: _ChunkDB):
+        self._db = db
+
+    def search(self, chunk_id: str):
+        rows = self._db.query("SELECT metadata, text FROM chunks WHERE chunk_id = ?", (chunk_id,))
+        if not rows:
+            return f"ID {chunk_id} not found."
+        metadata, text = rows[0]
+        return Document(id=chunk_id, page_content=text, metadata=json.loads(metadata))
+
+
+class LazyIdMap:
+    """Read-only position -> chunk id mapping backed by SQLite."""
+
+    def __init__(self, db: _ChunkDB, count: int):
+        self._db = db
+        self._count = count
+
+    def __getitem__(self, pos: int) -> str:
+        rows = self._db.query("SELECT chunk_id FROM chunks WHERE pos = ?", (int(pos),))
+        if not rows:
+            raise KeyError(pos)
+        return rows[0][0]
+
+    def __len__(self) -> int:
+        return self._count
+
+    def values(self) -> Iterator[str]:
+        for (chunk_id,) in self._db.query("SELECT chunk_id FROM chunks ORDER BY pos"):
+            yield chunk_id
+
+
+class MmapFlatIndex:
+    """Exact search over a memory-mapped float32 matrix, with FAISS's search() signature."""
+
+    def __init__(self, vectors: np.ndarray, norms: np.ndarray, metric: str, block_rows: int = 65_536):
+        self.vectors = vectors
+        self.norms = norms
+        self.metric = metric
+        self.block_rows = block_rows
+        self.ntotal, self.d = vectors.shape
+
+    def search(self, queries: np.ndarray, k: int, subset: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """Top-k rows per query. With `subset` (sorted row positions) only those rows are scored."""
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        nq = queries.shape[0]
+        rows = self.ntotal if subset is None else len(subset)
+        k = min(k, rows)
+        if k == 0:
+            return np.empty((nq, 0), dtype=np.float32), np.empty((nq, 0), dtype=np.int64)
+        # Scores where smaller is better: squared L2, or negated inner product
+        best_scores = np.full((nq, k), np.inf, dtype=np.float32)
+        best_ids = np.full((nq, k), -1, dtype=np.int64)
+        q_norms = (queries * queries).sum(axis=1)[:, None]
+
+        for start in range(0, rows, self.block_rows):
+            stop = min(start + self.block_rows, rows)
+            if subset is None:
+                block_ids = np.arange(start, stop, dtype=np.int64)
+                block, norms = self.vectors[start:stop], self.norms[start:stop]
+            else:
+                # Fancy indexing on the memmap only pages in the selected rows
+                block_ids = subset[start:stop]
+                block, norms = self.vectors[block_ids], self.norms[block_ids]
+            products = queries @ block.T
+            if self.metric == "ip":
+                scores = -products
+            else:
+                scores = q_norms - 2 * products + norms[None, :]
+            ids = np.broadcast_to(block_ids, scores.shape)
+            all_scores = np.concatenate([best_scores, scores], axis=1)
+            all_ids = np.concatenate([best_ids, ids], axis=1)
+            keep = np.argpartition(all_scores, k - 1, axis=1)[:, :k]
+            best_scores = np.take_along_axis(all_scores, keep, axis=1)
+            best_ids = np.take_along_axis(all_ids, keep, axis=1)
+
+        order = np.argsort(best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        if self.metric == "ip":
+            best_scores = -best_scores
+        return best_scores, best_ids
+
+
+class MmapVectorStore:
+    """Read-only vector store over the folder format written by export_store.
+
+    Opening it maps the vector file and opens SQLite; nothing is read into memory up front, and
+    several processes opening the same folder share the OS page cache.
+    """
+
+    _normalize_L2 = False
+
+    def __init__(self, path: str, embedding_function):
+        with open(os.path.join(path, META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        count, dim = meta["count"], meta["dim"]
+        vectors = np.memmap(os.path.join(path, VECTORS_FILE), dtype=np.float32, mode="r", shape=(count, dim))
+        norms = np.memmap(os.path.join(path, NORMS_FILE), dtype=np.float32, mode="r", shape=(count,))
+        db = _ChunkDB(os.path.join(path, CHUNKS_FILE))
+        self.path = path
+        self._db = db
+        self.embedding_function = embedding_function
+        self.index = MmapFlatIndex(vectors, norms, meta["metric"])
+        self.docstore = LazyDocstore(db)
+        self.index_to_docstore_id = LazyIdMap(db, count)
+
+    @classmethod
+    def load(cls, path: str, embedding_function) -> "MmapVectorStore":
+        return cls(path, embedding_function)
+
+    def filter_positions(self, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                         note_types: Optional[Sequence[str]] = None) -> Optional[np.ndarray]:
+        """Row positions whose note falls in [date_from, date_to] (YYYY-MM-DD) and has one of
+        `note_types`; None when no filter is given (search everything)."""
+        clauses, params = [], []
+        if date_from:
+            clauses.append("note_date >= ?")
+            params.append(date_from)
+        if date_to:
+            clauses.append("note_date <= ?")
+            params.append(date_to)
+        if note_types:
+            clauses.append(f"note_type IN ({', '.join('?' * len(note_types))})")
+            params.extend(note_types)
+        if not clauses:
+            return None
+        rows = self._db.query(f"SELECT pos FROM chunks WHERE {' AND '.join(clauses)} ORDER BY pos", params)
+        return np.fromiter((pos for (pos,) in rows), dtype=np.int64, count=len(rows))
+
+    def chunk_ids(self, positions: Sequence[int]) -> List[str]:
+        return [self.index_to_docstore_id[int(p)] for p in positions]
+
+    def search_vectors(self, vectors: np.ndarray, k: int,
+                       positions: Optional[np.ndarray] = None) -> List[List[Tuple[str, float]]]:
+        """Like retrieval.vector_search_many for already-embedded queries, optionally restricted to `positions`."""
+        distances, found = self.index.search(vectors, k, subset=positions)
+        return [
+            [(self.index_to_docstore_id[int(p)], float(d)) for p, d in zip(row_p, row_d) if p != -1]
+            for row_p, row_d in zip(found, distances)
+        ]
+
+    def similarity_search_with_score(self, query: str, k: int = 4) -> List[Tuple[Document, float]]:
+        vector = np.asarray([self.embedding_function.embed_query(query)], dtype=np.float32)
+        scores, positions = self.index.search(vector, k)
+        return [
+            (self.docstore.search(self.index_to_docstore_id[int(p)]), float(s))
+            for p, s in zip(positions[0], scores[0])
+            if p != -1
+        ]
+
+    def similarity_search(self, query: str, k: int = 4) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
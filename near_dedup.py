@@ -0,0 +1,176 @@
+import json
+import os
+import re
+import zlib
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from bm25_index import tokenize
+from faiss_store import chunk_id
+
+NEAR_DUPLICATES_FILE = "near_duplicates.json"
+
+_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64(0xFFFFFFFF)
+_NUMBER = re.compile(r"\d+(?:\.\d+)?")
+
+
+def shingles(text: str, size: int = 3) -> set:
+    """Word `size`-grams of the normalized text (the whole text when it is shorter)."""
+    tokens = tokenize(text)
+    if len(tokens) <= size:
+        return {" ".join(tokens)} if tokens else set()
+    return {" ".join(tokens[i:i + size]) for i in range(len(tokens) - size + 1)}
+
+
+class MinHashLSH:
+    """Near-duplicate lookup over MinHash signatures with LSH banding.
+
+    Two texts are near duplicates when their estimated shingle Jaccard similarity reaches
+    `threshold`. Signatures are split into `bands` bands and only texts sharing a band are
+    compared, so a lookup does not scan everything seen so far. Texts with different `scope`
+    values (e.g. patient ids), or with different numbers in them, are never matched: two lab
+    tables that differ in a single value are not duplicates, however similar the rest is.
+    """
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 64, bands: int = 16,
+                 shingle_size: int = 3, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        # Universal hashes (a * x + b) mod p over 32-bit shingle hashes; a, b < 2**31 keeps a * x + b in uint64
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, 1 << 31, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 1 << 31, num_perm, dtype=np.uint64)
+        self.signatures: List[Optional[np.ndarray]] = []
+        self._buckets: Dict[int, List[int]] = {}
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        grams = shingles(text, self.shingle_size)
+        if not grams:
+            return None
+        hashes = np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+        values = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % _PRIME
+        return (values & _MAX_HASH).min(axis=1).astype(np.uint32)
+
+    def add(self, text: str, scope: Any = None) -> Tuple[int, bool]:
+        """Return (representative index, is_new): the earlier text this one near-duplicates, or
+        a fresh index when there is none (the text then becomes a representative itself)."""
+        sig = self.signature(text)
+        if sig is not None:
+            scope = (scope, tuple(sorted(set(_NUMBER.findall(text)))))
+            keys = [hash((scope, band, sig[band * self.rows:(band + 1) * self.rows].tobytes()))
+                    for band in range(self.bands)]
+            checked = set()
+            for key in keys:
+                for candidate in self._buckets.get(key, ()):
+                    if candidate in checked:
+                        continue
+                    checked.add(candidate)
+                    if np.mean(self.signatures[candidate] == sig) >= self.threshold:
+                        return candidate, False
+        rep = len(self.signatures)
+        self.signatures.append(sig)
+        if sig is not None:
+            for key in keys:
+                self._buckets.setdefault(key, []).append(rep)
+        return rep, True
+
+
+class ChunkDeduplicator:
+    """Streaming near-duplicate filter for chunk Documents, run before they are embedded.
+
+    Only the first chunk of each near-duplicate group is passed on; the notes the dropped
+    copies came from are recorded in `provenance` under the representative's chunk id and
+    saved next to the index. Chunks are only compared within the same `scope_key` metadata
+    value, so one patient's text never stands in for another's.
+    """
+
+    def __init__(self, threshold: float = 0.85, scope_key: Optional[str] = "patient_id", **lsh_kwargs):
+        self.lsh = MinHashLSH(threshold, **lsh_kwargs)
+        self.scope_key = scope_key
+        self.provenance: Dict[str, List[Dict[str, Any]]] = {}
+        self._reps: List[Tuple[str, Any]] = []
+        self.kept = 0
+        self.dropped = 0
+
+    def filter(self, docs: Iterable[Document]) -> Iterator[Document]:
+        for doc in docs:
+            scope = doc.metadata.get(self.scope_key) if self.scope_key else None
+            rep, is_new = self.lsh.add(doc.page_content, scope)
+            if is_new:
+                self._reps.append((chunk_id(doc), doc.metadata.get("source")))
+                self.kept += 1
+                yield doc
+                continue
+            self.dropped += 1
+            rep_id, rep_source = self._reps[rep]
+            if doc.metadata.get("source") == rep_source:
+                continue
+            links = self.provenance.setdefault(rep_id, [])
+            if all(link.get("source") != doc.metadata.get("source") for link in links):
+                links.append(dict(doc.metadata))
+
+    def stats(self) -> str:
+        total = self.kept + self.dropped
+        return (f"[NearDedup] {self.dropped} of {total} chunks were near duplicates "
+                f"({self.dropped / total if total else 0:.0%}); {self.kept} kept")
+
+    def save(self, index_path: str) -> None:
+        os.makedirs(index_path, exist_ok=True)
+        tmp = os.path.join(index_path, NEAR_DUPLICATES_FILE + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.provenance, f)
+        os.replace(tmp, os.path.join(index_path, NEAR_DUPLICATES_FILE))
+
+
+def load_provenance(index_path: str) -> Dict[str, List[Dict[str, Any]]]:
+    """{representative chunk id: metadata of the notes whose copies were dropped}; empty if not saved."""
+    path = os.path.join(index_path, NEAR_DUPLICATES_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def duplicate_sources(provenance: Dict[str, List[Dict[str, Any]]], doc: Document) -> List[str]:
+    """Sources of the notes whose near-duplicate copies of `doc` were dropped at indexing time."""
+    return [link["source"] for link in provenance.get(chunk_id(doc), [])]
+
+
+def dedup_items(items: Sequence[Dict[str, Any]], text_key: str, source_key: str = "title",
+                scopes: Optional[Sequence[Any]] = None, threshold: float = 0.85,
+                **lsh_kwargs) -> Tuple[List[Dict[str, Any]], Dict[str, List[str]]]:
+    """Collapse near-duplicate prompt items (e.g. retrieved chunks) into the first of each group.
+
+    `scopes` optionally gives one scope value per item (items in different scopes are never merged).
+    Returns (kept items, {kept item's source: sources of the items collapsed into it}).
+    """
+    lsh = MinHashLSH(threshold, **lsh_kwargs)
+    kept, links = [], {}
+    rep_sources: List[Any] = []
+    for n, item in enumerate(items):
+        rep, is_new = lsh.add(item[text_key], scopes[n] if scopes is not None else None)
+        if is_new:
+            rep_sources.append(item[source_key])
+            kept.append(item)
+        elif item[source_key] != rep_sources[rep]:
+            sources = links.setdefault(rep_sources[rep], [])
+            if item[source_key] not in sources:
+                sources.append(item[source_key])
+    return kept, links
+
+
+def merge_links(*maps: Dict[str, List[str]]) -> Dict[str, List[str]]:
+    """Union of {source: [duplicate sources]} maps, keeping first-seen order."""
+    merged: Dict[str, List[str]] = {}
+    for links in maps:
+        for source, others in links.items():
+            target = merged.setdefault(source, [])
+            target.extend(other for other in others if other not in target and other != source)
+    return merged
@@ -0,0 +1,172 @@
+import bisect
+import multiprocessing
+import re
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+from ingest import parse_note_header
+from rule_extractor import PATTERNS
+from util import iter_batches
+
+# "ClinicalNoteId: ... NoteType: Progress Notes NoteText: <body>"
+_NOTE_TEXT = re.compile(r"NoteText:\s*")
+
+# Notes are exported on one line: sections are separated by runs of spaces, sentences by ". "
+_SECTION_BREAK = re.compile(r"\s{3,}")
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?;])\s+(?=[A-Z0-9(*\-])")
+
+# The value + reference range part of a lab-result row, value first ("203.94 (H) 0.76 - 6.83 mg/dL")
+# or range first ("0.76 - 6.83 mg/dL 56.21 (H)"); the analyte name before it is found by looking back
+_LAB_NUM = r"[<>]?\s?\d+(?:\.\d+)?(?:\s*\([HL]\))?"
+_LAB_RANGE = r"\d+(?:\.\d+)?\s*-\s*\d+(?:\.\d+)?\s*[A-Za-z/%0-9^]*"
+LAB_VALUES = re.compile(rf"{_LAB_NUM}\s+{_LAB_RANGE}|{_LAB_RANGE}\s+{_LAB_NUM}")
+_LAB_NAME_CHARS = 40
+
+# Rows this close together belong to one table
+_ROW_GAP = 5
+
+
+def split_header(text: str) -> Tuple[Dict[str, Optional[str]], int]:
+    """Header fields of a note and the offset where its NoteText body starts (0 if there is no header)."""
+    match = _NOTE_TEXT.search(text, 0, 2000)
+    return parse_note_header(text), (match.end() if match else 0)
+
+
+def protected_spans(text: str, start: int = 0) -> List[Tuple[int, int]]:
+    """Merged (start, end) spans of lab tables in `text[start:]` that must not be split."""
+    spans = []
+    for match in LAB_VALUES.finditer(text, start):
+        # The row starts at its analyte name: back to the previous gap of 2+ spaces, at most 40 characters
+        lookback = max(start, match.start() - _LAB_NAME_CHARS)
+        gap = text.rfind("  ", lookback, match.start())
+        spans.append((gap + 2 if gap != -1 else lookback, match.end()))
+    spans += [m.span() for pattern in PATTERNS for m in pattern.finditer(text, start)]
+    spans.sort()
+    merged: List[List[int]] = []
+    for s, e in spans:
+        if merged and s - merged[-1][1] <= _ROW_GAP:
+            merged[-1][1] = max(merged[-1][1], e)
+        else:
+            merged.append([s, e])
+    return [(s, e) for s, e in merged]
+
+
+class NoteChunker:
+    """Splits EMR notes along their own structure instead of fixed character windows.
+
+    The header (ClinicalNoteId ... NoteText:) is parsed into metadata and left out of the
+    chunk text. The body is cut at section gaps and sentence ends, never inside a lab table,
+    and the pieces are packed into chunks of up to `chunk_size` characters (a table longer
+    than that stays whole). Up to `overlap` characters of trailing sentences are repeated at
+    the start of the next chunk. Every chunk records `start_index` / `end_index`: its
+    character offsets in the original note text.
+    """
+
+    def __init__(self, chunk_size: int = 1000, overlap: int = 100):
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    def _units(self, text: str, start: int) -> List[Tuple[int, int]]:
+        spans = protected_spans(text, start)
+        starts = [s for s, _ in spans]
+        breaks = set()
+        for pattern in (_SECTION_BREAK, _SENTENCE_BREAK):
+            for match in pattern.finditer(text, start):
+                at = match.end()
+                i = bisect.bisect_right(starts, at) - 1
+                if i >= 0 and spans[i][0] < at < spans[i][1]:
+                    continue  # inside a lab table
+                breaks.add(at)
+        bounds = [start] + sorted(b for b in breaks if start < b < len(text)) + [len(text)]
+        units = []
+        for s, e in zip(bounds, bounds[1:]):
+            e = len(text[s:e].rstrip()) + s
+            if e <= s:
+                continue
+            i = bisect.bisect_right(starts, s) - 1
+            in_table = i >= 0 and spans[i][0] <= s < spans[i][1]
+            units.extend([(s, e)] if in_table else self._hard_split(text, s, e))
+        return units
+
+    def _hard_split(self, text: str, start: int, end: int) -> List[Tuple[int, int]]:
+        """Cut a run of text with no structure to break on at whitespace, chunk_size at a time."""
+        pieces = []
+        while end - start > self.chunk_size:
+            cut = text.rfind(" ", start + 1, start + self.chunk_size)
+            cut = cut if cut > start else start + self.chunk_size
+            pieces.append((start, cut))
+            start = cut
+            while start < end and text[start].isspace():
+                start += 1
+        if end > start:
+            pieces.append((start, end))
+        return pieces
+
+    def split_note(self, text: str) -> Tuple[Dict[str, Optional[str]], List[Tuple[str, int, int]]]:
+        """(header fields, [(chunk text, start offset, end offset)]) for one note."""
+        header, body_start = split_header(text)
+        units = self._units(text, body_start)
+        chunks: List[Tuple[str, int, int]] = []
+        current: List[Tuple[int, int]] = []
+        for unit in units:
+            if current and unit[1] - current[0][0] > self.chunk_size:
+                chunks.append((text[current[0][0]:current[-1][1]], current[0][0], current[-1][1]))
+                # Carry trailing units that fit in the overlap (and still leave room for this one)
+                carry: List[Tuple[int, int]] = []
+                for prev in reversed(current):
+                    if (current[-1][1] - prev[0] > self.overlap
+                            or unit[1] - prev[0] > self.chunk_size):
+                        break
+                    carry.insert(0, prev)
+                current = carry
+            current.append(unit)
+        if current:
+            chunks.append((text[current[0][0]:current[-1][1]], current[0][0], current[-1][1]))
+        return header, chunks
+
+
+def _chunk_batch(chunker: NoteChunker, notes: List[Tuple[str, str]]) -> List[Tuple[str, Dict[str, Any]]]:
+    out = []
+    for title, text in notes:
+        header, chunks = chunker.split_note(text)
+        metadata = {
+            "source": title,
+            "patient_id": header["patient_id"],
+            "note_date": header["note_date"],
+            "note_type": header["note_type"],
+        }
+        for chunk, start, end in chunks:
+            out.append((chunk, {**metadata, "start_index": start, "end_index": end}))
+    return out
+
+
+def chunk_notes(notes: Iterable[Tuple[str, str]], chunker: NoteChunker, workers: int = 1,
+                batch_size: int = 200) -> Iterator[Document]:
+    """Lazily chunk (title, text) notes into Documents, in input order.
+
+    With workers > 1 batches of `batch_size` notes are chunked on a process pool, with at most
+    2 * workers batches in flight. The pool needs the "fork" start method (the pipeline
+    scripts have no __main__ guard for "spawn" to re-import safely); elsewhere notes are
+    chunked in this process.
+    """
+    if workers > 1 and "fork" not in multiprocessing.get_all_start_methods():
+        print("[Chunker] No fork start method on this platform; chunking in one process")
+        workers = 1
+    if workers <= 1:
+        for batch in iter_batches(notes, batch_size):
+            for chunk, metadata in _chunk_batch(chunker, batch):
+                yield Document(page_content=chunk, metadata=metadata)
+        return
+
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork")) as pool:
+        pending = []
+        for batch in iter_batches(notes, batch_size):
+            pending.append(pool.submit(_chunk_batch, chunker, batch))
+            if len(pending) >= 2 * workers:
+                for chunk, metadata in pending.pop(0).result():
+                    yield Document(page_content=chunk, metadata=metadata)
+        for future in pending:
+            for chunk, metadata in future.result():
+                yield Document(page_content=chunk, metadata=metadata)
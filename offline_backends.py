@@ -0,0 +1,144 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage
+
+from bm25_index import tokenize
+from rule_extractor import extract_flc_rules
+
+# OFFLINE_BACKENDS=1 swaps the Azure embedding and chat models for the local stand-ins below,
+# so the pipelines can be run and benchmarked without endpoints or keys.
+
+
+def offline_enabled() -> bool:
+    return os.environ.get("OFFLINE_BACKENDS", "").strip().lower() in ("1", "true", "yes")
+
+
+@lru_cache(maxsize=200_000)
+def _bucket(token: str, dim: int):
+    digest = hashlib.md5(token.encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "little") % dim, 1.0 if digest[4] & 1 else -1.0
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic bag-of-words embeddings (signed feature hashing, L2-normalized).
+
+    Texts sharing words get similar vectors, so retrieval behaves sensibly without a model.
+    """
+
+    model_name = "offline-hash"
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in tokenize(text):
+            bucket, sign = _bucket(token, self.dim)
+            vector[bucket] += sign
+        norm = np.linalg.norm(vector)
+        if norm:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+def _prompt_payload(prompt: str) -> List[Dict[str, Any]]:
+    """The largest JSON list of objects embedded in a prompt (the context or records under review)."""
+    decoder = json.JSONDecoder()
+    best, best_len = [], 0
+    start = prompt.find("[")
+    while start != -1:
+        try:
+            value, end = decoder.raw_decode(prompt, start)
+        except ValueError:
+            value, end = None, start
+        if isinstance(value, list) and value and all(isinstance(v, dict) for v in value) and end - start > best_len:
+            best, best_len = value, end - start
+        start = prompt.find("[", start + 1)
+    return best
+
+
+class RuleBasedChatModel:
+    """Chat-model stand-in that answers the pipelines' prompts with the rule extractor.
+
+    Extraction prompts (context items with text) get the rule extractor's records for each item;
+    validation prompts (items that are already records) get their records back unchanged.
+    Multi-schema prompts (extraction_engine.py) get one list per schema, filled for "flc" only.
+    `latency` adds a fixed per-call delay to mimic a remote endpoint.
+    """
+
+    deployment_name = "offline"
+    model_name = "offline-rules"
+    temperature = 0
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def _answer(self, prompt: str) -> AIMessage:
+        items = _prompt_payload(prompt)
+        if items and all("schemas" in item for item in items):
+            return self._answer_schemas(prompt, items)
+        records = []
+        for item in items:
+            text = item.get("medical_notes") or item.get("content")
+            if text is None:
+                records.append(item)
+                continue
+            found, _ = extract_flc_rules(item.get("title", ""), text)
+            for record in found:
+                if "content" in item:
+                    # main.py's schema
+                    record = {
+                        "title": record["title"],
+                        "kappa_flc": record["kappa_flc"],
+                        "lambda_flc": record["lambda_flc"],
+                        "kappa_lambda_ratio": record["kappa_lambda_ratio"],
+                        "date_of_lab": record["date_of_lab"],
+                        "evidence_sentences": (record["evidence_sentences_for_lab_values"]
+                                               + record["evidence_sentences_for_lab_date"]),
+                    }
+                records.append(record)
+        return self._message(prompt, json.dumps(records, indent=2))
+
+    def _answer_schemas(self, prompt: str, items: List[Dict[str, Any]]) -> AIMessage:
+        # extraction_engine.py prompts: one list per schema; only "flc" has local rules
+        answer = {name: [] for item in items for name in item["schemas"]}
+        for item in items:
+            if "flc" in item["schemas"]:
+                answer["flc"].extend(extract_flc_rules(item["title"], item["medical_notes"])[0])
+        return self._message(prompt, json.dumps(answer, indent=2))
+
+    def _message(self, prompt: str, content: str) -> AIMessage:
+        # Rough 4-characters-per-token usage, enough for cost/throughput accounting
+        usage = {"input_tokens": len(prompt) // 4, "output_tokens": len(content) // 4}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        return AIMessage(content=content, usage_metadata=usage)
+
+    def invoke(self, prompt: str, **kwargs) -> AIMessage:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._answer(prompt)
+
+    async def ainvoke(self, prompt: str, **kwargs) -> AIMessage:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._answer(prompt)
+
+
+def offline_llm(latency: Optional[float] = None) -> RuleBasedChatModel:
+    if latency is None:
+        latency = float(os.environ.get("OFFLINE_LLM_LATENCY", 0))
+    return RuleBasedChatModel(latency=latency)
@@ -0,0 +1,67 @@
+import json
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from token_counter import count_tokens
+
+
+def item_tokens(item: Any, model: str = "gpt-4o") -> int:
+    # Items are embedded in prompts as indented JSON, so count that form
+    return count_tokens(json.dumps(item, indent=2), model)
+
+
+def pack_prompt_batches(items: List[Any], max_input_tokens: int, overhead_tokens: int = 0,
+                        group_key: Optional[Callable[[Any], Any]] = None, merge_groups: bool = True,
+                        model: str = "gpt-4o") -> Tuple[List[List[Any]], Dict[str, Any]]:
+    """Pack items into prompt batches that fill up to `max_input_tokens` each.
+
+    `overhead_tokens` is the size of the prompt template without any items. Items sharing a
+    `group_key` (e.g. the same note title) are kept in one batch when they fit; a group larger
+    than the budget is split across consecutive batches. With merge_groups=False every batch
+    holds items of a single group only.
+
+    Returns (batches, stats) where stats has calls, input_tokens and fill_rate.
+    """
+    budget = max(1, max_input_tokens - overhead_tokens)
+
+    # Group items, preserving first-appearance order of groups and of items within a group
+    groups: Dict[Any, List[Tuple[Any, int]]] = {}
+    for n, item in enumerate(items):
+        key = group_key(item) if group_key else n
+        groups.setdefault(key, []).append((item, item_tokens(item, model)))
+
+    batches, batch_tokens = [], []
+    current, current_tokens = [], 0
+
+    def flush():
+        nonlocal current, current_tokens
+        if current:
+            batches.append(current)
+            batch_tokens.append(current_tokens)
+        current, current_tokens = [], 0
+
+    for members in groups.values():
+        group_total = sum(tokens for _, tokens in members)
+        if current and (not merge_groups or current_tokens + group_total > budget):
+            flush()
+        for item, tokens in members:
+            if current and current_tokens + tokens > budget:
+                flush()
+            if tokens > budget:
+                print(f"[Packer] Item of {tokens} tokens exceeds the {budget}-token budget; sending it alone")
+            current.append(item)
+            current_tokens += tokens
+    flush()
+
+    used = sum(batch_tokens) + overhead_tokens * len(batches)
+    stats = {
+        "calls": len(batches),
+        "items": len(items),
+        "input_tokens": used,
+        "fill_rate": used / (max_input_tokens * len(batches)) if batches else 0.0,
+    }
+    return batches, stats
+
+
+def format_pack_stats(stage: str, stats: Dict[str, Any]) -> str:
+    return (f"[{stage}] {stats['items']} items packed into {stats['calls']} calls, "
+            f"{stats['input_tokens']} input tokens, {stats['fill_rate']:.0%} of budget used")
@@ -0,0 +1,83 @@
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import faiss
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from bm25_index import BM25Index
+from tracing import get_tracer
+
+
+def vector_search_many(store: FAISS, queries: Sequence[str], k: int) -> List[List[Tuple[str, float]]]:
+    """Embed all queries in one request and run one FAISS search over the query matrix.
+
+    Returns one list of (chunk_id, distance) pairs per query, nearest first.
+    """
+    with get_tracer().span("embedding", "query", items=len(queries)):
+        vectors = np.asarray(store.embedding_function.embed_documents(list(queries)), dtype=np.float32)
+    if store._normalize_L2:
+        faiss.normalize_L2(vectors)
+    distances, positions = store.index.search(vectors, min(k, store.index.ntotal))
+    return [
+        [(store.index_to_docstore_id[int(p)], float(d)) for p, d in zip(row_p, row_d) if p != -1]
+        for row_p, row_d in zip(positions, distances)
+    ]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[Tuple[str, float]]], k: int = 60) -> List[Tuple[str, float]]:
+    """Fuse several ranked id lists: score(id) = sum over lists of 1 / (k + rank)."""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, (chunk_id, _) in enumerate(ranking, start=1):
+            scores[chunk_id] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+def fuse_hybrid(bm25: BM25Index, keywords: Sequence[str], dense_rankings: Sequence[Sequence[Tuple[str, float]]],
+                keyword_k: Optional[int] = None, substring: bool = True,
+                allowed_ids: Optional[Set[str]] = None) -> Dict[str, float]:
+    """RRF-fuse each query's BM25 and dense ranking; returns the best fused score per chunk id.
+
+    `allowed_ids` drops keyword hits outside a pre-filtered set (dense rankings are expected to
+    be filtered already).
+    """
+    best = {}
+    for terms, dense in zip(keywords, dense_rankings):
+        lexical = bm25.search(terms, keyword_k, substring=substring)
+        if allowed_ids is not None:
+            lexical = [(chunk_id, score) for chunk_id, score in lexical if chunk_id in allowed_ids]
+        for chunk_id, score in reciprocal_rank_fusion([lexical, dense]):
+            if score > best.get(chunk_id, 0.0):
+                best[chunk_id] = score
+    return best
+
+
+def multi_query_search(store: FAISS, bm25: BM25Index, queries: Sequence[str],
+                       keywords: Optional[Sequence[str]] = None, k: Optional[int] = None, vector_k: int = 100,
+                       keyword_k: Optional[int] = None, substring: bool = True) -> List[Tuple[Document, float]]:
+    """Hybrid retrieval for several queries in one round-trip, merged by chunk id.
+
+    Each query's keyword (BM25) and vector rankings are fused with RRF; a chunk hit by several
+    queries keeps its best fused score. `keywords` (one per query) defaults to the queries.
+    keyword_k=None keeps every chunk that contains all of a keyword's words, so term-bearing
+    chunks are never cut off by the vector top-k.
+    """
+    keywords = list(keywords) if keywords is not None else list(queries)
+    dense_rankings = vector_search_many(store, queries, vector_k) if vector_k else [[] for _ in queries]
+    best = fuse_hybrid(bm25, keywords, dense_rankings, keyword_k=keyword_k, substring=substring)
+
+    ranked = sorted(best.items(), key=lambda x: x[1], reverse=True)
+    if k is not None:
+        ranked = ranked[:k]
+    return [(store.docstore.search(chunk_id), score) for chunk_id, score in ranked]
+
+
+def hybrid_search(store: FAISS, bm25: BM25Index, query: str, keywords: Optional[str] = None,
+                  k: Optional[int] = None, vector_k: int = 100, keyword_k: Optional[int] = None,
+                  substring: bool = True) -> List[Document]:
+    """Single-query form of multi_query_search."""
+    hits = multi_query_search(store, bm25, [query], [keywords if keywords is not None else query],
+                              k=k, vector_k=vector_k, keyword_k=keyword_k, substring=substring)
+    return [doc for doc, _ in hits]
@@ -0,0 +1,219 @@
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+# Building blocks for the lab-table and narrative forms seen in the notes
+_NUM = r"[<>]?\s?\d+(?:\.\d+)?"
+_FLAG = r"(?:\s*\([HL]\))?"
+_RANGE = r"\d+(?:\.\d+)?\s*-\s*\d+(?:\.\d+)?"
+_UNIT = r"mg\s?/\s?dL|mg\s?/\s?L"
+_DATE = r"\d{1,2}/\d{1,2}/(?:\d{4}|\d{2})"
+# Ratios can carry a thousands separator ("K/L >1,438.93")
+_RATIO_NUM = r"[<>]?\s?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?"
+
+# "Kappa Free Light Chain 203.94 (H) 0.76 - 6.83 mg/dL Lambda Free Light Chain <0.15 (L) 0.68 - 4.58 mg/dL
+#  Kappa/Lambda FLC Ratio >1456.71 (H)" -- a results table of the note itself
+TABLE_VALUE_FIRST = re.compile(
+    rf"Kappa Free Light Chain\s+(?P<kappa>{_NUM}){_FLAG}\s+{_RANGE}\s*(?P<kunit>{_UNIT})\s+"
+    rf"Lambda Free Light Chain\s+(?P<lambda>{_NUM}){_FLAG}\s+{_RANGE}\s*(?P<lunit>{_UNIT})\s+"
+    rf"Kappa/Lambda FLC Ratio\s+(?P<ratio>{_NUM}){_FLAG}",
+    re.IGNORECASE,
+)
+
+# "Latest Reference Range & Units 02/22/24 09:20 Kappa Free Light Chain 0.76 - 6.83 mg/dL 56.21 (H) ..."
+TABLE_RANGE_FIRST = re.compile(
+    rf"Latest Reference Range & Units\s+(?P<date>{_DATE})(?:\s+\d{{1,2}}:\d{{2}})?\s+"
+    rf"(?:(?!{_DATE}).){{0,200}}?"
+    rf"Kappa Free Light Chain\s+{_RANGE}\s*(?P<kunit>{_UNIT})\s+(?P<kappa>{_NUM}){_FLAG}\s+"
+    rf"Lambda Free Light Chain\s+{_RANGE}\s*(?P<lunit>{_UNIT})\s+(?P<lambda>{_NUM}){_FLAG}\s+"
+    rf"Kappa/Lambda FLC Ratio\s+{_RANGE}\s+(?P<ratio>{_NUM}){_FLAG}",
+    re.IGNORECASE,
+)
+
+# "1/16/24: KFLC 242.66, LFLC <0.15, kappa/lambda ratio >1733.29"
+# "11/28/23: kappa free light chain (KFLC) 129.54mg /dL, lambda free light chain (LFLC) 15mg /dL, kappa/lambda ratio >914.29"
+NARRATIVE_DATED = re.compile(
+    rf"(?P<date>{_DATE}):\s*"
+    rf"(?:kappa free light chains?\s*\(KFLC\)|KFLC)\s*(?P<kappa>{_NUM})\s*(?P<kunit>{_UNIT})?\s*,\s*"
+    rf"(?:lambda free light chains?\s*\(LFLC\)|LFLC)\s*(?P<lambda>{_NUM})\s*(?P<lunit>{_UNIT})?\s*,\s*"
+    rf"(?:kappa/lambda ratio|K/L ratio|K/L|ratio)\s*(?P<ratio>{_NUM})",
+    re.IGNORECASE,
+)
+
+# Narrative lines without a date of their own, e.g. "KFLC 65 mg/dL, LFLC 0.34 mg/dL, and K/L 190.88",
+# "kappa FLC of 20.78, lambda FLC of 0.24, kappa/lambda ratio of 86.58" or
+# "kappa free light chain was 1.24, lambda was 0.72 and kappa/lambda ratio was 1.72". A line missing
+# one of the three ("KFLC 1.24, K/L 1.72") is left to the LLM; a value followed by "-"
+# ("KFLC 42.6-->16.18") is a trend, not a result.
+_LINK = r"\s*(?:(?:of|was|were|is|at|(?:down |up )?to)\s+|[:=]\s*)?"
+_SEP = r"\s*[,;]?\s*(?:and\s+|with\s+(?:an?\s+)?)?"
+NARRATIVE = re.compile(
+    rf"\b(?:serum\s+)?(?:kappa free light chains?(?:\s*\(KFLC\))?|kappa\s+FLC|KFLC|kappa)"
+    rf"{_LINK}(?P<kappa>{_NUM})(?!\d|\.\d|\s*-)\s*(?P<kunit>{_UNIT})?"
+    rf"(?:{_SEP}(?:lambda free light chains?(?:\s*\(LFLC\))?|lambda\s+FLC|LFLC|lambda)"
+    rf"{_LINK}(?P<lambda>{_NUM})(?!\d|\.\d|\s*-)\s*(?P<lunit>{_UNIT})?)?"
+    rf"(?:{_SEP}(?:kappa/lambda(?:\s+FLC)?\s+ratio|K/L\s+ratio|K/L|FLC\s+ratio|ratio)"
+    rf"{_LINK}(?P<ratio>{_RATIO_NUM})(?!\d|\.\d))?",
+    re.IGNORECASE,
+)
+
+PATTERNS = [TABLE_VALUE_FIRST, TABLE_RANGE_FIRST, NARRATIVE_DATED, NARRATIVE]
+
+# Where an undated narrative line looks for its date: the current and previous sentence before it
+_SENTENCE_END = re.compile(r"\.\s|\s-\s")
+# "12/1/2021" or "12/1/21", "6/2021", and "(1/16)" whose year is the note's
+_CONTEXT_DATE = re.compile(
+    r"(?<![\d/])(?:(?P<m>\d{1,2})/(?P<d>\d{1,2})/(?P<y>\d{4}|\d{2})"
+    r"|(?P<my_m>\d{1,2})/(?P<my_y>\d{4})"
+    r"|(?P<md_m>\d{1,2})/(?P<md_d>\d{1,2}))(?![\d/])"
+)
+# Values described as past ones ("At that time, ...", "at diagnosis") are not the note's results
+_HISTORICAL = re.compile(r"\b(?:at that time|diagnos\w*|initial(?:ly)?|previous(?:ly)?|prior)\b", re.IGNORECASE)
+
+# Any numeric FLC-looking mention; if one is left after the patterns above, the chunk goes to the LLM
+FLC_MENTION = re.compile(r"\b(?:kappa|lambda|kflc|lflc|k/l|flc)\b[^.;]{0,40}?\d", re.IGNORECASE)
+
+NOTE_DATETIME = re.compile(r"NoteDateTime:\s*(?P<date>\d{4}-\d{2}-\d{2})")
+TITLE_DATE = re.compile(r"^(?P<date>\d{4}-\d{2}-\d{2})_")
+
+# date_source of a record whose date is quoted in its evidence_sentences_for_lab_date
+DATE_FROM_EVIDENCE = "evidence"
+
+
+def _clean_value(value: str) -> str:
+    return re.sub(r"[\s,]+", "", value)
+
+
+def _clean_unit(unit: Optional[str]) -> str:
+    return re.sub(r"\s+", "", unit) if unit else ""
+
+
+def _with_unit(value: str, unit: Optional[str]) -> str:
+    unit = _clean_unit(unit)
+    return f"{_clean_value(value)} {unit}" if unit else _clean_value(value)
+
+
+def to_iso_date(date: str) -> str:
+    month, day, year = date.split("/")
+    if len(year) == 2:
+        year = "20" + year
+    return f"{int(year):04d}-{int(month):02d}-{int(day):02d}"
+
+
+def note_date(title: str, text: str,
+              metadata_date: Optional[str] = None) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Date of the note from its NoteDateTime header, falling back to the chunk's note_date
+    metadata and then to the title prefix.
+
+    Returns (YYYY-MM-DD, evidence, source) or (None, None, None). Only the first chunk of a note
+    carries the header, so evidence is the header text when it is in `text` (source "evidence")
+    and None when the date comes from the metadata ("note_metadata") or the title ("title").
+    """
+    match = NOTE_DATETIME.search(text)
+    if match:
+        return match.group("date"), match.group(0), DATE_FROM_EVIDENCE
+    if metadata_date:
+        return metadata_date[:10], None, "note_metadata"
+    match = TITLE_DATE.match(title or "")
+    if match:
+        return match.group("date"), None, "title"
+    return None, None, None
+
+
+def _narrative_date(flat: str, start: int, noted: Optional[str],
+                    noted_evidence: Optional[str], noted_source: Optional[str]):
+    """Date for an undated narrative line starting at flat[start].
+
+    The nearest date earlier in the same or the previous sentence wins ("On 02/22/24, KFLC were ...",
+    "MM markers (1/16): KFLC 242, ..."); a month/day date takes the latest year that does not put it
+    after the note. Without one the line reports the note's own results, unless it is described as
+    a past result. Returns (date, evidence, source) or None when the date cannot be told.
+    """
+    bounds = [m.end() for m in _SENTENCE_END.finditer(flat, 0, start)]
+    context_start = bounds[-2] if len(bounds) > 1 else 0
+    dates = list(_CONTEXT_DATE.finditer(flat, context_start, start))
+    if not dates:
+        if noted is None or _HISTORICAL.search(flat, bounds[-1] if bounds else 0, start):
+            return None
+        return noted, noted_evidence, noted_source
+    found = dates[-1]
+    if found.group("m"):
+        return to_iso_date(found.group(0)), found.group(0), DATE_FROM_EVIDENCE
+    if found.group("my_m"):
+        return f"{found.group('my_y')}-{int(found.group('my_m')):02d}-XX", found.group(0), DATE_FROM_EVIDENCE
+    if noted is None:
+        return None
+    month, day = int(found.group("md_m")), int(found.group("md_d"))
+    if not (1 <= month <= 12 and 1 <= day <= 31):
+        return None
+    year = int(noted[:4]) - ((month, day) > (int(noted[5:7]), int(noted[8:10])))
+    return f"{year:04d}-{month:02d}-{day:02d}", found.group(0), DATE_FROM_EVIDENCE
+
+
+def extract_flc_rules(title: str, text: str,
+                      metadata_date: Optional[str] = None) -> Tuple[List[Dict[str, Any]], bool]:
+    """Extract FLC records from one chunk with compiled patterns.
+
+    `metadata_date` is the note_date the chunker stored for the chunk's note; undated results take
+    their date from the surrounding sentences or the note (see _narrative_date). Each record's
+    date_source says where its date came from (see note_date).
+    Returns (records, resolved). `resolved` is True only when at least one record was found and
+    no other numeric FLC mention is left in the chunk, i.e. the LLM would have nothing to add.
+    """
+    flat = re.sub(r"\s+", " ", text)
+    records, seen = [], set()
+    leftover = flat
+    noted = note_date(title, text, metadata_date)
+
+    for pattern in PATTERNS:
+        # Later patterns only see what earlier ones left, so one line is not read twice
+        for match in pattern.finditer(leftover):
+            if pattern is NARRATIVE:
+                if match.group("lambda") is None or match.group("ratio") is None:
+                    continue
+                dated = _narrative_date(flat, match.start(), *noted)
+                if dated is None:
+                    continue
+                date, date_evidence, date_source = dated
+            elif "date" in match.groupdict() and match.group("date"):
+                date = to_iso_date(match.group("date"))
+                date_evidence, date_source = match.group("date"), DATE_FROM_EVIDENCE
+            else:
+                date, date_evidence, date_source = noted
+                if date is None:
+                    continue
+            record = {
+                "title": title,
+                "kappa_flc": _with_unit(match.group("kappa"), match.group("kunit")),
+                "lambda_flc": _with_unit(match.group("lambda"), match.group("lunit")),
+                "kappa_lambda_ratio": _clean_value(match.group("ratio")),
+                "date_of_lab": date,
+                "evidence_sentences_for_lab_values": [match.group(0)],
+                "evidence_sentences_for_lab_date": [date_evidence] if date_evidence else [],
+                "date_source": date_source,
+            }
+            key = (record["kappa_flc"], record["lambda_flc"], record["kappa_lambda_ratio"], date)
+            if key not in seen:
+                seen.add(key)
+                records.append(record)
+            # Blank out the matched span so it is not counted as an unresolved mention
+            leftover = leftover[:match.start()] + " " * (match.end() - match.start()) + leftover[match.end():]
+
+    resolved = bool(records) and not FLC_MENTION.search(leftover)
+    return records, resolved
+
+
+def split_by_rules(documents: List[Dict[str, Any]], title_key: str = "title", text_key: str = "medical_notes",
+                   note_dates: Optional[Dict[str, str]] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Run the rule extractor over retrieved chunks.
+
+    `note_dates` maps titles to the note_date metadata of their chunks.
+    Returns (records from fully resolved chunks, chunks that still need the LLM).
+    """
+    records, unresolved = [], []
+    for doc in documents:
+        found, resolved = extract_flc_rules(doc[title_key], doc[text_key], (note_dates or {}).get(doc[title_key]))
+        if resolved:
+            records.extend(found)
+        else:
+            unresolved.append(doc)
+    return records, unresolved
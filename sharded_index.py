@@ -0,0 +1,224 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from bm25_index import BM25Index
+from mmap_store import MmapVectorStore, export_store
+from retrieval import fuse_hybrid
+from tracing import get_tracer
+
+# Layout: <root>/shards.json (manifest) and one mmap store folder (+ bm25.sqlite) per patient
+MANIFEST_FILE = "shards.json"
+UNKNOWN_PATIENT = "_unknown"
+
+
+def shard_dir(patient_id: str) -> str:
+    """Folder name of a patient's shard.
+
+    Patient ids come from the note text, so they are never used as paths directly: the name is
+    the id with anything but letters, digits, "-" and "_" replaced, plus a hash of the full id.
+    """
+    safe = re.sub(r"[^A-Za-z0-9_-]", "_", patient_id)[:40]
+    return f"{safe}-{hashlib.sha256(patient_id.encode('utf-8')).hexdigest()[:16]}"
+
+
+def _read_manifest(root: str) -> Dict[str, dict]:
+    path = os.path.join(root, MANIFEST_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build_shards(store: FAISS, root: str = "sharded_index") -> Dict[str, dict]:
+    """Split a synced FAISS store into one memory-mapped shard per patient.
+
+    Vectors are copied out of `store`, nothing is re-embedded. The manifest maps each patient to
+    its shard folder and keeps the shard's date range and note types, so searches can skip shards
+    without opening them, and a hash of its chunk ids: shards whose chunks are unchanged since the
+    last build are not written again.
+    """
+    by_patient = defaultdict(list)
+    manifest = {}
+    for pos in range(store.index.ntotal):
+        meta = store.docstore.search(store.index_to_docstore_id[pos]).metadata
+        patient_id = str(meta.get("patient_id") or UNKNOWN_PATIENT)
+        by_patient[patient_id].append(pos)
+        entry = manifest.setdefault(patient_id, {"dir": shard_dir(patient_id), "count": 0, "first_date": None,
+                                                 "last_date": None, "note_types": []})
+        entry["count"] += 1
+        date = meta.get("note_date")
+        if date:
+            entry["first_date"] = min(filter(None, [entry["first_date"], date]))
+            entry["last_date"] = max(filter(None, [entry["last_date"], date]))
+        if meta.get("note_type") and meta["note_type"] not in entry["note_types"]:
+            entry["note_types"].append(meta["note_type"])
+
+    os.makedirs(root, exist_ok=True)
+    previous = _read_manifest(root)
+    written = 0
+    for patient_id, positions in by_patient.items():
+        entry = manifest[patient_id]
+        # Chunk ids hash the chunk's source and text, so the same id set means the same shard
+        chunk_ids = sorted(store.index_to_docstore_id[pos] for pos in positions)
+        entry["chunks_hash"] = hashlib.sha256("\n".join(chunk_ids).encode("utf-8")).hexdigest()
+        shard_path = os.path.join(root, entry["dir"])
+        old = previous.get(patient_id, {})
+        if (old.get("dir") == entry["dir"] and old.get("chunks_hash") == entry["chunks_hash"]
+                and os.path.isdir(shard_path)):
+            continue
+        written += 1
+        export_store(store, shard_path, index_path=None, positions=positions)
+        bm25 = BM25Index()
+        for pos in positions:
+            chunk_id = store.index_to_docstore_id[pos]
+            bm25.add(chunk_id, store.docstore.search(chunk_id).page_content)
+        bm25.save(shard_path)
+
+    # Drop shards of patients that are no longer in the index
+    dirs = {entry["dir"] for entry in manifest.values()}
+    for name in os.listdir(root):
+        if os.path.isdir(os.path.join(root, name)) and name not in dirs:
+            shutil.rmtree(os.path.join(root, name))
+
+    tmp_path = os.path.join(root, MANIFEST_FILE + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, os.path.join(root, MANIFEST_FILE))
+    print(f"[Shards] {len(manifest)} patient shards in {root} ({written} written, "
+          f"{len(manifest) - written} unchanged)")
+    return manifest
+
+
+def publish_index(index: FAISS, index_path: str = "faiss_index", store_path: str = "vector_store",
+                  shards_root: str = "sharded_index") -> None:
+    """Refresh the readers' copies of a just-synced index: the memory-mapped store extract_flca.py
+    searches and the per-patient shards. Call it after every sync_index (and after saving the
+    near-duplicate provenance), or the readers keep searching the previous corpus."""
+    export_store(index, store_path, index_path=index_path)
+    build_shards(index, shards_root)
+
+
+def shards_exist(root: str = "sharded_index") -> bool:
+    return os.path.exists(os.path.join(root, MANIFEST_FILE))
+
+
+def open_scoped_index(scope: Dict[str, object], embedding_function,
+                      root: str = "sharded_index") -> Optional["ShardedIndex"]:
+    """The sharded index a retrieval scope is applied to; None when no scope is set.
+
+    A scope that cannot be applied is an error: searching every patient instead would silently
+    return other patients' notes.
+    """
+    if not scope:
+        return None
+    if not shards_exist(root):
+        raise FileNotFoundError(
+            f"Retrieval scope {scope} is set but {root} has no shards; run vectorize_patient_emr.py "
+            f"to build them or unset the RETRIEVAL_* variables"
+        )
+    return ShardedIndex(root, embedding_function)
+
+
+class ShardedIndex:
+    """Hybrid search over per-patient shards, scoped by patient, note date and note type.
+
+    Shards are opened lazily (an mmap store opens in milliseconds) and searched in parallel;
+    the query embedding is computed once and shared by every shard.
+    """
+
+    def __init__(self, root: str, embedding_function, max_workers: int = 8):
+        self.manifest = _read_manifest(root)
+        if any("dir" not in entry for entry in self.manifest.values()):
+            raise ValueError(f"{root} was built without shard folder names; run vectorize_patient_emr.py "
+                             f"to rebuild it")
+        self.root = root
+        self.embedding_function = embedding_function
+        self.max_workers = max_workers
+        self._shards: Dict[str, Tuple[MmapVectorStore, BM25Index]] = {}
+        self._lock = threading.Lock()
+
+    def _open(self, patient_id: str) -> Tuple[MmapVectorStore, BM25Index]:
+        with self._lock:
+            if patient_id not in self._shards:
+                path = os.path.join(self.root, self.manifest[patient_id]["dir"])
+                self._shards[patient_id] = (MmapVectorStore.load(path, self.embedding_function),
+                                            BM25Index.load(path))
+            return self._shards[patient_id]
+
+    def select_shards(self, patient_ids: Optional[Sequence[str]] = None, date_from: Optional[str] = None,
+                      date_to: Optional[str] = None, note_types: Optional[Sequence[str]] = None) -> List[str]:
+        """Shards that can hold matching chunks, decided from the manifest alone."""
+        selected = []
+        for patient_id in (patient_ids if patient_ids is not None else self.manifest):
+            entry = self.manifest.get(patient_id)
+            if entry is None:
+                continue
+            if date_from and entry["last_date"] and entry["last_date"] < date_from:
+                continue
+            if date_to and entry["first_date"] and entry["first_date"] > date_to:
+                continue
+            if note_types and not set(note_types) & set(entry["note_types"]):
+                continue
+            selected.append(patient_id)
+        return selected
+
+    def _search_shard(self, patient_id: str, vectors: Optional[np.ndarray], keywords: Sequence[str],
+                      filters: dict, vector_k: int, keyword_k: Optional[int],
+                      substring: bool) -> Dict[str, Tuple[float, MmapVectorStore]]:
+        store, bm25 = self._open(patient_id)
+        positions = store.filter_positions(**filters)
+        if positions is not None and len(positions) == 0:
+            return {}
+        if vectors is not None:
+            dense = store.search_vectors(vectors, vector_k, positions)
+        else:
+            dense = [[] for _ in keywords]
+        allowed = None if positions is None else set(store.chunk_ids(positions))
+        fused = fuse_hybrid(bm25, keywords, dense, keyword_k=keyword_k, substring=substring, allowed_ids=allowed)
+        return {chunk_id: (score, store) for chunk_id, score in fused.items()}
+
+    def search(self, queries: Sequence[str], keywords: Optional[Sequence[str]] = None,
+               patient_ids: Optional[Sequence[str]] = None, date_from: Optional[str] = None,
+               date_to: Optional[str] = None, note_types: Optional[Sequence[str]] = None,
+               k: Optional[int] = None, vector_k: int = 100, keyword_k: Optional[int] = None,
+               substring: bool = True) -> List[Tuple[Document, float]]:
+        """multi_query_search over the selected shards; dates are inclusive YYYY-MM-DD bounds."""
+        keywords = list(keywords) if keywords is not None else list(queries)
+        filters = {"date_from": date_from, "date_to": date_to, "note_types": note_types}
+        shard_ids = self.select_shards(patient_ids, **filters)
+        print(f"[Shards] Searching {len(shard_ids)} of {len(self.manifest)} shards")
+        if not shard_ids:
+            return []
+
+        vectors = None
+        if vector_k:
+            with get_tracer().span("embedding", "query", items=len(queries)):
+                vectors = np.asarray(self.embedding_function.embed_documents(list(queries)), dtype=np.float32)
+
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(shard_ids))) as pool:
+            results = list(pool.map(
+                lambda patient_id: self._search_shard(patient_id, vectors, keywords, filters, vector_k,
+                                                      keyword_k, substring),
+                shard_ids,
+            ))
+
+        best = {}
+        for fused in results:
+            for chunk_id, (score, store) in fused.items():
+                if chunk_id not in best or score > best[chunk_id][0]:
+                    best[chunk_id] = (score, store)
+        ranked = sorted(best.items(), key=lambda x: x[1][0], reverse=True)
+        if k is not None:
+            ranked = ranked[:k]
+        return [(store.docstore.search(chunk_id), score) for chunk_id, (score, store) in ranked]
@@ -0,0 +1,20 @@
+from bm25_index import BM25Index
+
+
+def make_index(texts):
+    index = BM25Index()
+    for i, text in enumerate(texts):
+        index.add(str(i), text)
+    return index
+
+
+def test_multi_word_keywords_need_every_word():
+    index = make_index(["Kappa free light chain 20.78 mg/L", "free of symptoms", "light chain disease"])
+    assert [chunk_id for chunk_id, _ in index.search("free light chain", substring=True)] == ["0"]
+
+
+def test_expansion_only_from_the_start_of_a_word():
+    index = make_index(["kappa/lambda ratios 1.2", "lightheadedness and flights", "ratio of 3"])
+    assert {chunk_id for chunk_id, _ in index.search("ratio", substring=True)} == {"0", "2"}
+    assert [chunk_id for chunk_id, _ in index.search("light", substring=True)] == ["1"]
+    assert index.search("ight", substring=True) == []
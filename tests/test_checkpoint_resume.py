@@ -0,0 +1,77 @@
+import asyncio
+import json
+
+import checkpoint_store
+from checkpoint_store import checkpoint_node, open_checkpoints, run_prompts_checkpointed
+from llm_runner import LLMBatchError
+from offline_backends import RuleBasedChatModel
+
+LINES = [
+    "1/16/24: KFLC 242.66, LFLC <0.15, kappa/lambda ratio >1733.29",
+    "1/24/24: KFLC 203.94, LFLC <0.15, ratio >1456.71",
+    "2/22/24: KFLC 16.18, LFLC <0.15, kappa/lambda ratio >115.57",
+]
+
+
+class RecordingModel(RuleBasedChatModel):
+    """The offline rule-based model, counting calls and failing prompts that contain `fail_on`."""
+
+    def __init__(self, fail_on=None):
+        super().__init__()
+        self.fail_on = fail_on
+        self.prompts = []
+
+    async def ainvoke(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+        if self.fail_on and self.fail_on in prompt:
+            raise ValueError("deployment unavailable")
+        return await super().ainvoke(prompt, **kwargs)
+
+
+def run_pipeline(llm, calls):
+    """Two checkpointed nodes shaped like extract_flca.py's: retrieval, then batched extraction."""
+
+    @checkpoint_node("Retrieve")
+    def retrieve(state):
+        calls.append("Retrieve")
+        docs = [{"title": f"2024-03-0{i}_note", "medical_notes": line} for i, line in enumerate(LINES, 1)]
+        return {**state, "documents": docs}
+
+    @checkpoint_node("Extract", llm=llm)
+    async def extract(state):
+        calls.append("Extract")
+        failed_batches = list(state.get("failed_batches", []))
+        prompts = [f"Extract the FLC values.\n{json.dumps([doc])}" for doc in state["documents"]]
+        try:
+            responses = await run_prompts_checkpointed(llm, prompts, "Extract", max_retries=0)
+        except LLMBatchError as e:
+            failed_batches.extend({"stage": "Extract", "batch": i} for i in e.failed)
+            responses = e.results
+        records = [r for response in responses if response is not None for r in json.loads(response.content)]
+        return {**state, "records": records, "failed_batches": failed_batches}
+
+    return asyncio.run(extract(retrieve({"query": "flc"})))
+
+
+def test_resume_restores_finished_batches_and_reruns_failed_nodes(tmp_path, monkeypatch):
+    monkeypatch.setattr(checkpoint_store, "_checkpoints", checkpoint_store.get_checkpoints())
+    open_checkpoints(str(tmp_path / "checkpoints.sqlite"), "resume")
+
+    calls, flaky = [], RecordingModel(fail_on="1/24/24")
+    first = run_pipeline(flaky, calls)
+    assert calls == ["Retrieve", "Extract"]
+    assert first["failed_batches"] == [{"stage": "Extract", "batch": 1}]
+    assert len(first["records"]) == 2
+
+    # Resume: retrieval is restored, extraction runs again but only sends the failed batch
+    calls, healthy = [], RecordingModel()
+    second = run_pipeline(healthy, calls)
+    assert calls == ["Extract"]
+    assert len(healthy.prompts) == 1 and "1/24/24" in healthy.prompts[0]
+    assert second["failed_batches"] == []
+    assert [r["kappa_flc"] for r in second["records"]] == ["242.66", "203.94", "16.18"]
+
+    # A finished run is restored whole
+    calls, idle = [], RecordingModel()
+    assert run_pipeline(idle, calls) == second
+    assert calls == [] and idle.prompts == []
@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from extraction_engine import ExtractionEngine, SCHEMAS
+
+FLC_LINE = "1/16/24: KFLC 242.66, LFLC <0.15, kappa/lambda ratio >1733.29"
+
+
+def make_engine(*names):
+    return ExtractionEngine(llm=None, schemas=[SCHEMAS[name] for name in names or SCHEMAS])
+
+
+def item(title, text, *schemas):
+    return {"title": title, "medical_notes": text, "schemas": list(schemas)}
+
+
+def test_split_response_keeps_records_of_the_batch_titles():
+    engine = make_engine("flc", "m_spike")
+    batch = [item("a", "...", "flc"), item("b", "...", "m_spike")]
+    content = json.dumps({
+        "flc": [{"title": "a", "kappa_flc": "1.2"}, {"title": "elsewhere", "kappa_flc": "3"}, {"kappa_flc": "4"}],
+        "m_spike": [{"title": "b", "m_spike": "0.3 g/dL", "extra": "dropped"}],
+        "unknown": [{"title": "a"}],
+    })
+    results = engine.split_response(content, batch)
+    assert [r["kappa_flc"] for r in results["flc"]] == ["1.2"]
+    assert results["m_spike"] == [{"title": "b", "m_spike": "0.3 g/dL", "date_of_lab": None,
+                                   "evidence_sentences": None}]
+    assert "unknown" not in results
+
+
+def test_split_response_bare_list():
+    engine = make_engine("flc", "m_spike")
+    records = [{"title": "a", "kappa_flc": "1.2"}]
+    assert engine.split_response(json.dumps(records), [item("a", "...", "flc")])["flc"][0]["kappa_flc"] == "1.2"
+    with pytest.raises(ValueError):
+        engine.split_response(json.dumps(records), [item("a", "...", "flc"), item("b", "...", "m_spike")])
+    with pytest.raises(ValueError):
+        engine.split_response('"no records"', [item("a", "...", "flc")])
+
+
+def test_apply_rules_resolves_only_fully_matched_chunks():
+    engine = make_engine("flc", "m_spike")
+    items = [
+        item("2024-02-01_note", FLC_LINE, "flc"),
+        item("2024-02-02_note", FLC_LINE + " M spike 0.3 g/dL", "flc", "m_spike"),
+        item("2024-02-03_note", FLC_LINE + ". Earlier kappa 31.5 and lambda 2", "flc"),
+    ]
+    results, remaining = engine.apply_rules(items)
+    assert [r["title"] for r in results["flc"]] == ["2024-02-01_note", "2024-02-02_note"]
+    assert results["m_spike"] == []
+    assert [(r["title"], r["schemas"]) for r in remaining] == [
+        ("2024-02-02_note", ["m_spike"]), ("2024-02-03_note", ["flc"])]
@@ -0,0 +1,60 @@
+import types
+
+from langchain_core.documents import Document
+
+import embedding_cache
+from bm25_index import BM25Index
+from embedding_cache import EmbeddingCache
+from faiss_store import sync_index
+from offline_backends import HashEmbeddings
+
+NOTES = {
+    "a.txt": ["KFLC 242.66, LFLC <0.15, kappa/lambda ratio >1733.29", "Continue daratumumab every 4 weeks"],
+    "b.txt": ["M spike 2.81 g/dL on SPEP", "Bone marrow biopsy showed 60% plasma cells"],
+}
+
+
+class CountingEmbeddings(HashEmbeddings):
+    def __init__(self):
+        super().__init__()
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return super().embed_documents(texts)
+
+
+def chunks(notes):
+    return [Document(page_content=text, metadata={"source": source}) for source, texts in notes.items()
+            for text in texts]
+
+
+def test_resync_embeds_only_edited_chunks_and_keeps_bm25_in_step(tmp_path):
+    index_path = str(tmp_path / "faiss_index")
+    embeddings = CountingEmbeddings()
+    before = set(sync_index(chunks(NOTES), embeddings, index_path).index_to_docstore_id.values())
+    assert len(before) == 4
+
+    edited = {**NOTES, "b.txt": ["M spike 1.90 g/dL on SPEP", NOTES["b.txt"][1]]}
+    embeddings.embedded.clear()
+    index = sync_index(chunks(edited), embeddings, index_path)
+    after = set(index.index_to_docstore_id.values())
+
+    assert (len(after - before), len(before - after)) == (1, 1)
+    assert embeddings.embedded == ["M spike 1.90 g/dL on SPEP"]
+    bm25 = BM25Index.load(index_path)
+    assert bm25.chunk_ids() == after
+    [(hit, _)] = bm25.search("spike")
+    assert index.docstore.search(hit).page_content == "M spike 1.90 g/dL on SPEP"
+
+
+def test_embedding_cache_evicts_the_least_recently_used(tmp_path, monkeypatch):
+    ticks = iter(range(100))
+    monkeypatch.setattr(embedding_cache, "time", types.SimpleNamespace(time=lambda: next(ticks)))
+    cache = EmbeddingCache(str(tmp_path / "cache.sqlite"), max_entries=2)
+    cache.put_many("m", ["a", "b"], [[1.0], [2.0]])
+    assert set(cache.get_many("m", ["a"])) == {"a"}  # "a" is now more recent than "b"
+    cache.put_many("m", ["c"], [[3.0]])
+    assert len(cache) == 2
+    assert set(cache.get_many("m", ["a", "b", "c"])) == {"a", "c"}
+    cache.close()
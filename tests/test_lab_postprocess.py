@@ -0,0 +1,37 @@
+import pandas as pd
+
+from lab_postprocess import evidence_units, postprocess_labs
+
+FIELDS = {"kappa_flc": "mg/L", "lambda_flc": "mg/L"}
+
+
+def record(kappa, lam, evidence, date="2024-01-24"):
+    return {"patient_id": "p1", "date_of_lab": date, "kappa_flc": kappa, "lambda_flc": lam,
+            "evidence_sentences_for_lab_values": [evidence]}
+
+
+def test_bare_values_are_kept_when_the_unit_is_unknown():
+    df = postprocess_labs([record("204", "< 0.15", "KFLC 204, LFLC < 0.15")], FIELDS,
+                          require=["kappa_flc", "lambda_flc"])
+    assert len(df) == 1
+    assert df["kappa_flc_raw_value"].iloc[0] == 204
+    assert df["lambda_flc_comparator"].iloc[0] == "<"
+    assert pd.isna(df["kappa_flc_value"].iloc[0]) and pd.isna(df["kappa_flc_unit"].iloc[0])
+
+
+def test_unit_attached_to_the_number():
+    assert evidence_units(pd.Series([["KFLC 06mg /dL, LFLC 1.2mg/dl"]])).iloc[0] == "mg/dl"
+    df = postprocess_labs([record("06", "1.2", "KFLC 06mg /dL, LFLC 1.2mg/dl", "2024-04-08")], FIELDS)
+    assert df["kappa_flc_value"].iloc[0] == 60.0
+
+
+def test_dedup_keys_unknown_units_on_the_raw_value():
+    df = postprocess_labs([
+        record("20.78", "0.24", "kappa FLC of 20.78, lambda FLC of 0.24"),
+        record("1.45", "0.73", "kappa FLC 1.45, lambda FLC 0.73"),
+        record("1.45", "0.73", "kappa FLC 1.45, lambda FLC 0.73"),
+        record("1.45 mg/dL", "0.73 mg/dL", "kappa 1.45 mg/dL, lambda 0.73 mg/dL"),
+    ], FIELDS)
+    # Different bare values stay apart; a bare value is not merged into the same number with a unit
+    assert df["kappa_flc_raw_value"].tolist() == [20.78, 1.45, 1.45]
+    assert df["kappa_flc_value"].isna().tolist() == [True, True, False]
@@ -0,0 +1,76 @@
+import asyncio
+import types
+
+import pytest
+from langchain_core.messages import AIMessage
+
+import llm_runner
+from llm_runner import LLMBatchError, RateLimiter, run_prompts
+
+
+class FakeClock:
+    """Stands in for llm_runner's time and asyncio.sleep: sleeping advances the clock instantly."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(llm_runner, "time", types.SimpleNamespace(monotonic=fake.monotonic))
+    monkeypatch.setattr(llm_runner, "asyncio", types.SimpleNamespace(Lock=asyncio.Lock, sleep=fake.sleep))
+    return fake
+
+
+def test_oversized_prompt_leaves_the_bucket_in_debt(clock):
+    # 600 tokens/minute = 10 tokens/s; the bucket holds 10 seconds' worth (100 tokens)
+    limiter = RateLimiter(tokens_per_minute=600)
+
+    async def scenario():
+        await limiter.acquire(250)  # waits only for a full bucket, is charged all 250
+        assert clock.sleeps == []
+        await limiter.acquire(10)  # must first pay back the 150-token debt plus its own 10
+
+    asyncio.run(scenario())
+    assert sum(clock.sleeps) == pytest.approx(16.0)
+
+
+class EchoModel:
+    """Answers each prompt with itself, the later prompts faster; "fail" prompts raise."""
+
+    def __init__(self, prompts):
+        self.delays = {prompt: 0.01 * (len(prompts) - i) for i, prompt in enumerate(prompts)}
+
+    async def ainvoke(self, prompt, **kwargs):
+        await asyncio.sleep(self.delays[prompt])
+        if prompt.startswith("fail"):
+            raise ValueError(prompt)
+        return AIMessage(content=prompt)
+
+
+def test_results_come_back_in_input_order():
+    prompts = [f"prompt {i}" for i in range(6)]
+    finished = []
+    results = asyncio.run(run_prompts(EchoModel(prompts), prompts, max_concurrency=6,
+                                      on_result=lambda i, _: finished.append(i)))
+    assert [r.content for r in results] == prompts
+    assert finished == sorted(finished, reverse=True)
+
+
+def test_batch_error_carries_the_successful_results():
+    prompts = ["prompt 0", "fail 1", "prompt 2"]
+    with pytest.raises(LLMBatchError) as raised:
+        asyncio.run(run_prompts(EchoModel(prompts), prompts))
+    error = raised.value
+    assert error.failed == [1]
+    assert isinstance(error.errors[0], ValueError)
+    assert [r.content if r else None for r in error.results] == ["prompt 0", None, "prompt 2"]
@@ -0,0 +1,45 @@
+import pytest
+
+from local_validator import validate_record, VALID, INVALID, AMBIGUOUS
+
+TITLE = "2024-03-06_00:00:00.000_Progress Note"
+SOURCE = "MM markers on 2/22/24: KFLC 16.18 mg/dL, LFLC <0.15 mg/dL, kappa/lambda ratio >115.57"
+
+
+def record(**changes):
+    base = {
+        "title": TITLE,
+        "kappa_flc": "16.18 mg/dL",
+        "lambda_flc": "<0.15 mg/dL",
+        "kappa_lambda_ratio": ">115.57",
+        "date_of_lab": "2024-02-22",
+        "evidence_sentences_for_lab_values": [SOURCE],
+        "evidence_sentences_for_lab_date": ["MM markers on 2/22/24"],
+    }
+    return {**base, **changes}
+
+
+@pytest.mark.parametrize("case, rec, source, metadata_date, expected", [
+    ("all checks pass", record(), SOURCE, None, (VALID, [])),
+    ("comparator mismatch", record(lambda_flc="0.15 mg/dL"), SOURCE, None, (AMBIGUOUS, ["lambda_flc"])),
+    ("value not in evidence", record(kappa_flc="61.8"), SOURCE, None, (INVALID, ["kappa_flc"])),
+    ("lab after the note", record(date_of_lab="2024-03-22", evidence_sentences_for_lab_date=["3/22/24"]),
+     SOURCE + " 3/22/24", None, (INVALID, ["date_of_lab"])),
+    ("evidence as a single string", record(evidence_sentences_for_lab_values=SOURCE,
+                                           evidence_sentences_for_lab_date="MM markers on 2/22/24"),
+     SOURCE, None, (VALID, [])),
+    ("dated from metadata", record(date_of_lab="2024-03-01", evidence_sentences_for_lab_date=[],
+                                   date_source="note_metadata"), SOURCE, "2024-03-01", (VALID, [])),
+    ("metadata date disagrees", record(date_of_lab="2024-02-01", evidence_sentences_for_lab_date=[],
+                                       date_source="note_metadata"), SOURCE, "2024-03-01",
+     (INVALID, ["date_of_lab"])),
+    ("month name", record(date_of_lab="2024-02-XX", evidence_sentences_for_lab_date=["in Feb. 2024"]),
+     SOURCE + " in Feb. 2024", None, (VALID, [])),
+    ("'Mar' inside a word", record(date_of_lab="2023-03-XX", evidence_sentences_for_lab_date=["Marrow 2023"]),
+     SOURCE + " Marrow 2023", None, (AMBIGUOUS, ["date_of_lab"])),
+    ("evidence not in the chunk", record(evidence_sentences_for_lab_values=["KFLC 16.18, LFLC <0.15, ratio >115.57 "
+                                                                            "per outside records from Duke"]),
+     SOURCE, None, (INVALID, ["evidence_in_source"])),
+])
+def test_validate_record(case, rec, source, metadata_date, expected):
+    assert validate_record(rec, source, metadata_date) == expected
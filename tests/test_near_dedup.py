@@ -0,0 +1,49 @@
+from langchain_core.documents import Document
+
+from near_dedup import ChunkDeduplicator, MinHashLSH
+
+NOTE = ("Patient seen in clinic for follow up of IgG kappa multiple myeloma on daratumumab. "
+        "Tolerating treatment well with mild fatigue, no fevers, no new bone pain, appetite stable.")
+
+
+def doc(text, source, patient_id="p1"):
+    return Document(page_content=text, metadata={"source": source, "title": source, "patient_id": patient_id})
+
+
+def test_lsh_matches_near_duplicates_above_the_threshold():
+    lsh = MinHashLSH(threshold=0.8)
+    assert lsh.add(NOTE) == (0, True)
+    assert lsh.add(NOTE + " Plan unchanged") == (0, False)
+    assert lsh.add("Lambda light chain amyloidosis with cardiac involvement, started on CyBorD") == (1, True)
+
+
+def test_lsh_threshold_and_scope():
+    edited = NOTE.replace("mild fatigue", "worsening fatigue and nausea")
+    strict, loose = MinHashLSH(threshold=1.0), MinHashLSH(threshold=0.5)
+    for lsh in (strict, loose):
+        lsh.add(NOTE)
+    assert strict.add(edited) == (1, True)
+    assert loose.add(edited) == (0, False)
+    assert loose.add(NOTE, scope="p2") == (1, True)
+
+
+def test_lsh_never_matches_texts_with_different_numbers():
+    lsh = MinHashLSH(threshold=0.5)
+    lsh.add(NOTE + " KFLC 242.66")
+    assert lsh.add(NOTE + " KFLC 16.18") == (1, True)
+
+
+def test_filter_keeps_one_chunk_per_patient_and_records_provenance():
+    dedup = ChunkDeduplicator(threshold=0.8)
+    docs = [doc(NOTE, "a.txt"), doc(NOTE, "b.txt"), doc(NOTE, "b.txt"), doc(NOTE, "c.txt", patient_id="p2")]
+    kept = list(dedup.filter(docs))
+    assert [d.metadata["source"] for d in kept] == ["a.txt", "c.txt"]
+    assert (dedup.kept, dedup.dropped) == (2, 2)
+    [links] = dedup.provenance.values()
+    assert [link["source"] for link in links] == ["b.txt"]
+
+
+def test_filter_without_scope_merges_across_patients():
+    dedup = ChunkDeduplicator(threshold=0.8, scope_key=None)
+    kept = list(dedup.filter([doc(NOTE, "a.txt"), doc(NOTE, "c.txt", patient_id="p2")]))
+    assert len(kept) == 1
@@ -0,0 +1,47 @@
+import pytest
+
+from rule_extractor import extract_flc_rules
+
+TITLE = "2024-03-06_00:00:00.000_Progress Note"
+
+
+def values(records):
+    return [(r["kappa_flc"], r["lambda_flc"], r["kappa_lambda_ratio"], r["date_of_lab"], r["date_source"])
+            for r in records]
+
+
+# Lines as they appear in the bundled notes
+@pytest.mark.parametrize("line, expected", [
+    ("- MM markers (1/16): KFLC 242, LFLC < 0.15, ratio >1733.29, M spike 2.81 g/dL",
+     ("242", "<0.15", ">1733.29", "2024-01-16", "evidence")),
+    ("On 02/22/24, KFLC were 16.18; LFLC <0.15; FLC ratio >115.57.",
+     ("16.18", "<0.15", ">115.57", "2024-02-22", "evidence")),
+    ("In 6/2021, he had kappa FLC of 20.78, lambda FLC of 0.24, kappa/lambda ratio of 86.58.",
+     ("20.78", "0.24", "86.58", "2021-06-XX", "evidence")),
+    ("Repeat labs on 11/7/2023 showed M spike 2.2 g/dL, KFLC 141.89 mg/dL, LFLC <0.15 mg/dL, K/L >1,013.50.",
+     ("141.89 mg/dL", "<0.15 mg/dL", ">1013.50", "2023-11-07", "evidence")),
+    ("Labs today: KFLC 27.56 mg/dL, LFLC 0.76, K/L 36.26.",
+     ("27.56 mg/dL", "0.76", "36.26", "2024-03-06", "title")),
+])
+def test_narrative_lines(line, expected):
+    records, resolved = extract_flc_rules(TITLE, line)
+    assert values(records) == [expected]
+    assert resolved
+
+
+def test_month_day_takes_the_latest_year_not_after_the_note():
+    records, _ = extract_flc_rules(TITLE, "Labs (12/15): KFLC 1.24, LFLC 0.72, K/L ratio 1.72")
+    assert records[0]["date_of_lab"] == "2023-12-15"
+
+
+@pytest.mark.parametrize("line", [
+    # Past results, without a date to tell when
+    "At that time, he had an M-spike of 6, kappa FLC 64.9, lambda FLC 0.34, kappa/lambda ratio of 190.",
+    # A trend, and a line missing the lambda value
+    "KFLC 42.6-->16.18, LFLC <0.15, ratio >115.57",
+    "Most recent labs show KFLC 1.24, K/L 1.72 - UPEP negative",
+])
+def test_unclear_lines_are_left_to_the_llm(line):
+    records, resolved = extract_flc_rules(TITLE, line)
+    assert records == []
+    assert not resolved
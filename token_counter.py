@@ -0,0 +1,29 @@
+from functools import lru_cache
+
+import tiktoken
+
+
+def _load_encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Azure deployment names are not known to tiktoken; every model we use is cl100k/o200k based
+        return tiktoken.get_encoding("o200k_base" if "4o" in model or "4.1" in model else "cl100k_base")
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "text-embedding-3-large"):
+    try:
+        return _load_encoding(model)
+    except Exception as e:
+        # tiktoken downloads its BPE files on first use; without network (offline runs) fall back
+        # to a character-based estimate instead of failing the pipeline
+        print(f"[Tokens] No tiktoken encoding for {model} ({type(e).__name__}); estimating 4 chars per token")
+        return None
+
+
+def count_tokens(text: str, model: str = "text-embedding-3-large") -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
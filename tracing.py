@@ -0,0 +1,166 @@
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+# USD per 1K tokens for the cost column (config["tracing"]["prices"] overrides these)
+DEFAULT_PRICES = {
+    "llm": {"input": 0.0025, "output": 0.01},  # gpt-4o
+    "embedding": {"input": 0.00013, "output": 0.0},  # text-embedding-3-large
+}
+
+
+class Tracer:
+    """Structured trace of one pipeline run: node spans, LLM calls and embedding batches.
+
+    Each event is appended to a JSONL file as it happens (so a crashed run still leaves a
+    trace) and kept in memory for the end-of-run summary. A Tracer without a path only
+    aggregates; the module-level default tracer is disabled and records nothing.
+    """
+
+    def __init__(self, path: Optional[str] = None, enabled: bool = True,
+                 prices: Optional[Dict[str, Dict[str, float]]] = None):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.enabled = enabled
+        self.path = path
+        self.prices = prices or DEFAULT_PRICES
+        self.events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self._file = None
+        if enabled and path:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self._file = open(path, "a", encoding="utf-8")
+
+    def _cost(self, kind: str, fields: Dict[str, Any]) -> float:
+        price = self.prices.get(kind)
+        if price is None or fields.get("cached"):
+            return 0.0
+        return (fields.get("prompt_tokens", 0) * price["input"]
+                + fields.get("completion_tokens", 0) * price["output"]) / 1000
+
+    def record(self, kind: str, name: str, **fields) -> None:
+        if not self.enabled:
+            return
+        event = {"run_id": self.run_id, "ts": time.time(), "kind": kind, "name": name, **fields}
+        event["cost_usd"] = self._cost(kind, event)
+        with self._lock:
+            self.events.append(event)
+            if self._file:
+                self._file.write(json.dumps(event, default=str) + "\n")
+                self._file.flush()
+
+    @contextmanager
+    def span(self, kind: str, name: str, **fields):
+        """Time a block; fields added to the yielded dict inside the block are recorded too."""
+        extra: Dict[str, Any] = dict(fields)
+        start = time.perf_counter()
+        try:
+            yield extra
+        except BaseException as e:
+            extra.setdefault("status", "failed")
+            extra.setdefault("error", repr(e))
+            raise
+        finally:
+            extra.setdefault("status", "ok")
+            self.record(kind, name, seconds=time.perf_counter() - start, **extra)
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """One row per (kind, name): calls, failures, timings, queue wait, tokens, retries, cache hits, cost."""
+        groups = defaultdict(list)
+        for event in self.events:
+            groups[(event["kind"], event["name"])].append(event)
+        rows = []
+        for (kind, name), events in groups.items():
+            seconds = [e.get("seconds", 0.0) for e in events]
+            rows.append({
+                "kind": kind,
+                "name": name,
+                "calls": len(events),
+                "failures": sum(1 for e in events if e.get("status") == "failed"),
+                "total_s": round(sum(seconds), 3),
+                "mean_s": round(float(np.mean(seconds)), 3),
+                "p95_s": round(float(np.percentile(seconds, 95)), 3),
+                "queue_wait_s": round(sum(e.get("queue_wait", 0.0) for e in events), 3),
+                "retries": sum(e.get("retries", 0) for e in events),
+                "cache_hits": sum(e.get("cache_hits", 1 if e.get("cached") else 0) for e in events),
+                "prompt_tokens": sum(e.get("prompt_tokens", 0) for e in events),
+                "completion_tokens": sum(e.get("completion_tokens", 0) for e in events),
+                "cost_usd": round(sum(e.get("cost_usd", 0.0) for e in events), 4),
+            })
+        return rows
+
+    def format_summary(self) -> str:
+        rows = self.summary()
+        if not rows:
+            return "[Trace] No events recorded"
+        columns = list(rows[0].keys())
+        widths = {c: max(len(c), *(len(str(r[c])) for r in rows)) for c in columns}
+        lines = ["  ".join(c.ljust(widths[c]) for c in columns)]
+        lines += ["  ".join(str(r[c]).ljust(widths[c]) for c in columns) for r in rows]
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._file:
+                self._file.write(json.dumps({"run_id": self.run_id, "ts": time.time(), "kind": "summary",
+                                             "rows": self.summary()}) + "\n")
+                self._file.close()
+                self._file = None
+
+
+_tracer = Tracer(enabled=False)
+
+
+def get_tracer() -> Tracer:
+    return _tracer
+
+
+def start_trace(directory: Optional[str] = "traces", prefix: str = "run",
+                prices: Optional[Dict[str, Dict[str, float]]] = None) -> Tracer:
+    """Install a new global tracer writing to <directory>/<prefix>_<timestamp>.jsonl (None: in memory only)."""
+    global _tracer
+    path = None
+    if directory:
+        path = os.path.join(directory, f"{prefix}_{datetime.now():%Y%m%d_%H%M%S}.jsonl")
+    _tracer = Tracer(path, prices=prices)
+    print(f"[Trace] Run {_tracer.run_id}" + (f" tracing to {path}" if path else ""))
+    return _tracer
+
+
+def traced_node(name: str):
+    """Decorator recording a LangGraph node's wall time and the size of the lists it returns."""
+
+    def sizes(state: Any) -> Dict[str, int]:
+        if not isinstance(state, dict):
+            return {}
+        return {f"out_{key}": len(value) for key, value in state.items() if isinstance(value, list)}
+
+    def decorate(fn):
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(state):
+                with get_tracer().span("node", name) as fields:
+                    result = await fn(state)
+                    fields.update(sizes(result))
+                return result
+        else:
+            @functools.wraps(fn)
+            def wrapper(state):
+                with get_tracer().span("node", name) as fields:
+                    result = fn(state)
+                    fields.update(sizes(result))
+                return result
+        return wrapper
+
+    return decorate
@@ -1,5 +1,6 @@
 import re
 import json
+from itertools import islice
 
 def parse_llm_json(raw_text: str) -> str:
     if not raw_text.strip():
@@ -40,4 +41,13 @@ def clean_numeric(val: str) -> str:
 
 def batchify(lst, n):
     for i in range(0, len(lst), n):
-        yield lst[i:i + n]
\ No newline at end of file
+        yield lst[i:i + n]
+
+def iter_batches(iterable, n):
+    # Like batchify, but for generators: only holds one batch in memory
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, n))
+        if not batch:
+            return
+        yield batch
@@ -1,57 +1,59 @@
-import pandas as pd
+import os
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_core.documents import Document
 from util import *
-from langchain_community.vectorstores import FAISS
 from langchain_openai import AzureOpenAIEmbeddings
 from config import *
-
-csv_path = "d2c1f46e2b3267d315fb03f76724aa7036ea01b3f1803e94126e26dc26881629.csv"
-df = pd.read_csv(csv_path)
-
-# --- Create documents ---
-documents = []
-for _, row in tqdm(df.iterrows(), total=len(df)):
-    if pd.isna(row["text"]):
-        continue
-    documents.append(Document(page_content=row["text"], metadata={"source": row["title"]}))
-
-splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-chunks = splitter.split_documents(documents)
-
-batches = list(batchify(chunks, 20))
+from embedding_cache import get_cached_embeddings
+from faiss_store import sync_index
+from sharded_index import publish_index
+from ingest import iter_notes
+from note_chunker import NoteChunker, chunk_notes
+from near_dedup import ChunkDeduplicator
+from tracing import start_trace
+from offline_backends import offline_enabled, HashEmbeddings
+
+csv_path = os.environ.get("EMR_CSV_PATH", "d2c1f46e2b3267d315fb03f76724aa7036ea01b3f1803e94126e26dc26881629.csv")
+
+# --- Stream notes -> chunks (read and split lazily, one window at a time) ---
+# Chunks follow the note's sections and sentences, keep lab tables whole and leave the header out
+chunker = NoteChunker(config["chunking"]["chunk_size"], config["chunking"]["overlap"])
+chunks = chunk_notes(tqdm(iter_notes(csv_path, rows_per_chunk=1000)), chunker, workers=config["chunking"]["workers"])
+# Copied-forward text (lab tables pasted into every follow-up) is embedded once per patient;
+# the notes it also appeared in are saved with the index as provenance
+deduplicator = ChunkDeduplicator(config["near_dedup"]["threshold"]) if config["near_dedup"]["enabled"] else None
+if deduplicator:
+    chunks = deduplicator.filter(chunks)
 
 
 # --- Embedding & FAISS index ---
-embedding_model = AzureOpenAIEmbeddings(
-    deployment=config["embedding_models"]["text_embedding_3_large"],
-    model="text-embedding-3-large",
-    openai_api_key=config["azure_openai"]["api_key"],
-    azure_endpoint=config["azure_openai"]["endpoint"],
-    openai_api_version=config["azure_openai_4O"]["api_version"],
-    chunk_size=1000
-)
-
-def build_faiss(batch):
-    return FAISS.from_documents(batch, embedding_model)
-
-sub_indexes = []
-with ThreadPoolExecutor(max_workers=4) as executor:
-    futures = {executor.submit(build_faiss, batch): batch for batch in batches}
-    for future in tqdm(as_completed(futures), total=len(futures)):
-        try:
-            sub_indexes.append(future.result())
-        except Exception as e:
-            print(f"Batch failed: {e}")
-
-# Merge all sub-indexes into one
-print("Merging FAISS indexes...")
-main_index = sub_indexes[0]
-for sub_index in sub_indexes[1:]:
-    main_index.merge_from(sub_index)
-
-# Save final FAISS index
-print("Saving FAISS index...")
-main_index.save_local("faiss_index")
\ No newline at end of file
+if offline_enabled():
+    # Local hash embeddings (benchmarks / offline runs); cached under their own model name
+    embedding_model = get_cached_embeddings(HashEmbeddings(), HashEmbeddings.model_name)
+else:
+    azure_embeddings = AzureOpenAIEmbeddings(
+        deployment=config["embedding_models"]["text_embedding_3_large"],
+        model="text-embedding-3-large",
+        openai_api_key=config["azure_openai"]["api_key"],
+        azure_endpoint=config["azure_openai"]["endpoint"],
+        openai_api_version=config["azure_openai_4O"]["api_version"],
+        chunk_size=1000
+    )
+    # Vectors are cached on disk, so only new or changed chunks reach Azure
+    embedding_model = get_cached_embeddings(azure_embeddings, "text-embedding-3-large")
+
+tracer = start_trace(config["tracing"]["directory"], "vectorize", prices=config["tracing"]["prices"])
+
+# Add new chunks to / drop stale chunks from the saved index instead of rebuilding it
+print("Syncing FAISS index...")
+main_index = sync_index(chunks, embedding_model, "faiss_index", window_size=2000)
+print(f"Embedding cache: {embedding_model.hits} hits, {embedding_model.misses} misses")
+if deduplicator:
+    print(deduplicator.stats())
+    deduplicator.save("faiss_index")
+
+# Memory-mappable copy for the readers (extract_flca.py opens it without unpickling anything)
+# and per-patient shards for scoped (patient / date / note type) retrieval
+publish_index(main_index, "faiss_index", "vector_store", "sharded_index")
+
+print(tracer.format_summary())
+tracer.close()